@@ -0,0 +1,268 @@
+"""
+   Description:
+
+   Optional profiling of the API functions that are made available to the
+   sandboxed program. When profiling is enabled (repy's --profileapi
+   option), each function wrapped by the namespace layer records how often
+   it is called, how many calls raised an exception, how long the calls
+   took in total and at most, and a histogram of call latencies with
+   power-of-two bucket sizes. The latency is measured around the wrapped
+   function, so it includes argument checking and copying, any time the
+   nanny makes the call wait, and the underlying system call.
+
+   The report is written out when repy exits, and also whenever the repy
+   process receives SIGUSR1 (on systems that have it).
+
+   When profiling is disabled nothing is wrapped, so the API functions
+   don't pay anything for it.
+"""
+
+import math
+import os
+import signal
+import threading
+import time
+
+
+# Set by repy.py. If enabled is False, profile_function() should not be
+# called at all.
+enabled = False
+report_filename = None
+
+# To allow access to a real fileobject
+myfile = file
+
+# Saved while we still have it, as the signal handler may run at any time
+_sigusr1 = getattr(signal, "SIGUSR1", None)
+
+# The number of buckets in each latency histogram. Bucket 0 counts calls
+# which took less than a microsecond, bucket i counts calls which took from
+# 2**(i-1) up to 2**i microseconds, and the last bucket counts everything
+# which took longer than that (about 4 seconds and up).
+HISTOGRAM_BUCKETS = 24
+
+# Maps the name of each profiled function to its _FunctionProfile
+_profiles = {}
+_profiles_lock = threading.Lock()
+
+
+
+class _FunctionProfile(object):
+  """
+  The numbers recorded for one API function.
+  """
+
+  __slots__ = ["calls", "errors", "totaltime", "maxtime", "histogram"]
+
+  def __init__(self):
+    self.calls = 0
+    self.errors = 0
+    self.totaltime = 0.0
+    self.maxtime = 0.0
+    self.histogram = [0] * HISTOGRAM_BUCKETS
+
+
+
+def _get_bucket(elapsed):
+  """
+  Returns the index of the histogram bucket for a call that took elapsed
+  seconds.
+  """
+  # frexp gives the exponent e with 2**(e-1) <= x < 2**e, or e <= 0 for
+  # x < 1, which is exactly our bucket numbering.
+  exponent = math.frexp(elapsed * 1000000.0)[1]
+  if exponent < 0:
+    return 0
+  return min(exponent, HISTOGRAM_BUCKETS - 1)
+
+
+
+def _record_call(profile, elapsed, failed):
+  """
+  Adds one call which took elapsed seconds to profile.
+  """
+  bucket = _get_bucket(elapsed)
+
+  _profiles_lock.acquire()
+  try:
+    profile.calls += 1
+    if failed:
+      profile.errors += 1
+    profile.totaltime += elapsed
+    if elapsed > profile.maxtime:
+      profile.maxtime = elapsed
+    profile.histogram[bucket] += 1
+  finally:
+    _profiles_lock.release()
+
+
+
+def profile_function(name, function):
+  """
+  <Purpose>
+    Wraps a function so that its calls are recorded under name.
+
+  <Arguments>
+    name:
+      The name to report the function under, e.g. "openfile" or
+      "file.readat". Functions which are profiled under the same name
+      share their numbers.
+    function:
+      The function to wrap.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    Adds name to the report.
+
+  <Returns>
+    A function which calls function with the arguments it is given and
+    returns its return value or raises its exception.
+  """
+  _profiles_lock.acquire()
+  try:
+    if name not in _profiles:
+      _profiles[name] = _FunctionProfile()
+    profile = _profiles[name]
+  finally:
+    _profiles_lock.release()
+
+  timer = time.time
+
+  def profiled_function(*args, **kwargs):
+    failed = True
+    starttime = timer()
+    try:
+      retval = function(*args, **kwargs)
+      failed = False
+      return retval
+    finally:
+      _record_call(profile, timer() - starttime, failed)
+
+  return profiled_function
+
+
+
+def _format_bucket(bucket):
+  """
+  Returns a short description of the latencies in a histogram bucket.
+  """
+  if bucket == 0:
+    return "<1us"
+  if bucket == HISTOGRAM_BUCKETS - 1:
+    return ">=" + str(2 ** (bucket - 1)) + "us"
+  return str(2 ** (bucket - 1)) + "-" + str(2 ** bucket) + "us"
+
+
+
+def get_report():
+  """
+  <Purpose>
+    Formats the numbers recorded so far.
+
+  <Arguments>
+    None.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    None.
+
+  <Returns>
+    A string with one line per profiled function that was called, sorted
+    by the total time spent in it, followed by an indented line with the
+    non-empty buckets of its latency histogram.
+  """
+  # We don't hold the lock while reading, as we may be running in a signal
+  # handler that interrupted a thread holding it. The numbers of a function
+  # which is being called right now may be off by one call.
+  rows = []
+  for name in _profiles.keys():
+    profile = _profiles[name]
+    if profile.calls:
+      rows.append((profile.totaltime, name, profile))
+  rows.sort(reverse=True)
+
+  lines = ["# API profile of process " + str(os.getpid()) + " at " + str(time.time()),
+           "# %-28s %10s %8s %12s %12s %12s" % ("function", "calls", "errors",
+               "total(s)", "avg(us)", "max(us)")]
+  for totaltime, name, profile in rows:
+    lines.append("%-30s %10d %8d %12.6f %12.1f %12.1f" % (name, profile.calls,
+        profile.errors, totaltime, totaltime * 1000000.0 / profile.calls,
+        profile.maxtime * 1000000.0))
+
+    buckets = []
+    for bucket in range(HISTOGRAM_BUCKETS):
+      if profile.histogram[bucket]:
+        buckets.append(_format_bucket(bucket) + ":" + str(profile.histogram[bucket]))
+    lines.append("    " + " ".join(buckets))
+
+  return "\n".join(lines) + "\n"
+
+
+
+def write_report(filename=None):
+  """
+  <Purpose>
+    Writes the report from get_report() to a file.
+
+  <Arguments>
+    filename:
+      The file to write to. Defaults to report_filename.
+
+  <Exceptions>
+    Exceptions from writing the file are raised.
+
+  <Side Effects>
+    Replaces the contents of the file. Nothing is written if no functions
+    have been profiled (as in repy's resource monitor process).
+
+  <Returns>
+    None.
+  """
+  if filename is None:
+    filename = report_filename
+
+  if filename is None or not _profiles:
+    return
+
+  reportfo = myfile(filename, "w")
+  try:
+    reportfo.write(get_report())
+  finally:
+    reportfo.close()
+
+
+
+def _report_signal_handler(signum, frame):
+  try:
+    write_report()
+  except Exception:
+    # We were interrupted in the middle of something else. Don't let a
+    # problem with the report file disturb it.
+    pass
+
+
+
+def install_report_signal_handler():
+  """
+  <Purpose>
+    Arranges for the report to be written whenever the process receives
+    SIGUSR1. Must be called from the main thread.
+
+  <Arguments>
+    None.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    Replaces any existing SIGUSR1 handler.
+
+  <Returns>
+    None.
+  """
+  if _sigusr1 is not None:
+    signal.signal(_sigusr1, _report_signal_handler)
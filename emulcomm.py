@@ -48,6 +48,9 @@ import time
 # Armon: Used for decoding the error messages
 import errno
 
+# For os.strerror
+import os
+
 # Armon: Used for getting the constant IP values for resolving our external IP
 import repy_constants 
 
@@ -67,6 +70,53 @@ from exception_hierarchy import *
 # Val - Bound socket object
 _BOUND_SOCKETS = {} # Ticket = 1015 (Resolved)
 
+# When nothing is listening on a local IP and port, sendmessage() keeps
+# a bound socket around here instead of creating a new one for every
+# message. Each pooled socket holds an outsocket. A later listenformessage()
+# on the same IP and port takes the socket over.
+#
+# Format of entries is as follows:
+# Key - 2-tuple of (IP, Port)
+# Val - 3-element list of [Bound socket object, runtime of last use,
+#       number of threads currently sending with it]
+_UDP_SEND_POOL = {}
+
+# Protects _UDP_SEND_POOL. This is re-entrant because adding an outsocket
+# may evict pooled sockets while the pool is being updated.
+_UDP_SEND_POOL_LOCK = threading.RLock()
+
+# Pooled sockets that have not been used for this many seconds are closed
+UDP_SEND_POOL_IDLE_TIMEOUT = 10.0
+
+# The timer which closes idle pooled sockets, or None if none is pending.
+# Protected by _UDP_SEND_POOL_LOCK.
+_udp_send_pool_sweeper = None
+
+# If this is set (with repy's --loopbackfastpath flag), TCP connections
+# between two ends in this process do not go through the OS. The data is
+# passed through a pair of in-process buffers instead. The resource
+# accounting is the same either way.
+loopback_fast_path = False
+
+# The TCPServerSockets which accept in-process connections.
+#
+# Format of entries is as follows:
+# Key - 2-tuple of (IP, Port)
+# Val - _InProcessListener
+_IN_PROCESS_LISTENERS = {}
+
+# The ("TCP", localip, localport, destip, destport) tuples of the open
+# in-process connections, so that duplicates can be detected.
+_IN_PROCESS_CONNECTIONS = set()
+
+# Protects _IN_PROCESS_LISTENERS, _IN_PROCESS_CONNECTIONS and the queues
+# of connections waiting to be accepted
+_IN_PROCESS_LOCK = threading.Lock()
+
+# The initial size (in bytes) of the buffer for each direction of an
+# in-process connection
+IN_PROCESS_BUFFER_SIZE = 65536
+
 # If we have a preference for an IP/Interface this flag is set to True
 user_ip_interface_preferences = False
 
@@ -84,6 +134,117 @@ user_specified_ip_interface_list = []
 allowediplist = []
 cachelock = threading.Lock()  # This allows only a single simultaneous cache update
 
+# The same IPs as a set, so that _ip_is_allowed is a single lookup
+_allowed_ip_set = set()
+
+# This is incremented every time the allowed IPs change
+ip_cache_generation = 0
+
+# The runtime at which the allowed IP cache must be refreshed.
+# None means the cache must be refreshed on the next use.
+_ip_cache_expiry = None
+
+# How long (in seconds) the allowed IP cache is trusted. When the OS tells
+# us about address changes, the cache is refreshed as soon as something
+# changes, and the longer TTL is just a safety net for lost notifications.
+IP_CACHE_TTL = 5.0
+IP_CACHE_NOTIFIED_TTL = 60.0
+
+# The IP getmyip() found when there are no IP preferences, and the runtime
+# at which it must be found again. None means it must be found on the next
+# use. These share the TTLs and change notifications of the allowed IP
+# cache, and are protected by cachelock as well.
+_myip_cache = None
+_myip_cache_expiry = None
+
+# The _MyIPProbe which is looking for the IP, or None. Callers that find
+# the cache stale while it runs wait for it rather than starting another.
+# Protected by cachelock.
+_myip_probe = None
+
+# Incremented whenever an address change notification expires the caches,
+# so that a probe can tell if the address changed while it was running
+_address_change_count = 0
+
+# How long (in seconds) getmyip() waits for the probes of
+# repy_constants.STABLE_PUBLIC_IPS to find the IP
+MYIP_PROBE_TIMEOUT = 1.0
+
+# A socket which becomes readable when interfaces or addresses change.
+# This is opened on the first cache refresh, if the OS supports it.
+_address_change_socket = None
+_address_change_socket_opened = False
+_get_address_change_socket = getattr(nonportable.os_api, "get_address_change_socket", None)
+
+# Resolved hostnames, so that repeated lookups do not go to the network.
+#
+# Format of entries is as follows:
+# Key - The hostname
+# Val - 2-tuple of (IP address or None if the name could not be resolved,
+#       runtime at which the entry expires)
+_RESOLVER_CACHE = {}
+
+# The lookups which are running, so that concurrent lookups of the same
+# name share one.
+#
+# Format of entries is as follows:
+# Key - The hostname
+# Val - _HostnameLookup
+_RESOLVER_LOOKUPS = {}
+
+# Protects _RESOLVER_CACHE and _RESOLVER_LOOKUPS
+_RESOLVER_LOCK = threading.Lock()
+
+# How long (in seconds) names which could / could not be resolved are cached
+RESOLVER_CACHE_TTL = 300.0
+RESOLVER_NEGATIVE_CACHE_TTL = 30.0
+
+# The most names that are cached
+RESOLVER_CACHE_SIZE = 256
+
+# The most lookups that may run at the same time. Each one runs in a thread
+# of its own, which keeps running after the caller gave up waiting, so
+# this bounds the threads that slow or unresolvable names can pile up.
+RESOLVER_MAX_LOOKUPS = 4
+
+# How long (in seconds) gethostbyname() waits for the OS resolver. This can
+# be changed with repy's --resolvertimeout flag.
+resolver_timeout = 10.0
+
+# The netsend / netrecv charged when gethostbyname() is answered from the
+# cache, instead of the 1K / 4K charged for a lookup
+RESOLVER_CACHE_HIT_NETSEND = 64
+RESOLVER_CACHE_HIT_NETRECV = 64
+
+# This does the actual lookups. Tests replace it with a stub resolver.
+_system_gethostbyname = socket.gethostbyname
+
+# The largest datagram we will receive (64K is the max that fits in the UDP
+# header)
+MAX_MESSAGE_SIZE = 65535
+
+# How many datagrams UDPServerSocket.getmessages() receives per system call
+MESSAGE_BATCH_SIZE = 16
+
+# Some platforms (Linux) can receive a batch of datagrams with a single
+# recvmmsg() call. Elsewhere, getmessages() loops over recvfrom_into().
+_recvmmsg_available = getattr(nonportable.os_api, "recvmmsg_available", False)
+
+# Likewise, some platforms can send a batch of datagrams with a single
+# sendmmsg() call. Elsewhere, sendmessages() loops over sendto().
+_sendmmsg_available = getattr(nonportable.os_api, "sendmmsg_available", False)
+
+# Some platforms (Linux) can send from a file to a socket without copying
+# the data through python. Elsewhere, sendfile() reads and sends the data.
+_sendfile_available = getattr(nonportable.os_api, "sendfile_available", False)
+
+# Some platforms (Linux) can tell us the round trip time, retransmits, etc.
+# of a TCP connection
+_get_tcp_info = getattr(nonportable.os_api, "get_tcp_info", None)
+
+# bytearray is not available once the builtins are replaced, so keep a copy
+_saved_bytearray = bytearray
+
 
 ##### Internal Functions
 
@@ -108,8 +269,8 @@ def _ip_is_allowed(ip):
   if not user_ip_interface_preferences or allow_nonspecified_ips:
     return True
   
-  # Check the list of allowed IP's
-  return (ip in allowediplist)
+  # Check the set of allowed IP's
+  return (ip in _allowed_ip_set)
 
 
 # Only appends the elem to lst if the elem is unique
@@ -117,23 +278,125 @@ def _unique_append(lst, elem):
   if elem not in lst:
     lst.append(elem)
       
+# Determines if address change notifications are waiting, without reading
+# them, so this is safe to call without the cachelock
+def _address_changes_pending():
+  if _address_change_socket is None:
+    return False
+  try:
+    (readable, writable, exceptional) = select.select([_address_change_socket], [], [], 0)
+  except (select.error, socket.error):
+    # Let the caller take the cachelock and read the notifications
+    return True
+  return len(readable) > 0
+
+
+# Reads and discards pending address change notifications. Returns True
+# if there were any. The cachelock must be held.
+def _drain_address_changes():
+  changed = False
+  while True:
+    try:
+      _address_change_socket.recv(65536)
+    except socket.error, e:
+      if _is_recoverable_network_exception(e):
+        return changed
+      # Something else, e.g. ENOBUFS because notifications were dropped.
+      # Assume that anything could have changed.
+      return True
+    changed = True
+
+
+# Opens the address change socket the first time it is needed. The
+# cachelock must be held.
+def _watch_address_changes():
+  global _address_change_socket
+  global _address_change_socket_opened
+
+  if not _address_change_socket_opened:
+    _address_change_socket_opened = True
+    if _get_address_change_socket is not None:
+      _address_change_socket = _get_address_change_socket()
+
+
+# Returns the runtime at which a cache which was just refreshed expires
+def _ip_cache_next_expiry():
+  if _address_change_socket is not None:
+    return nonportable.getruntime() + IP_CACHE_NOTIFIED_TTL
+  else:
+    return nonportable.getruntime() + IP_CACHE_TTL
+
+
+# Expires both the allowed IP cache and the getmyip() cache if the OS
+# reported an address change. The cachelock must be held.
+def _check_address_changes():
+  global _ip_cache_expiry
+  global _myip_cache_expiry
+  global _address_change_count
+
+  if _address_change_socket is not None and _drain_address_changes():
+    _ip_cache_expiry = None
+    _myip_cache_expiry = None
+    _address_change_count += 1
+
+
+# Determines if the allowed IP cache needs to be refreshed. This only
+# reads the cache state, so it can be used without the cachelock; pending
+# change notifications count as stale, and are read by
+# _check_address_changes() once the lock is held.
+def _ip_cache_is_stale():
+  return (_ip_cache_expiry is None or
+      nonportable.getruntime() >= _ip_cache_expiry or
+      _address_changes_pending())
+
+
+# Determines if the getmyip() cache needs to be refreshed. Like
+# _ip_cache_is_stale(), this does not need the cachelock.
+def _myip_cache_is_stale():
+  return (_myip_cache_expiry is None or
+      nonportable.getruntime() >= _myip_cache_expiry or
+      _address_changes_pending())
+
+
 # This function updates the allowed IP cache
 # It iterates through all possible IP's and stores ones which are bindable as part of the allowediplist
-def update_ip_cache():
+# The cache is only rebuilt when it has expired or the OS reported an
+# address change, unless force is True.
+def update_ip_cache(force=False):
   global allowediplist
   global user_ip_interface_preferences
   global user_specified_ip_interface_list
   global allow_nonspecified_ips
+  global _allowed_ip_set
+  global ip_cache_generation
+  global _ip_cache_expiry
   
   # If there is no preference, this is a no-op
   if not user_ip_interface_preferences:
     return
+
+  # The usual case, the cache is still good
+  if not force and not _ip_cache_is_stale():
+    return
     
   # Acquire the lock to update the cache
   cachelock.acquire()
   
   # If there is any exception release the cachelock
   try:  
+    # Another thread may have refreshed the cache while we waited
+    _check_address_changes()
+    if not force and not _ip_cache_is_stale():
+      return
+
+    # Start listening for changes before looking at the interfaces, so
+    # that we don't miss a change made while we are looking
+    _watch_address_changes()
+
+    # Set the expiry first. If a change notification comes in while we
+    # are refreshing, it resets this and the next call refreshes again.
+    _ip_cache_expiry = _ip_cache_next_expiry()
+
     # Stores the IP's
     allowed_list = []
   
@@ -173,7 +436,15 @@ def update_ip_cache():
     _unique_append(bindable_list, "127.0.0.1")
   
     # Update the global cache
-    allowediplist = bindable_list
+    if bindable_list != allowediplist:
+      allowediplist = bindable_list
+      _allowed_ip_set = set(bindable_list)
+      ip_cache_generation += 1
+
+  except:
+    # Try again next time
+    _ip_cache_expiry = None
+    raise
   
   finally:      
     # Release the lock
@@ -609,11 +880,124 @@ def _is_allowed_localport(type, localport):
 
 
 
+# Stores the result of a lookup. The resolver lock must be held.
+def _cache_hostname(name, address):
+  now = nonportable.getruntime()
+
+  # Make room if needed. Drop the expired entries first, and if that is
+  # not enough, the entry which would expire next.
+  if name not in _RESOLVER_CACHE and len(_RESOLVER_CACHE) >= RESOLVER_CACHE_SIZE:
+    for cachedname in _RESOLVER_CACHE.keys():
+      if _RESOLVER_CACHE[cachedname][1] <= now:
+        del _RESOLVER_CACHE[cachedname]
+
+    if len(_RESOLVER_CACHE) >= RESOLVER_CACHE_SIZE:
+      cachedname = min(_RESOLVER_CACHE, key=lambda key: _RESOLVER_CACHE[key][1])
+      del _RESOLVER_CACHE[cachedname]
+
+  if address is None:
+    _RESOLVER_CACHE[name] = (None, now + RESOLVER_NEGATIVE_CACHE_TTL)
+  else:
+    _RESOLVER_CACHE[name] = (address, now + RESOLVER_CACHE_TTL)
+
+
+class _HostnameLookup(object):
+  # A hostname lookup. This runs in its own thread, so that callers can
+  # give up waiting for a slow resolver.
+  #
+  # Fields:
+  # name: The hostname
+  # done: An Event which is set once the lookup has finished
+  # address: The IP address, or None if the name could not be resolved
+  __slots__ = ["name", "done", "address"]
+
+  def __init__(self, name):
+    self.name = name
+    self.done = threading.Event()
+    self.address = None
+
+
+  def run(self):
+    try:
+      address = _system_gethostbyname(self.name)
+    except Exception:
+      # socket.gaierror, or e.g. a UnicodeError for a malformed name
+      address = None
+
+    _RESOLVER_LOCK.acquire()
+    try:
+      # Even if the caller gave up, later lookups can use this
+      _cache_hostname(self.name, address)
+      del _RESOLVER_LOOKUPS[self.name]
+    finally:
+      _RESOLVER_LOCK.release()
+
+    self.address = address
+    self.done.set()
+
+
+
+def _resolve_hostname(name):
+  """
+  <Purpose>
+    Translates a hostname to an IPv4 address, using the resolver cache
+    where possible.
+
+  <Arguments>
+    name: The hostname
+
+  <Exceptions>
+    ResourceExhaustedError if the name has to be looked up, but
+    RESOLVER_MAX_LOOKUPS other lookups are still running.
+
+  <Side Effects>
+    If the name is not cached, a thread is started to look it up. The
+    thread keeps running if the lookup times out, and its result is
+    cached.
+
+  <Returns>
+    A tuple (IP address, from cache). The IP address is None if the name
+    could not be resolved within resolver_timeout seconds. from cache is
+    True if no lookup was needed.
+  """
+  # IP addresses translate to themselves
+  if _is_valid_ip_address(name):
+    return (name, True)
+
+  _RESOLVER_LOCK.acquire()
+  try:
+    entry = _RESOLVER_CACHE.get(name)
+    if entry is not None and nonportable.getruntime() < entry[1]:
+      return (entry[0], True)
+
+    # Wait for a lookup that is already running, or start one
+    lookup = _RESOLVER_LOOKUPS.get(name)
+    if lookup is None:
+      # Every running lookup has an entry until its thread finishes
+      if len(_RESOLVER_LOOKUPS) >= RESOLVER_MAX_LOOKUPS:
+        raise ResourceExhaustedError("Too many hostname lookups are in progress!")
+
+      lookup = _HostnameLookup(name)
+      _RESOLVER_LOOKUPS[name] = lookup
+
+      lookupthread = threading.Thread(target=lookup.run)
+      lookupthread.setDaemon(True)
+      lookupthread.start()
+
+  finally:
+    _RESOLVER_LOCK.release()
+
+  lookup.done.wait(resolver_timeout)
+  return (lookup.address, False)
+
+
+
 # Public interface
 def gethostbyname(name):
   """
    <Purpose>
-      Provides information about a hostname. Calls socket.gethostbyname().
+      Provides information about a hostname. Calls socket.gethostbyname(),
+      and caches the results.
       Translate a host name to IPv4 address format. The IPv4 address is
       returned as a string, such as '100.50.200.5'. If the host name is an
       IPv4 address itself it is returned unchanged.
@@ -625,7 +1009,9 @@ def gethostbyname(name):
    <Exceptions>
      RepyArgumentError (descends from NetworkError) if the name is not a string
      NetworkAddressError (descends from NetworkError) if the address cannot
-     be resolved.
+     be resolved, or the lookup takes too long.
+     ResourceExhaustedError if too many lookups which took too long are
+     still running. This can be retried later.
 
    <Side Effects>
      None.
@@ -633,6 +1019,8 @@ def gethostbyname(name):
    <Resource Consumption>
      This operation consumes network bandwidth of 4K netrecv, 1K netsend.
      (It's hard to tell how much was actually sent / received at this level.)
+     If the answer is cached (for up to 5 minutes, or 30 seconds if the name
+     could not be resolved), it consumes 64 bytes of each.
 
    <Returns>
      The IPv4 address as a string.
@@ -641,16 +1029,26 @@ def gethostbyname(name):
   if type(name) is not str:
     raise RepyArgumentError("gethostbyname() takes a string as argument.")
 
-  # charge 4K for a look up...   I don't know the right number, but we should
-  # charge something.   We'll always charge to the netsend interface...
-  nanny.tattle_quantity('netsend', 1024) 
-  nanny.tattle_quantity('netrecv', 4096)
+  # Wait for resources
+  nanny.tattle_quantity('netsend', 0)
+  nanny.tattle_quantity('netrecv', 0)
 
-  try:
-    return socket.gethostbyname(name)
-  except socket.gaierror:
+  address, from_cache = _resolve_hostname(name)
+
+  if from_cache:
+    nanny.tattle_quantity('netsend', RESOLVER_CACHE_HIT_NETSEND)
+    nanny.tattle_quantity('netrecv', RESOLVER_CACHE_HIT_NETRECV)
+  else:
+    # charge 4K for a look up...   I don't know the right number, but we should
+    # charge something.   We'll always charge to the netsend interface...
+    nanny.tattle_quantity('netsend', 1024) 
+    nanny.tattle_quantity('netrecv', 4096)
+
+  if address is None:
     raise NetworkAddressError("The hostname '"+name+"' could not be resolved.")
 
+  return address
+
 
 
 # Public interface
@@ -658,7 +1056,8 @@ def getmyip():
   """
    <Purpose>
       Provides the IP of this computer on its public facing interface.  
-      Does some clever trickery. 
+      Does some clever trickery. The IP is cached until the OS reports an
+      address change, or for a few seconds if it can't.
 
    <Arguments>
       None
@@ -688,35 +1087,181 @@ def getmyip():
     # Return the first allowed ip, there is always at least 1 element (loopback)
     return allowediplist[0]
 
-  # Initialize these to None, so we can detect a failure
-  myip = None
-  
-  # It's possible on some platforms (Windows Mobile) that the IP will be
-  # 0.0.0.0 even when I have a public IP and the external IP is up. However, if
-  # I get a real connection with SOCK_STREAM, then I should get the real
-  # answer.
-        
-  # Try each stable IP  
-  for ip_addr in repy_constants.STABLE_PUBLIC_IPS:  
+  return _get_public_ip()
+
+
+
+class _MyIPProbe(object):
+  # Tries all of the stable public IPs at once. The IP found through the
+  # first of them that works is used, as if they were tried one after
+  # another in the order of repy_constants.STABLE_PUBLIC_IPS.
+  #
+  # Fields:
+  # lock: Protects results and myip
+  # done: An Event which is set once the answer is known, i.e. a probe
+  #       found an IP and all the probes before it failed, or all failed
+  # results: For each stable IP in order, the local IP its probe found,
+  #          False if it failed, or None if it is still running
+  # decided: True once myip is final
+  # myip: The IP which was found, or None
+  # deadline: The runtime at which we stop waiting for the probes
+  # expiry: The runtime at which the IP found expires
+  # changecount: _address_change_count when the probe was started
+  __slots__ = ["lock", "done", "results", "decided", "myip", "deadline",
+               "expiry", "changecount"]
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.done = threading.Event()
+    self.results = [None] * len(repy_constants.STABLE_PUBLIC_IPS)
+    self.decided = False
+    self.myip = None
+    self.deadline = nonportable.getruntime() + MYIP_PROBE_TIMEOUT
+    # As in update_ip_cache(), the expiry is taken before looking, so that
+    # a change while we look is not lost
+    self.expiry = _ip_cache_next_expiry()
+    self.changecount = _address_change_count
+
+
+  def start(self):
+    for index in range(len(self.results)):
+      probethread = threading.Thread(target=self.run,
+          args=(index, repy_constants.STABLE_PUBLIC_IPS[index]))
+      probethread.setDaemon(True)
+      probethread.start()
+
+
+  def run(self, index, ip_addr):
     try:
       # Try to resolve using the current connection type and 
       # stable IP, using port 80 since some platforms panic
       # when given 0 (FreeBSD)
       myip = _get_localIP_to_remoteIP(socket.SOCK_DGRAM, ip_addr, 80)
     except (socket.error, socket.timeout):
-      # We can ignore any networking related errors, since we want to try 
-      # the other connection types and IP addresses. If we fail,
-      # we will eventually raise an exception anyways.
-      pass
-    else:
-      # Return immediately if the IP address is good
-      if _is_valid_ip_address(myip): 
-        return myip
+      # We can ignore any networking related errors, since the other
+      # probes may work. If they all fail, getmyip() raises an exception.
+      myip = None
+
+    if myip is None or not _is_valid_ip_address(myip):
+      myip = False
+
+    self.lock.acquire()
+    try:
+      self.results[index] = myip
+
+      # See if the probes before this one have all failed, or if all
+      # probes have finished
+      for result in self.results:
+        if result is None:
+          return
+        if result is not False:
+          break
+      self.done.set()
+    finally:
+      self.lock.release()
+
+
+  def get_ip(self):
+    # Waits for the answer until the deadline, and returns it. Probes
+    # which are still running by then count as failed.
+    self.done.wait(max(0, self.deadline - nonportable.getruntime()))
 
+    self.lock.acquire()
+    try:
+      # Every caller must get the same answer, even if a probe finishes
+      # between their calls
+      if not self.decided:
+        self.decided = True
+        for result in self.results:
+          if result:
+            self.myip = result
+            break
+
+      return self.myip
+    finally:
+      self.lock.release()
+
+
+
+def _get_public_ip():
+  """
+  <Purpose>
+    Finds the IP of this computer on its public facing interface, for
+    getmyip() when there are no IP preferences. The result is cached until
+    the OS reports an address change, or the allowed IP cache TTL passes.
+
+  <Arguments>
+    None
+
+  <Exceptions>
+    InternetConnectivityError if none of the stable public IPs can be
+    reached.
+
+  <Returns>
+    The IP address as a string.
+  """
+  global _myip_cache
+  global _myip_cache_expiry
+  global _myip_probe
+
+  # The usual case, the cache is still good
+  if not _myip_cache_is_stale():
+    return _myip_cache
+
+  cachelock.acquire()
+  try:
+    # Another thread may have refreshed the cache while we waited
+    _check_address_changes()
+    if not _myip_cache_is_stale():
+      return _myip_cache
+
+    # Wait for the probe which is already running, or start one. It runs
+    # without the cachelock, so that the allowed IP cache can be used and
+    # refreshed meanwhile.
+    probe = _myip_probe
+    if probe is None:
+      # As in update_ip_cache(), watch for changes before looking
+      _watch_address_changes()
+
+      # It's possible on some platforms (Windows Mobile) that the IP will be
+      # 0.0.0.0 even when I have a public IP and the external IP is up. However, if
+      # I get a real connection with SOCK_STREAM, then I should get the real
+      # answer.
+
+      # Try every stable IP at once, rather than waiting for each in turn
+      probe = _MyIPProbe()
+      _myip_probe = probe
+      probe.start()
+
+  finally:
+    cachelock.release()
+
+  myip = probe.get_ip()
+
+  # Whoever gets here first stores the answer
+  cachelock.acquire()
+  try:
+    if _myip_probe is probe:
+      _myip_probe = None
+
+      if myip is not None:
+        _myip_cache = myip
+
+      if myip is None or _address_change_count != probe.changecount:
+        # Try again next time, we may be back online by then, or the
+        # address changed while we were looking
+        _myip_cache_expiry = None
+      else:
+        _myip_cache_expiry = probe.expiry
+
+  finally:
+    cachelock.release()
 
-  # Since we haven't returned yet, we must have failed.
-  # Raise an exception, we must not be connected to the internet
-  raise InternetConnectivityError("Cannot detect a connection to the Internet.")
+  if myip is None:
+    # We must not be connected to the internet
+    raise InternetConnectivityError("Cannot detect a connection to the Internet.")
+
+  return myip
 
 
 
@@ -771,6 +1316,107 @@ def _get_localIP_to_remoteIP(connection_type, external_ip, external_port=80):
 # Armon: How frequently should we check for the availability of the socket?
 RETRY_INTERVAL = 0.2 # In seconds
 
+# The first wait before retrying a connection. This doubles after every
+# recoverable error, up to RETRY_INTERVAL.
+CONNECT_RETRY_MIN_INTERVAL = 0.005 # In seconds
+
+
+# The socket options that can be set with setsocketoption(), mapped to
+# their (level, option name). "backlog" is handled separately since it is
+# not a real socket option.
+_SOCKET_OPTIONS = {
+  "sendbuffer" : (socket.SOL_SOCKET, socket.SO_SNDBUF),
+  "recvbuffer" : (socket.SOL_SOCKET, socket.SO_RCVBUF),
+  "nodelay" : (socket.IPPROTO_TCP, socket.TCP_NODELAY),
+  "keepalive" : (socket.SOL_SOCKET, socket.SO_KEEPALIVE),
+}
+
+# A TCPServerSocket also has a backlog
+_SERVER_SOCKET_OPTIONS = _SOCKET_OPTIONS.keys() + ["backlog"]
+
+# These options are turned on or off, the others take a size
+_BOOLEAN_SOCKET_OPTIONS = ["nodelay", "keepalive"]
+
+
+# Returns the largest listen backlog a TCPServerSocket may have
+def _get_listen_backlog_limit():
+  # Use the limit from the resource file, if there is one
+  max_backlog = nanny.get_resource_limit("listenbacklog")
+  if max_backlog:
+    return int(max_backlog)
+
+  # Otherwise, we can't usefully have more pending connections than
+  # we can accept
+  max_outsockets = nanny.get_resource_limit("outsockets")
+  if max_outsockets:
+    return int(max_outsockets)
+
+  return 5
+
+
+def _check_socket_option(name, value, allowed_options):
+  """
+  <Purpose>
+    Checks the arguments to setsocketoption() and clamps the value to the
+    limits in the resource file.
+
+  <Arguments>
+    name: The name of the option
+    value: The requested value
+    allowed_options: The option names this kind of socket supports
+
+  <Exceptions>
+    RepyArgumentError if the option is unknown or the value is invalid.
+    ResourceForbiddenError if the resource file does not allow changing
+    the buffer sizes.
+
+  <Returns>
+    The value to use.
+  """
+  # Check the input arguments (type)
+  if type(name) is not str:
+    raise RepyArgumentError("Provided option name must be a string!")
+  if name not in allowed_options:
+    raise RepyArgumentError("Unknown socket option '"+name+"'!")
+
+  if name in _BOOLEAN_SOCKET_OPTIONS:
+    if type(value) is not bool:
+      raise RepyArgumentError("Provided value for '"+name+"' must be a bool!")
+    return value
+
+  if type(value) not in [int, long]:
+    raise RepyArgumentError("Provided value for '"+name+"' must be an int!")
+
+  # Check the input arguments (sanity)
+  if value < 1:
+    raise RepyArgumentError("Provided value for '"+name+"' must be positive! Value: "+str(value))
+
+  # Check the input arguments (permission)
+  if name == "backlog":
+    return min(value, _get_listen_backlog_limit())
+
+  max_buffer = nanny.get_resource_limit("socketbuffer")
+  if not max_buffer:
+    raise ResourceForbiddenError("Socket buffer sizes may not be changed!")
+
+  return min(value, int(max_buffer))
+
+
+def _set_socket_option(sock, name, value):
+  # Applies an option which was checked by _check_socket_option
+  level, option = _SOCKET_OPTIONS[name]
+  sock.setsockopt(level, option, int(value))
+
+
+def _get_socket_option(sock, name):
+  # Reads an option as the OS reports it. Note that some OSes (Linux)
+  # report twice the buffer size that was set, to allow for overhead.
+  level, option = _SOCKET_OPTIONS[name]
+  value = sock.getsockopt(level, option)
+  if name in _BOOLEAN_SOCKET_OPTIONS:
+    return value != 0
+  return value
+
 
 def _cleanup_socket(self):
   """
@@ -823,76 +1469,322 @@ def _cleanup_socket(self):
 
 ####################### Message sending #############################
 
+# Closes a pooled sending socket. The pool lock must be held, and the
+# socket must not be in use.
+def _evict_udp_send_socket(key):
+  sock = _UDP_SEND_POOL[key][0]
+  del _UDP_SEND_POOL[key]
 
+  try:
+    sock.close()
+  except:
+    pass
 
-# Public interface!!!
-def sendmessage(destip, destport, message, localip, localport):
-  """
-   <Purpose>
-      Send a message to a host / port
+  nanny.tattle_remove_item('outsockets', id(sock))
 
-   <Arguments>
-      destip:
-         The host to send a message to
-      destport:
-         The port to send the message to
-      message:
-         The message to send
-      localhost:
-         The local IP to send the message from 
-      localport:
-         The local port to send the message from
 
-   <Exceptions>
-      AddressBindingError (descends NetworkError) when the local IP isn't
-        a local IP.
 
-      ResourceForbiddenError (descends ResourceException?) when the local
-        port isn't allowed
+# Closes the pooled sending sockets that have been idle for too long. The
+# pool lock must be held.
+def _evict_idle_udp_send_sockets():
+  now = nonportable.getruntime()
+  for poolkey in _UDP_SEND_POOL.keys():
+    sock, lastused, users = _UDP_SEND_POOL[poolkey]
+    if users == 0 and now - lastused > UDP_SEND_POOL_IDLE_TIMEOUT:
+      _evict_udp_send_socket(poolkey)
 
-      RepyArgumentError when the local IP and port aren't valid types
-        or values
 
-      AlreadyListeningError if there is an existing listening UDP socket
-      on the same local IP and port.
 
-      DuplicateTupleError if there is another sendmessage on the same
-      local IP and port to the same remote host.
+# Runs from a timer, so that idle pooled sockets are closed even when the
+# program stops sending
+def _sweep_udp_send_pool():
+  global _udp_send_pool_sweeper
 
-   <Side Effects>
-      None.
+  _UDP_SEND_POOL_LOCK.acquire()
+  try:
+    _udp_send_pool_sweeper = None
+    _evict_idle_udp_send_sockets()
+    _schedule_udp_send_pool_sweep()
+  finally:
+    _UDP_SEND_POOL_LOCK.release()
 
-   <Resource Consumption>
-      This operation consumes 64 bytes + number of bytes of the message that
-      were transmitted. This requires that the localport is allowed.
 
-   <Returns>
-      The number of bytes sent on success
-  """
-  # Check the input arguments (type)
-  if type(destip) is not str:
-    raise RepyArgumentError("Provided destip must be a string!")
-  if type(localip) is not str:
-    raise RepyArgumentError("Provided localip must be a string!")
 
-  if type(destport) is not int:
-    raise RepyArgumentError("Provided destport must be an int!")
-  if type(localport) is not int:
-    raise RepyArgumentError("Provided localport must be an int!")
+# Starts the timer which closes idle pooled sockets, unless it is already
+# pending or there is nothing pooled. The pool lock must be held.
+def _schedule_udp_send_pool_sweep():
+  global _udp_send_pool_sweeper
 
-  if type(message) is not str:
-    raise RepyArgumentError("Provided message must be a string!")
+  if _udp_send_pool_sweeper is not None or len(_UDP_SEND_POOL) == 0:
+    return
 
+  # Wake up when the socket that was idle the longest expires. Sockets in
+  # use are looked at again a full timeout later.
+  now = nonportable.getruntime()
+  delay = UDP_SEND_POOL_IDLE_TIMEOUT
+  for sock, lastused, users in _UDP_SEND_POOL.values():
+    if users == 0:
+      delay = min(delay, lastused + UDP_SEND_POOL_IDLE_TIMEOUT - now)
 
-  # Check the input arguments (sanity)
-  if not _is_valid_ip_address(destip):
-    raise RepyArgumentError("Provided destip is not valid! IP: '"+destip+"'")
-  if not _is_valid_ip_address(localip):
-    raise RepyArgumentError("Provided localip is not valid! IP: '"+localip+"'")
+  # Don't spin if the clock is slightly off
+  delay = max(delay, 0.1)
 
-  if not _is_valid_network_port(destport):
-    raise RepyArgumentError("Provided destport is not valid! Port: "+str(destport))
-  if not _is_valid_network_port(localport):
+  _udp_send_pool_sweeper = threading.Timer(delay, _sweep_udp_send_pool)
+  _udp_send_pool_sweeper.setDaemon(True)
+  _udp_send_pool_sweeper.start()
+
+
+
+# Registers a socket as an outsocket
+def _tattle_add_outsocket(sockid):
+  """
+  <Purpose>
+    Registers a socket as an outsocket. If the outsockets are exhausted,
+    pooled UDP sending sockets which are not in use are closed (least
+    recently used first) to make room, since they are only a cache.
+
+  <Arguments>
+    sockid: The id of the socket object
+
+  <Exceptions>
+    ResourceExhaustedError if there are no outsockets left, even after
+    closing the pooled sockets which are not in use.
+
+  <Returns>
+    None
+  """
+  _UDP_SEND_POOL_LOCK.acquire()
+  try:
+    while True:
+      try:
+        nanny.tattle_add_item('outsockets', sockid)
+        return
+
+      except ResourceExhaustedError:
+        # Find the least recently used pooled socket that nobody is
+        # sending with right now. Closing one that is in use would make
+        # the send fail.
+        oldest = None
+        for poolkey in _UDP_SEND_POOL:
+          sock, lastused, users = _UDP_SEND_POOL[poolkey]
+          if users == 0 and (oldest is None or lastused < _UDP_SEND_POOL[oldest][1]):
+            oldest = poolkey
+
+        if oldest is None:
+          raise
+
+        # Give it up and try again
+        _evict_udp_send_socket(oldest)
+
+  finally:
+    _UDP_SEND_POOL_LOCK.release()
+
+
+
+# Gets a bound UDP socket for sending from the pool
+def _get_udp_send_socket(localip, localport):
+  """
+  <Purpose>
+    Returns the pooled sending socket for a local IP and port, binding a
+    new one if needed. Pooled sockets that have been idle for too long are
+    closed along the way.
+
+  <Arguments>
+    localip: The local IP to send from
+    localport: The local port to send from
+
+  <Exceptions>
+    As with _get_udp_socket(), and ResourceExhaustedError if there is no
+    outsocket for a new socket.
+
+  <Side Effects>
+    The socket is marked as in use, so that it is not closed while the
+    caller sends with it.
+
+  <Returns>
+    A bound socket.socket object. This is owned by the pool and must not
+    be closed by the caller. The caller must hand it back with
+    _release_udp_send_socket() once it is done sending.
+  """
+  key = (localip, localport)
+
+  _UDP_SEND_POOL_LOCK.acquire()
+  try:
+    # Close anything that has been idle for too long
+    _evict_idle_udp_send_sockets()
+
+    if key in _UDP_SEND_POOL:
+      entry = _UDP_SEND_POOL[key]
+      entry[2] += 1
+      return entry[0]
+
+    # Get the socket
+    sock = _get_udp_socket(localip, localport)
+
+    # Register this socket with nanny
+    try:
+      _tattle_add_outsocket(id(sock))
+    except:
+      # don't leak sockets
+      sock.close()
+      raise
+
+    _UDP_SEND_POOL[key] = [sock, nonportable.getruntime(), 1]
+    _schedule_udp_send_pool_sweep()
+    return sock
+
+  finally:
+    _UDP_SEND_POOL_LOCK.release()
+
+
+
+# Hands a socket from _get_udp_send_socket() back to the pool
+def _release_udp_send_socket(localip, localport, sock):
+  """
+  <Purpose>
+    Marks a pooled sending socket as no longer in use by the caller, so
+    that it can be closed once it has been idle for long enough.
+
+  <Arguments>
+    localip: The local IP the socket was requested for
+    localport: The local port the socket was requested for
+    sock: The socket returned by _get_udp_send_socket()
+
+  <Exceptions>
+    None
+
+  <Returns>
+    None
+  """
+  key = (localip, localport)
+
+  _UDP_SEND_POOL_LOCK.acquire()
+  try:
+    # The socket may have been taken over by listenformessage() meanwhile
+    if key in _UDP_SEND_POOL and _UDP_SEND_POOL[key][0] is sock:
+      entry = _UDP_SEND_POOL[key]
+      entry[1] = nonportable.getruntime()
+      entry[2] -= 1
+
+  finally:
+    _UDP_SEND_POOL_LOCK.release()
+
+
+
+# Takes a pooled sending socket over for use by a UDPServerSocket
+def _adopt_udp_send_socket(localip, localport):
+  """
+  <Purpose>
+    Removes the pooled sending socket for a local IP and port, if there
+    is one, so that listenformessage() can use it instead of binding a new
+    socket. The socket becomes an insocket rather than an outsocket.
+
+  <Arguments>
+    localip: The local IP
+    localport: The local port
+
+  <Exceptions>
+    ResourceExhaustedError if there is no insocket available. The pool is
+    left as it was.
+
+  <Returns>
+    The bound socket.socket object, or None if nothing is pooled.
+  """
+  key = (localip, localport)
+
+  _UDP_SEND_POOL_LOCK.acquire()
+  try:
+    if key not in _UDP_SEND_POOL:
+      return None
+
+    sock = _UDP_SEND_POOL[key][0]
+
+    # Register this socket as an insocket
+    nanny.tattle_add_item('insockets', id(sock))
+
+    del _UDP_SEND_POOL[key]
+    nanny.tattle_remove_item('outsockets', id(sock))
+
+    return sock
+
+  finally:
+    _UDP_SEND_POOL_LOCK.release()
+
+
+
+
+
+# Public interface!!!
+def sendmessage(destip, destport, message, localip, localport):
+  """
+   <Purpose>
+      Send a message to a host / port
+
+   <Arguments>
+      destip:
+         The host to send a message to
+      destport:
+         The port to send the message to
+      message:
+         The message to send
+      localhost:
+         The local IP to send the message from 
+      localport:
+         The local port to send the message from
+
+   <Exceptions>
+      AddressBindingError (descends NetworkError) when the local IP isn't
+        a local IP.
+
+      ResourceForbiddenError (descends ResourceException?) when the local
+        port isn't allowed
+
+      RepyArgumentError when the local IP and port aren't valid types
+        or values
+
+      AlreadyListeningError if there is an existing listening UDP socket
+      on the same local IP and port.
+
+      DuplicateTupleError if there is another sendmessage on the same
+      local IP and port to the same remote host.
+
+   <Side Effects>
+      If nothing is listening on the local IP and port, the socket used to
+      send is kept open for later messages until it has been idle for
+      UDP_SEND_POOL_IDLE_TIMEOUT seconds.
+
+   <Resource Consumption>
+      This operation consumes 64 bytes + number of bytes of the message that
+      were transmitted. This requires that the localport is allowed. A
+      pooled socket holds an outsocket until it is closed.
+
+   <Returns>
+      The number of bytes sent on success
+  """
+  # Check the input arguments (type)
+  if type(destip) is not str:
+    raise RepyArgumentError("Provided destip must be a string!")
+  if type(localip) is not str:
+    raise RepyArgumentError("Provided localip must be a string!")
+
+  if type(destport) is not int:
+    raise RepyArgumentError("Provided destport must be an int!")
+  if type(localport) is not int:
+    raise RepyArgumentError("Provided localport must be an int!")
+
+  if type(message) is not str:
+    raise RepyArgumentError("Provided message must be a string!")
+
+
+  # Check the input arguments (sanity)
+  if not _is_valid_ip_address(destip):
+    raise RepyArgumentError("Provided destip is not valid! IP: '"+destip+"'")
+  if not _is_valid_ip_address(localip):
+    raise RepyArgumentError("Provided localip is not valid! IP: '"+localip+"'")
+
+  if not _is_valid_network_port(destport):
+    raise RepyArgumentError("Provided destport is not valid! Port: "+str(destport))
+  if not _is_valid_network_port(localport):
     raise RepyArgumentError("Provided localport is not valid! Port: "+str(localport))
 
 
@@ -914,16 +1806,16 @@ def sendmessage(destip, destport, message, localip, localport):
   else:
     nanny.tattle_quantity('netsend', 0)
 
-  try:
-    sock = None
+  # Set once we have a socket from the pool, which must be handed back
+  pooled = False
 
+  try:
     if ("UDP", localip, localport) in _BOUND_SOCKETS:
       sock = _BOUND_SOCKETS[("UDP", localip, localport)]       
     else:
-      # Get the socket
-      sock = _get_udp_socket(localip, localport)      
-      # Register this socket with nanny
-      nanny.tattle_add_item("outsockets", id(sock))
+      # Get a bound socket from the pool
+      sock = _get_udp_send_socket(localip, localport)
+      pooled = True
     # Send the message
     bytessent = sock.sendto(message, (destip, destport))
 
@@ -936,13 +1828,198 @@ def sendmessage(destip, destport, message, localip, localport):
     return bytessent
 
   except Exception, e:
-        
+
+    # The socket is borrowed from a UDPServerSocket or the pool, so it is
+    # not closed here.
+
+    # Check if address is already in use
+    if _is_addr_in_use_exception(e):
+      raise DuplicateTupleError("Provided Local IP and Local Port is already in use!")
+ 
+    if _is_addr_unavailable_exception(e):
+      raise AddressBindingError("Cannot bind to the specified local ip, invalid!")
+
+    # Unknown error...
+    else:
+      raise
+
+  finally:
+    if pooled:
+      _release_udp_send_socket(localip, localport, sock)
+
+
+
+
+# Sends a list of datagrams from a bound UDP socket
+def _send_datagrams(sock, messages):
+  """
+  <Purpose>
+    Private helper for sendmessages(). Sends as many of the datagrams as
+    possible, using as few system calls as possible.
+
+  <Arguments>
+    sock: The bound UDP socket to send from
+    messages: A list of (destip, destport, message) tuples
+    
+  <Exceptions>
+    As with socket.sendto(), but only if the first datagram fails.
+
+  <Returns>
+    A list with the number of bytes sent for each datagram. If a datagram
+    fails after at least one was sent, the list stops there.
+  """
+  bytessent = []
+
+  while len(bytessent) < len(messages):
     try:
-      # If we're borrowing the socket, closing is not appropriate.
-      if not ("UDP", localip, localport) in _BOUND_SOCKETS:
-        sock.close()
-    except:
-      pass
+      if _sendmmsg_available:
+        sent = nonportable.os_api.send_messages(sock, messages[len(bytessent):])
+        bytessent.extend(sent)
+      else:
+        destip, destport, message = messages[len(bytessent)]
+        bytessent.append(sock.sendto(message, (destip, destport)))
+
+    except Exception:
+      # Report what was sent so far. The error will show up again if the
+      # caller retries the rest.
+      if len(bytessent) == 0:
+        raise
+      break
+
+  return bytessent
+
+
+
+
+# Public interface!!!
+def sendmessages(localip, localport, messages):
+  """
+   <Purpose>
+      Send several messages from a local IP and port. This checks the local
+      IP and port only once and sends the messages with as few system calls
+      as possible.
+
+   <Arguments>
+      localip:
+         The local IP to send the messages from
+      localport:
+         The local port to send the messages from
+      messages:
+         A list of (destip, destport, message) tuples to send, in order.
+
+   <Exceptions>
+      As with sendmessage(). The argument checks are done for every message
+      before anything is sent.
+
+   <Side Effects>
+      As with sendmessage().
+
+   <Resource Consumption>
+      This operation consumes 64 bytes + number of bytes of the message that
+      were transmitted for each message. This requires that the localport is
+      allowed.
+
+   <Returns>
+      A list with the number of bytes sent for each message. If an error
+      occurs after some of the messages were sent, the list is shorter than
+      messages and the remaining messages were not sent.
+  """
+  # Check the input arguments (type)
+  if type(localip) is not str:
+    raise RepyArgumentError("Provided localip must be a string!")
+  if type(localport) is not int:
+    raise RepyArgumentError("Provided localport must be an int!")
+  if type(messages) is not list:
+    raise RepyArgumentError("Provided messages must be a list!")
+
+  # Check the input arguments (sanity)
+  if not _is_valid_ip_address(localip):
+    raise RepyArgumentError("Provided localip is not valid! IP: '"+localip+"'")
+  if not _is_valid_network_port(localport):
+    raise RepyArgumentError("Provided localport is not valid! Port: "+str(localport))
+
+  # Check each message. We also work out which resources we will use.
+  uses_loopback = False
+  uses_network = False
+  for item in messages:
+    if type(item) is not tuple or len(item) != 3:
+      raise RepyArgumentError("Provided messages must be (destip, destport, message) tuples!")
+
+    destip, destport, message = item
+
+    if type(destip) is not str:
+      raise RepyArgumentError("Provided destip must be a string!")
+    if type(destport) is not int:
+      raise RepyArgumentError("Provided destport must be an int!")
+    if type(message) is not str:
+      raise RepyArgumentError("Provided message must be a string!")
+
+    if not _is_valid_ip_address(destip):
+      raise RepyArgumentError("Provided destip is not valid! IP: '"+destip+"'")
+    if not _is_valid_network_port(destport):
+      raise RepyArgumentError("Provided destport is not valid! Port: "+str(destport))
+
+    # Check that if localip == destip, then localport != destport
+    if localip == destip and localport == destport:
+      raise RepyArgumentError("Local socket name cannot match destination socket name! Local/Dest IP and Port match.")
+
+    if _is_loopback_ipaddr(destip):
+      uses_loopback = True
+    else:
+      uses_network = True
+
+  # Check the input arguments (permission)
+  update_ip_cache()
+  if not _ip_is_allowed(localip):
+    raise ResourceForbiddenError("Provided localip is not allowed! IP: "+localip)
+
+  if not _is_allowed_localport("UDP", localport):
+    raise ResourceForbiddenError("Provided localport is not allowed! Port: "+str(localport))
+
+  # Nothing to do
+  if len(messages) == 0:
+    return []
+
+  # Wait for netsend
+  if uses_loopback:
+    nanny.tattle_quantity('loopsend', 0)
+  if uses_network:
+    nanny.tattle_quantity('netsend', 0)
+
+  # Set once we have a socket from the pool, which must be handed back
+  pooled = False
+
+  try:
+    if ("UDP", localip, localport) in _BOUND_SOCKETS:
+      sock = _BOUND_SOCKETS[("UDP", localip, localport)]       
+    else:
+      # Get a bound socket from the pool
+      sock = _get_udp_send_socket(localip, localport)
+      pooled = True
+
+    # Send the messages
+    bytessent = _send_datagrams(sock, messages)
+
+    # Account for the resources
+    loopbytes = 0
+    netbytes = 0
+    for index in range(len(bytessent)):
+      if _is_loopback_ipaddr(messages[index][0]):
+        loopbytes += bytessent[index] + 64
+      else:
+        netbytes += bytessent[index] + 64
+
+    if uses_loopback:
+      nanny.tattle_quantity('loopsend', loopbytes)
+    if uses_network:
+      nanny.tattle_quantity('netsend', netbytes)
+
+    return bytessent
+
+  except Exception, e:
+
+    # The socket is borrowed from a UDPServerSocket or the pool, so it is
+    # not closed here.
 
     # Check if address is already in use
     if _is_addr_in_use_exception(e):
@@ -955,6 +2032,10 @@ def sendmessage(destip, destport, message, localip, localport):
     else:
       raise
 
+  finally:
+    if pooled:
+      _release_udp_send_socket(localip, localport, sock)
+
 
 
 
@@ -1025,11 +2106,15 @@ def listenformessage(localip, localport):
     # Check if localip is on loopback
     on_loopback = _is_loopback_ipaddr(localip) 
 
-    # Get the socket
-    sock = _get_udp_socket(localip,localport)
+    # Take over the socket sendmessage() has been using, if there is one
+    sock = _adopt_udp_send_socket(localip, localport)
+
+    if sock is None:
+      # Get the socket
+      sock = _get_udp_socket(localip,localport)
     
-    # Register this socket as an insocket
-    nanny.tattle_add_item('insockets',id(sock))
+      # Register this socket as an insocket
+      nanny.tattle_add_item('insockets',id(sock))
 
     # Add the socket to _BOUND_SOCKETS so that we can 
     # preserve send functionality on this port.
@@ -1146,6 +2231,105 @@ def _conn_cleanup_check(identity):
       raise CleanupInProgressError("The socket is being cleaned up by the operating system!")
 
 
+# Errors from a non-blocking connect() meaning it has not finished yet
+_CONNECT_PENDING_ERRORS = ["EINPROGRESS", "EALREADY", "EWOULDBLOCK", "EINTR",
+                           "WSAEINPROGRESS", "WSAEALREADY", "WSAEWOULDBLOCK"]
+
+
+def _start_connect(sock, destip, destport):
+  """
+  <Purpose>
+    Starts connecting a non-blocking socket.
+
+  <Arguments>
+    sock: A non-blocking TCP socket
+    destip,destport: The address to connect to
+
+  <Exceptions>
+    socket.error if the connection failed right away.
+
+  <Returns>
+    True if the socket is connected, False if the connection is in
+    progress. Use _finish_connect to wait for it.
+  """
+  errnum = sock.connect_ex((destip, destport))
+  if errnum == 0:
+    return True
+
+  if errno.errorcode.get(errnum) in _CONNECT_PENDING_ERRORS:
+    return False
+
+  raise socket.error(errnum, os.strerror(errnum))
+
+
+def _finish_connect(sock, timeout):
+  """
+  <Purpose>
+    Waits for a connection started by _start_connect.
+
+  <Arguments>
+    sock: The connecting socket
+    timeout: The longest time to wait, 0 to just check
+
+  <Exceptions>
+    socket.error if the connection failed.
+    As with select.select().
+
+  <Returns>
+    True if the socket is connected, False if the connection is still in
+    progress.
+  """
+  # A connecting socket becomes writable once the connection is done.
+  # (Windows reports failures as exceptions, which counts too.)
+  (read_will_block, write_will_block) = _check_socket_state(sock, "w", timeout)
+  if write_will_block:
+    return False
+
+  # Find out how it went
+  errnum = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+  if errnum != 0:
+    raise socket.error(errnum, os.strerror(errnum))
+
+  return True
+
+
+def _is_recoverable_connect_exception(exceptionobj):
+  """
+  <Purpose>
+    Checks an exception from _start_connect or _finish_connect.
+
+  <Arguments>
+    exceptionobj: The exception
+
+  <Exceptions>
+    Raises DuplicateTupleError if there is already a connection.
+    Raises InternetConnectivityError if the network is down.
+    Raises ConnectionRefusedError if the connection was refused.
+
+  <Returns>
+    True if connecting may be retried, False if the exception is not one
+    we know about (the caller should re-raise it).
+  """
+  # Check if we are already connected
+  if _is_already_connected_exception(exceptionobj):
+    raise DuplicateTupleError("There is a duplicate connection which conflicts with the request!")
+
+  # Check if the network is down
+  if _is_network_down_exception(exceptionobj):
+    raise InternetConnectivityError("The network is down or cannot be reached from the local IP!")
+
+  # Check if the connection was refused
+  if _is_conn_refused_exception(exceptionobj):
+    raise ConnectionRefusedError("The connection was refused!") 
+
+  # Check for ECONNABORTED due to a server-sent RST
+  if _is_conn_aborted_exception(exceptionobj):
+    raise ConnectionRefusedError("The remote side hung up before the connection was established.")
+
+  # Check if this is recoverable (try again, timeout, etc)
+  return _is_recoverable_network_exception(exceptionobj)
+
+
 def _timed_conn_initialize(localip,localport,destip,destport, timeout):
   """
   <Purpose> 
@@ -1175,53 +2359,133 @@ def _timed_conn_initialize(localip,localport,destip,destport, timeout):
 
   # Get a TCP socket bound to the local ip / port
   sock = _get_tcp_socket(localip, localport)
-  sock.settimeout(timeout)
+  sock.setblocking(0)
+
+  try:
+    # Start connecting, then wait for the connection to finish. Only
+    # recoverable errors cause another attempt, after a short wait which
+    # grows each time.
+    retry_interval = CONNECT_RETRY_MIN_INTERVAL
+    while True:
+      try:
+        if _start_connect(sock, destip, destport):
+          return sock
+
+        remaining = timeout - (nonportable.getruntime() - starttime)
+        if remaining > 0 and _finish_connect(sock, remaining):
+          return sock
+
+      except Exception, e:
+        if not _is_recoverable_connect_exception(e):
+          raise
+
+        # Sleep and retry, avoid busy waiting
+        remaining = timeout - (nonportable.getruntime() - starttime)
+        if remaining > 0:
+          time.sleep(min(retry_interval, remaining))
+          retry_interval = min(retry_interval * 2, RETRY_INTERVAL)
+
+      # Check if we timed out
+      if nonportable.getruntime() - starttime >= timeout:
+        raise TimeoutError("Timed-out connecting to the remote host!")
+
+  except:
+    # Close the socket, and raise
+    sock.close()
+    raise
+
+
+# Checks the arguments to openconnection and openconnectionasync
+def _check_connection_arguments(destip, destport, localip, localport, timeout):
+  """
+  <Purpose>
+    Checks the types, values and permissions of the arguments to
+    openconnection() and openconnectionasync().
+
+  <Arguments>
+    As with openconnection().
+
+  <Exceptions>
+    RepyArgumentError if the arguments are invalid.
+    ResourceForbiddenError if the local IP or port is not allowed.
+
+  <Returns>
+    None
+  """
+  # Check the input arguments (type)
+  if type(destip) is not str:
+    raise RepyArgumentError("Provided destip must be a string!")
+  if type(localip) is not str:
+    raise RepyArgumentError("Provided localip must be a string!")
+
+  if type(destport) is not int:
+    raise RepyArgumentError("Provided destport must be an int!")
+  if type(localport) is not int:
+    raise RepyArgumentError("Provided localport must be an int!")
+
+  if type(timeout) not in [float, int]:
+    raise RepyArgumentError("Provided timeout must be an int or float!")
+
+
+  # Check the input arguments (sanity)
+  if not _is_valid_ip_address(destip):
+    raise RepyArgumentError("Provided destip is not valid! IP: '"+destip+"'")
+  if not _is_valid_ip_address(localip):
+    raise RepyArgumentError("Provided localip is not valid! IP: '"+localip+"'")
+
+  if not _is_valid_network_port(destport):
+    raise RepyArgumentError("Provided destport is not valid! Port: "+str(destport))
+  if not _is_valid_network_port(localport):
+    raise RepyArgumentError("Provided localport is not valid! Port: "+str(localport))
 
-  try:
-    # Try to connect until we timeout
-    connected = False
-    while nonportable.getruntime() - starttime < timeout:
-      try:
-        sock.connect((destip, destport))
-        connected = True
-        break
-      except Exception, e:
-        # Check if we are already connected
-        if _is_already_connected_exception(e):
-          connected = True     
-          raise DuplicateTupleError("There is a duplicate connection which conflicts with the request!")
-          break
+  if timeout <= 0:
+    raise RepyArgumentError("Provided timeout is not valid, must be positive! Timeout: "+str(timeout))
 
-        # Check if the network is down
-        if _is_network_down_exception(e):
-          raise InternetConnectivityError("The network is down or cannot be reached from the local IP!")
+  # Check that if localip == destip, then localport != destport
+  if localip == destip and localport == destport:
+    raise RepyArgumentError("Local socket name cannot match destination socket name! Local/Dest IP and Port match.")
 
-        # Check if the connection was refused
-        if _is_conn_refused_exception(e):
-          raise ConnectionRefusedError("The connection was refused!") 
+  # Check the input arguments (permission)
+  update_ip_cache()
+  if not _ip_is_allowed(localip):
+    raise ResourceForbiddenError("Provided localip is not allowed! IP: "+localip)
 
-        # Check for ECONNABORTED due to a server-sent RST
-        if _is_conn_aborted_exception(e):
-          raise ConnectionRefusedError("The remote side hung up before the connection was established.")
+  if not _is_allowed_localport("TCP", localport):
+    raise ResourceForbiddenError("Provided localport is not allowed! Port: "+str(localport))
 
-        # Check if this is recoverable (try again, timeout, etc)
-        elif not _is_recoverable_network_exception(e):
-          raise
 
-        # Sleep and retry, avoid busy waiting
-        time.sleep(RETRY_INTERVAL)
+# Works out why binding or connecting a TCP socket failed
+def _check_connection_setup_exception(exceptionobj, identity):
+  """
+  <Purpose>
+    Converts an address error from binding or connecting an outgoing
+    TCP socket into the matching repy exception. The socket should
+    already be closed.
 
-    # Check if we timed out
-    if not connected:
-      raise TimeoutError("Timed-out connecting to the remote host!")
+  <Arguments>
+    exceptionobj: The exception
+    identity: The ("TCP", localip, localport, destip, destport) tuple
 
-    # Return the socket
-    return sock
+  <Exceptions>
+    DuplicateTupleError, CleanupInProgressError, AlreadyListeningError or
+    AddressBindingError if this was an address error.
 
-  except:
-    # Close the socket, and raise
-    sock.close()
-    raise
+  <Returns>
+    None if this was some other error.
+  """
+  # Check if this an already in use error
+  if _is_addr_in_use_exception(exceptionobj):
+    # Call _conn_cleanup_check to determine if this is because
+    # the socket is being cleaned up or if it is actively being used
+    # This will always raise DuplicateTupleError or
+    # CleanupInProgressError or AlreadyListeningError
+    _conn_cleanup_check(identity)
+ 
+  # Check if this is a binding error
+  if _is_addr_unavailable_exception(exceptionobj):
+    # Call _conn_alreadyexists_check to determine if this is because
+    # the connection is active or not
+    _conn_alreadyexists_check(identity)
 
 
 # Public interface!!!
@@ -1289,48 +2553,8 @@ def openconnection(destip, destport,localip, localport, timeout):
       A socket-like object that can be used for communication. Use send, 
       recv, and close just like you would an actual socket object in python.
   """
-  # Check the input arguments (type)
-  if type(destip) is not str:
-    raise RepyArgumentError("Provided destip must be a string!")
-  if type(localip) is not str:
-    raise RepyArgumentError("Provided localip must be a string!")
-
-  if type(destport) is not int:
-    raise RepyArgumentError("Provided destport must be an int!")
-  if type(localport) is not int:
-    raise RepyArgumentError("Provided localport must be an int!")
-
-  if type(timeout) not in [float, int]:
-    raise RepyArgumentError("Provided timeout must be an int or float!")
-
-
-  # Check the input arguments (sanity)
-  if not _is_valid_ip_address(destip):
-    raise RepyArgumentError("Provided destip is not valid! IP: '"+destip+"'")
-  if not _is_valid_ip_address(localip):
-    raise RepyArgumentError("Provided localip is not valid! IP: '"+localip+"'")
-
-  if not _is_valid_network_port(destport):
-    raise RepyArgumentError("Provided destport is not valid! Port: "+str(destport))
-  if not _is_valid_network_port(localport):
-    raise RepyArgumentError("Provided localport is not valid! Port: "+str(localport))
-
-  if timeout <= 0:
-    raise RepyArgumentError("Provided timeout is not valid, must be positive! Timeout: "+str(timeout))
-
-  # Check that if localip == destip, then localport != destport
-  if localip == destip and localport == destport:
-    raise RepyArgumentError("Local socket name cannot match destination socket name! Local/Dest IP and Port match.")
-
-  # Check the input arguments (permission)
-  update_ip_cache()
-  if not _ip_is_allowed(localip):
-    raise ResourceForbiddenError("Provided localip is not allowed! IP: "+localip)
-
-  if not _is_allowed_localport("TCP", localport):
-    raise ResourceForbiddenError("Provided localport is not allowed! Port: "+str(localport))
-
-
+  # Check the input arguments
+  _check_connection_arguments(destip, destport, localip, localport, timeout)
 
   # use this tuple during connection clean up check
   identity = ("TCP", localip, localport, destip, destport)
@@ -1347,31 +2571,23 @@ def openconnection(destip, destport,localip, localport, timeout):
     # To Know if remote IP is on loopback or not
     on_loopback = _is_loopback_ipaddr(destip)
 
-    # Get the socket
-    sock = _timed_conn_initialize(localip,localport,destip,destport, timeout)
+    # Skip the OS if something in this process is listening
+    sock = None
+    if loopback_fast_path and on_loopback:
+      sock = _connect_in_process(identity)
+
+    if sock is None:
+      # Get the socket
+      sock = _timed_conn_initialize(localip,localport,destip,destport, timeout)
     
-    # Register this socket as an outsocket
-    nanny.tattle_add_item('outsockets',id(sock))
+      # Register this socket as an outsocket
+      _tattle_add_outsocket(id(sock))
   except Exception, e:
-
-    # Check if this an already in use error
-    if _is_addr_in_use_exception(e):
-      # Call _conn_cleanup_check to determine if this is because
-      # the socket is being cleaned up or if it is actively being used
-      # This will always raise DuplicateTupleError or
-      # CleanupInProgressError or AlreadyListeningError
-      _conn_cleanup_check(identity)
- 
-    # Check if this is a binding error
-    if _is_addr_unavailable_exception(e):
-      # Call _conn_alreadyexists_check to determine if this is because
-      # the connection is active or not
-      _conn_alreadyexists_check(identity)
-      
+    # Find out why binding or connecting failed
+    _check_connection_setup_exception(e, identity)
 
     # Unknown error...
-    else:
-      raise
+    raise
 
   emul_sock = EmulatedSocket(sock, on_loopback)
 
@@ -1387,6 +2603,84 @@ def openconnection(destip, destport,localip, localport, timeout):
   return emul_sock
 
 
+# Public interface!!!
+def openconnectionasync(destip, destport, localip, localport, timeout):
+  """
+    <Purpose>
+      Starts opening a connection without waiting for it to finish.
+
+    <Arguments>
+      As with openconnection(). The timeout is measured from this call.
+
+    <Exceptions>
+      As with openconnection(), for the problems that can be detected
+      right away. Everything else is raised by PendingConnection.poll()
+      or PendingConnection.wait().
+
+    <Side Effects>
+      Binds a socket to the local IP and port and starts connecting it
+      in the background. The returned PendingConnection holds the local
+      IP and port, and the outsocket registered for it, until the
+      connection fails or is cancelled. Once the connection is
+      established, the socket-like object returned by poll() or wait()
+      takes them over.
+
+    <Resource Consumption>
+      This operation consumes an outsocket until the connection fails or
+      is cancelled, or for as long as the connected socket is open. Upon
+      success, it consumes the same netsend and netrecv as openconnection().
+
+    <Returns>
+      A PendingConnection. Its poll() and wait() methods return the
+      socket-like object once the connection is established.
+  """
+  # Check the input arguments
+  _check_connection_arguments(destip, destport, localip, localport, timeout)
+
+  # use this tuple during connection clean up check
+  identity = ("TCP", localip, localport, destip, destport)
+
+  starttime = nonportable.getruntime()
+
+  # Wait for netsend / netrecv
+  on_loopback = _is_loopback_ipaddr(destip)
+  if on_loopback:
+    nanny.tattle_quantity('loopsend', 0)
+    nanny.tattle_quantity('looprecv', 0)
+  else:
+    nanny.tattle_quantity('netsend', 0)
+    nanny.tattle_quantity('netrecv', 0)
+
+  try:
+    # Get a TCP socket bound to the local ip / port
+    sock = _get_tcp_socket(localip, localport)
+  except Exception, e:
+    # Find out why binding failed
+    _check_connection_setup_exception(e, identity)
+
+    # Unknown error...
+    raise
+
+  try:
+    # Register this socket as an outsocket now, so that there can not be
+    # more connections in progress than there are outsockets
+    _tattle_add_outsocket(id(sock))
+  except:
+    sock.close()
+    raise
+
+  sock.setblocking(0)
+  pending = PendingConnection(sock, on_loopback, identity, starttime + timeout)
+
+  # Start connecting. Errors found right away are raised here.
+  try:
+    pending.poll()
+  except SocketWouldBlockError:
+    pass
+
+  return pending
+
+
 def listenforconnection(localip, localport):
   """
   <Purpose>
@@ -1452,15 +2746,9 @@ def listenforconnection(localip, localport):
     # Get the socket
     sock = _get_tcp_socket(localip,localport)     
     nanny.tattle_add_item('insockets',id(sock))
-    # Get the maximum number of outsockets
-    max_outsockets = nanny.get_resource_limit("outsockets")        
-    # If we have restrictions, then we want to set the outsocket
-    # limit
-    if max_outsockets:
-      # Set the backlog to be the maximum number of outsockets
-      sock.listen(max_outsockets)
-    else:
-      sock.listen(5)
+    # Set the backlog to the largest one allowed
+    backlog = _get_listen_backlog_limit()
+    sock.listen(backlog)
 
   except Exception, e:
     
@@ -1481,7 +2769,18 @@ def listenforconnection(localip, localport):
     else:
         raise
 
-  server_sock = TCPServerSocket(sock, on_loopback)
+  server_sock = TCPServerSocket(sock, on_loopback, backlog)
+
+  # Let connections from this process skip the OS
+  if loopback_fast_path and on_loopback:
+    listener = _InProcessListener((localip, localport), backlog)
+    _IN_PROCESS_LOCK.acquire()
+    try:
+      _IN_PROCESS_LISTENERS[(localip, localport)] = listener
+    finally:
+      _IN_PROCESS_LOCK.release()
+
+    server_sock.in_process_listener = listener
 
   # Return the TCPServerSocket
   return server_sock
@@ -1578,6 +2877,309 @@ def _check_socket_state(realsock, waitfor="rw", timeout=0.0):
   return (realsock not in readable, realsock not in writeable)
 
 
+# Raises SocketClosedRemote if the other end of a TCP socket has closed
+def _check_remote_close(sock):
+  # Fixes ticket#974
+  # (In-process connections raise EPIPE from send() instead)
+  if isinstance(sock, _InProcessEndpoint):
+    return
+
+  (readable, writable, exception) = select.select([sock],[],[],0)
+  # check if socket is readable.   This is true if the remote end closed.
+  if readable:
+
+     # if socket is readable but there was no data this means the remote end
+     # has closed the socket.   We peek so that we don't consume a character.
+     data_peeked = sock.recv(1,socket.MSG_PEEK)
+     if len(data_peeked) == 0:
+        # remote socket is closed
+        raise SocketClosedRemote("The socket has been closed by the remote end!")
+
+
+####################### In-process connections #######################
+
+# Raises a socket.error like the OS would
+def _raise_in_process_error(errnum):
+  raise socket.error(errnum, os.strerror(errnum))
+
+
+class _InProcessPipe(object):
+  # One direction of an in-process connection.
+  #
+  # Fields:
+  # chunks: The strings which were sent but not yet received
+  # length: The total length of chunks
+  # capacity: The most bytes that may be waiting in chunks
+  # writer_closed: True once the sending end has stopped sending
+  # reader_closed: True once the receiving end was closed
+  __slots__ = ["chunks", "length", "capacity", "writer_closed", "reader_closed"]
+
+  def __init__(self):
+    self.chunks = []
+    self.length = 0
+    self.capacity = IN_PROCESS_BUFFER_SIZE
+    self.writer_closed = False
+    self.reader_closed = False
+
+
+
+class _InProcessEndpoint(object):
+  """
+  One end of an in-process TCP connection. This provides the parts of the
+  socket object interface that EmulatedSocket and TCPServerSocket use, so
+  they work the same way on both. Errors are raised as socket.error with
+  the error number the OS would use.
+  """
+  # Fields:
+  # inbound: The _InProcessPipe this end receives from
+  # outbound: The _InProcessPipe this end sends into
+  # lock: Protects both pipes. It is shared by both ends.
+  # identity: The ("TCP", localip, localport, destip, destport) tuple of
+  #           the connection, as seen by the connecting end
+  # options: The other socket options which were set, keyed by
+  #          (level, option name)
+  __slots__ = ["inbound", "outbound", "lock", "identity", "options"]
+
+  def __init__(self, inbound, outbound, lock, identity):
+    self.inbound = inbound
+    self.outbound = outbound
+    self.lock = lock
+    self.identity = identity
+    self.options = {}
+
+
+  def send(self, data):
+    self.lock.acquire()
+    try:
+      pipe = self.outbound
+      if pipe.writer_closed:
+        _raise_in_process_error(errno.EBADF)
+      if pipe.reader_closed:
+        _raise_in_process_error(errno.EPIPE)
+
+      space = pipe.capacity - pipe.length
+      if space <= 0:
+        _raise_in_process_error(errno.EWOULDBLOCK)
+
+      data = data[:space]
+      if data:
+        pipe.chunks.append(data)
+        pipe.length += len(data)
+      return len(data)
+
+    finally:
+      self.lock.release()
+
+
+  def recv(self, bytes, flags=0):
+    self.lock.acquire()
+    try:
+      pipe = self.inbound
+      if pipe.reader_closed:
+        _raise_in_process_error(errno.EBADF)
+
+      if pipe.length == 0:
+        # Nothing more will arrive once the other end closed
+        if pipe.writer_closed:
+          return ""
+        _raise_in_process_error(errno.EWOULDBLOCK)
+
+      # Take whole chunks while they fit, then split the next one
+      received = []
+      wanted = bytes
+      chunks = pipe.chunks
+      while chunks and wanted > 0:
+        chunk = chunks[0]
+        if len(chunk) <= wanted:
+          del chunks[0]
+        else:
+          chunks[0] = chunk[wanted:]
+          chunk = chunk[:wanted]
+        received.append(chunk)
+        wanted -= len(chunk)
+
+      data = "".join(received)
+      pipe.length -= len(data)
+      return data
+
+    finally:
+      self.lock.release()
+
+
+  def shutdown(self, how):
+    self.lock.acquire()
+    try:
+      if how != socket.SHUT_RD:
+        self.outbound.writer_closed = True
+    finally:
+      self.lock.release()
+
+
+  def close(self):
+    self.lock.acquire()
+    try:
+      self.outbound.writer_closed = True
+      self.inbound.reader_closed = True
+      # Nobody will receive this anymore
+      self.inbound.chunks = []
+      self.inbound.length = 0
+      # Did the other end close already?
+      both_closed = self.outbound.reader_closed
+    finally:
+      self.lock.release()
+
+    if not both_closed:
+      return
+
+    # The tuple can be used again once both ends are closed
+    _IN_PROCESS_LOCK.acquire()
+    try:
+      _IN_PROCESS_CONNECTIONS.discard(self.identity)
+    finally:
+      _IN_PROCESS_LOCK.release()
+
+
+  def setblocking(self, flag):
+    # This never blocks anyways
+    pass
+
+
+  def getsockopt(self, level, option):
+    if (level, option) == (socket.SOL_SOCKET, socket.SO_SNDBUF):
+      return self.outbound.capacity
+    if (level, option) == (socket.SOL_SOCKET, socket.SO_RCVBUF):
+      return self.inbound.capacity
+    return self.options.get((level, option), 0)
+
+
+  def setsockopt(self, level, option, value):
+    self.lock.acquire()
+    try:
+      if (level, option) == (socket.SOL_SOCKET, socket.SO_SNDBUF):
+        self.outbound.capacity = value
+      elif (level, option) == (socket.SOL_SOCKET, socket.SO_RCVBUF):
+        self.inbound.capacity = value
+      else:
+        self.options[(level, option)] = value
+    finally:
+      self.lock.release()
+
+
+
+class _InProcessListener(object):
+  # The in-process part of a TCPServerSocket.
+  #
+  # Fields:
+  # key: The (IP, Port) in _IN_PROCESS_LISTENERS
+  # backlog: The most connections that may wait in pending
+  # pending: The connections waiting to be accepted, as
+  #          (remote ip, remote port, _InProcessEndpoint) tuples.
+  #          This is protected by _IN_PROCESS_LOCK.
+  __slots__ = ["key", "backlog", "pending"]
+
+  def __init__(self, key, backlog):
+    self.key = key
+    self.backlog = backlog
+    self.pending = []
+
+
+
+# Returns the (connecting end, accepting end) of a new in-process connection
+def _create_in_process_pair(identity):
+  # Each end sends into the pipe the other one receives from
+  lock = threading.Lock()
+  forward = _InProcessPipe()
+  backward = _InProcessPipe()
+  return (_InProcessEndpoint(backward, forward, lock, identity),
+      _InProcessEndpoint(forward, backward, lock, identity))
+
+
+
+def _connect_in_process(identity):
+  """
+  <Purpose>
+    Opens a connection to a TCPServerSocket in this process, without
+    going through the OS.
+
+  <Arguments>
+    identity: The ("TCP", localip, localport, destip, destport) tuple of
+              the connection
+
+  <Exceptions>
+    DuplicateTupleError if an in-process connection with this identity
+    is already open.
+
+    ResourceExhaustedError if there are no free outsockets.
+
+  <Side Effects>
+    The other end is queued on the listening TCPServerSocket, and is
+    returned by its getconnection().
+
+  <Resource Consumption>
+    Uses an outsocket for the returned end.
+
+  <Returns>
+    The local _InProcessEndpoint, or None if nothing in this process is
+    listening on the destination or its backlog is full. The caller
+    should then connect through the OS.
+  """
+  localip = identity[1]
+  localport = identity[2]
+  destination = (identity[3], identity[4])
+
+  _IN_PROCESS_LOCK.acquire()
+  try:
+    listener = _IN_PROCESS_LISTENERS.get(destination)
+    if listener is None or len(listener.pending) >= listener.backlog:
+      return None
+
+    if identity in _IN_PROCESS_CONNECTIONS:
+      raise DuplicateTupleError("Duplicate local (ip, port, destip, destport) tuple is already in use!")
+
+    local_end, remote_end = _create_in_process_pair(identity)
+
+    # Register this end as an outsocket before anyone can see it
+    _tattle_add_outsocket(id(local_end))
+
+    _IN_PROCESS_CONNECTIONS.add(identity)
+    listener.pending.append((localip, localport, remote_end))
+    return local_end
+
+  finally:
+    _IN_PROCESS_LOCK.release()
+
+
+
+def _stop_listening_in_process(listener):
+  """
+  <Purpose>
+    Stops a TCPServerSocket from accepting in-process connections, and
+    closes the connections that were not accepted yet.
+
+  <Arguments>
+    listener: The _InProcessListener of the TCPServerSocket
+
+  <Exceptions>
+    None
+
+  <Returns>
+    None
+  """
+  _IN_PROCESS_LOCK.acquire()
+  try:
+    if _IN_PROCESS_LISTENERS.get(listener.key) is listener:
+      del _IN_PROCESS_LISTENERS[listener.key]
+    pending = listener.pending
+    listener.pending = []
+  finally:
+    _IN_PROCESS_LOCK.release()
+
+  # The connecting ends will see a remote close
+  for (remote_ip, remote_port, endpoint) in pending:
+    endpoint.close()
+
+
+
 ##### Class Definitions
 
 # Public.   We pass these to the users for communication purposes
@@ -1601,10 +3203,11 @@ class EmulatedSocket:
   #              this is used for resource accounting.
   # sock_lock: Threading Lock on socket object used for 
   #            synchronization.
-  __slots__ = ["socketobj", "send_buffer_size", "on_loopback", "sock_lock"]
+  # stats: The counters getstatistics() returns, protected by sock_lock.
+  __slots__ = ["socketobj", "send_buffer_size", "on_loopback", "sock_lock", "stats"]
 
   
-  def __init__(self, sock, on_loopback):
+  def __init__(self, sock, on_loopback, send_buffer_size=None):
     """
     <Purpose>
       Initializes a EmulatedSocket object.
@@ -1614,6 +3217,10 @@ class EmulatedSocket:
 
       on_loopback: True/False based on whether remote IP is
                    on loopback oe not
+
+      send_buffer_size: The size of the socket's send buffer, if the
+                        caller already knows it. Otherwise it is read
+                        from the socket.
       
     <Exceptions>
       InteralRepyError is raised if there is no table entry for
@@ -1626,9 +3233,13 @@ class EmulatedSocket:
     self.socketobj = sock
     self.on_loopback = on_loopback
     self.sock_lock = threading.Lock()
+    self.stats = {"bytessent" : 0, "bytesreceived" : 0, "sendcalls" : 0,
+                  "recvcalls" : 0, "wouldblock" : 0, "throttletime" : 0.0}
     
     # Store the socket send buffer size and set to non-blocking
-    self.send_buffer_size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    if send_buffer_size is None:
+      send_buffer_size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    self.send_buffer_size = send_buffer_size
     # locking should be unnecessary because there isn't another external
     # reference here yet
     sock.setblocking(0)
@@ -1715,6 +3326,31 @@ class EmulatedSocket:
 
 
 
+  def _tattle_traffic(self, sendamount, recvamount):
+    """
+    <Purpose>
+      Private method to charge the traffic of the connection to loopsend
+      and looprecv or netsend and netrecv, depending on where it goes.
+      With amounts of 0, this just waits until the resources are
+      available.
+
+    <Arguments>
+      sendamount: The bytes of netsend / loopsend to charge
+      recvamount: The bytes of netrecv / looprecv to charge
+
+    <Returns>
+      How long (in seconds) the nanny made us wait.
+    """
+    waitstart = nonportable.getruntime()
+    if self.on_loopback:
+      nanny.tattle_quantity('loopsend', sendamount)
+      nanny.tattle_quantity('looprecv', recvamount)
+    else:
+      nanny.tattle_quantity('netsend', sendamount)
+      nanny.tattle_quantity('netrecv', recvamount)
+    return nonportable.getruntime() - waitstart
+
+
   def recv(self,bytes):
     """
       <Purpose>
@@ -1744,17 +3380,16 @@ class EmulatedSocket:
     # Get the socket lock
     socket_lock = self.sock_lock
     # Wait if already oversubscribed
-    if self.on_loopback:
-      nanny.tattle_quantity('looprecv',0)
-      nanny.tattle_quantity('loopsend',0)
-    else:
-      nanny.tattle_quantity('netrecv',0)
-      nanny.tattle_quantity('netsend',0)
+    throttled = self._tattle_traffic(0, 0)
 
 
     # Acquire the socket lock
     socket_lock.acquire()
     try:
+      stats = self.stats
+      stats["recvcalls"] += 1
+      stats["throttletime"] += throttled
+
       # Get the socket
       sock = self.socketobj
       if sock is None:
@@ -1770,12 +3405,8 @@ class EmulatedSocket:
       if data_length == 0:
         raise SocketClosedRemote("The socket has been closed remotely!")
 
-      if self.on_loopback:
-        nanny.tattle_quantity('looprecv',data_length+64)
-        nanny.tattle_quantity('loopsend',64)
-      else:
-        nanny.tattle_quantity('netrecv',data_length+64)
-        nanny.tattle_quantity('netsend',64)
+      stats["bytesreceived"] += data_length
+      stats["throttletime"] += self._tattle_traffic(64, data_length+64)
 
       return data_recieved
 
@@ -1789,6 +3420,7 @@ class EmulatedSocket:
       # Check if this a recoverable error
       if _is_recoverable_network_exception(e):
         # Operation would block
+        self.stats["wouldblock"] += 1
         raise SocketWouldBlockError("There is no data! recv() would block.")
 
       elif _is_terminated_connection_exception(e):
@@ -1834,12 +3466,7 @@ class EmulatedSocket:
     # Get the socket lock
     socket_lock = self.sock_lock
     # Wait if already oversubscribed
-    if self.on_loopback:
-      nanny.tattle_quantity('loopsend',0)
-      nanny.tattle_quantity('looprecv',0)
-    else:
-      nanny.tattle_quantity('netsend',0)
-      nanny.tattle_quantity('netrecv',0)
+    throttled = self._tattle_traffic(0, 0)
 
     # Trim the message size to be less than the send buffer size.
     # This is a fix for http://support.microsoft.com/kb/823764
@@ -1848,33 +3475,23 @@ class EmulatedSocket:
     # Acquire the socket lock
     socket_lock.acquire()
     try:
+      stats = self.stats
+      stats["sendcalls"] += 1
+      stats["throttletime"] += throttled
+
       # Get the socket
       sock = self.socketobj
       if sock is None:
         raise KeyError # Socket is closed locally
  
       # Detect Socket Closed Remote
-      # Fixes ticket#974
-      (readable, writable, exception) = select.select([sock],[],[],0)
-      # check if socket is readable.   This is true if the remote end closed.
-      if readable:
-
-         # if socket is readable but there was no data this means the remote end
-         # has closed the socket.   We peek so that we don't consume a character.
-         data_peeked = sock.recv(1,socket.MSG_PEEK)
-         if len(data_peeked) == 0:
-            # remote socket is closed
-            raise SocketClosedRemote("The socket has been closed by the remote end!")
+      _check_remote_close(sock)
 
       # Try to send the data
       bytes_sent = sock.send(message)
       
-      if self.on_loopback:
-        nanny.tattle_quantity('looprecv', 64)
-        nanny.tattle_quantity('loopsend', 64 + bytes_sent)
-      else:
-        nanny.tattle_quantity('netrecv', 64)
-        nanny.tattle_quantity('netsend', 64 + bytes_sent)
+      stats["bytessent"] += bytes_sent
+      stats["throttletime"] += self._tattle_traffic(64 + bytes_sent, 64)
 
       # Return the number of bytes sent
       return bytes_sent
@@ -1888,6 +3505,7 @@ class EmulatedSocket:
       # Check if this a recoverable error
       if _is_recoverable_network_exception(e):
         # Operation would block
+        self.stats["wouldblock"] += 1
         raise SocketWouldBlockError("send() would block.")
 
       elif _is_terminated_connection_exception(e):
@@ -1904,6 +3522,269 @@ class EmulatedSocket:
       socket_lock.release()
 
 
+  def sendfile(self, fileobj, offset, count):
+    """
+      <Purpose>
+        Sends data from a file on a socket. Where the OS supports it, the
+        data goes straight from the file to the socket. It may send fewer
+        bytes than requested.
+
+      <Arguments>
+        fileobj:
+          The file to send from, as returned by openfile().
+        offset:
+          The offset in the file to start sending from.
+        count:
+          The maximum number of bytes to send.
+
+      <Exceptions>
+        RepyArgumentError is raised if the offset or count are invalid.
+        FileClosedError is raised if the file is closed.
+        SeekPastEndOfFileError is raised if the offset is past the end of
+        the file.
+        SocketClosedLocal is raised if the socket is closed locally.
+        SocketClosedRemote is raised if the socket is closed remotely.
+        SocketWouldBlockError is raised if the operation would block.
+
+      <Side Effects>
+        None.
+
+      <Resource Consumption>
+        As with send(), for the data sent. This also consumes 4K of fileread
+        for each 4K aligned-block of the file sent, as with readat().
+
+      <Returns>
+        The number of bytes sent. This is 0 if the offset is at the end of
+        the file.
+    """
+    # Check the input arguments (type)
+    if type(offset) not in [int, long]:
+      raise RepyArgumentError("Provided offset must be an int!")
+
+    if type(count) not in [int, long]:
+      raise RepyArgumentError("Provided count must be an int!")
+
+    # Check the input arguments (sanity)
+    if offset < 0:
+      raise RepyArgumentError("Provided offset must not be negative! Offset: "+str(offset))
+
+    if count < 0:
+      raise RepyArgumentError("Provided count must not be negative! Count: "+str(count))
+
+    # Get the socket lock
+    socket_lock = self.sock_lock
+    # Wait if already oversubscribed
+    nanny.tattle_quantity('fileread',0)
+    throttled = self._tattle_traffic(0, 0)
+
+    # As with send(), stay below the send buffer size
+    count = min(count, self.send_buffer_size-1)
+
+    # Acquire the socket lock
+    socket_lock.acquire()
+    try:
+      stats = self.stats
+      stats["sendcalls"] += 1
+      stats["throttletime"] += throttled
+
+      # Get the socket
+      sock = self.socketobj
+      if sock is None:
+        raise KeyError # Socket is closed locally
+
+      # Detect Socket Closed Remote
+      _check_remote_close(sock)
+
+      # Hold the file's lock, so it isn't closed or written while we read it
+      fileobj.seek_lock.acquire()
+      try:
+        fobj = fileobj.fobj
+        if fobj is None:
+          raise FileClosedError("File '"+fileobj.filename+"' is already closed!")
+
+        # Check the provided offset
+        if offset > fileobj.filesize:
+          raise SeekPastEndOfFileError("Seek offset extends past the EOF!")
+
+        # Try to send the data
+        if count == 0 or offset == fileobj.filesize:
+          bytes_sent = 0
+        elif _sendfile_available and not isinstance(sock, _InProcessEndpoint):
+          bytes_sent = nonportable.os_api.send_file(sock, fobj, offset, count)
+        else:
+          fobj.seek(offset)
+          bytes_sent = sock.send(fobj.read(count))
+
+      finally:
+        fileobj.seek_lock.release()
+
+      # Check how much we've read, in terms of 4K "blocks"
+      end_offset = bytes_sent + offset
+      disk_blocks_read = end_offset / 4096 - offset / 4096
+      if end_offset % 4096 > 0:
+        disk_blocks_read += 1
+
+      # Charge 4K per block
+      nanny.tattle_quantity('fileread', disk_blocks_read*4096)
+
+      stats["bytessent"] += bytes_sent
+      stats["throttletime"] += self._tattle_traffic(64 + bytes_sent, 64)
+
+      # Return the number of bytes sent
+      return bytes_sent
+
+
+    except KeyError:
+      raise SocketClosedLocal("The socket is closed!")
+    except RepyException:
+      raise # pass up from inner block
+    except Exception, e:
+      # Check if this a recoverable error
+      if _is_recoverable_network_exception(e):
+        # Operation would block
+        self.stats["wouldblock"] += 1
+        raise SocketWouldBlockError("sendfile() would block.")
+
+      elif _is_terminated_connection_exception(e):
+        # Remote close
+        self._close()
+        raise SocketClosedRemote("The socket has been closed remotely!")
+
+      else:
+        # Unknown error
+        self._close()
+        raise SocketClosedLocal("The socket has encountered an unexpected error! Error:"+str(e))
+
+    finally:
+      socket_lock.release()
+
+
+  def getstatistics(self):
+    """
+    <Purpose>
+      Provides statistics about the connection.
+
+    <Arguments>
+      None
+
+    <Exceptions>
+      None
+
+    <Resource Consumption>
+      None
+
+    <Returns>
+      A dictionary with the bytes sent ("bytessent") and received
+      ("bytesreceived"), the number of send / sendfile ("sendcalls") and
+      recv ("recvcalls") calls, how many of these would have blocked
+      ("wouldblock"), and the seconds they waited for network resources
+      ("throttletime").
+
+      While the socket is open, and if the OS supports it, this also
+      includes what the OS knows about the connection: The round trip time
+      ("rtt") and its variance ("rttvariance") in seconds, the retransmits
+      of the current segment ("retransmits") and of the whole connection
+      ("totalretransmits"), the congestion window in segments
+      ("congestionwindow"), the sending MSS in bytes ("mss") and the
+      number of segments which are not acknowledged yet ("unacked").
+    """
+    socket_lock = self.sock_lock
+    socket_lock.acquire()
+    try:
+      statistics = self.stats.copy()
+
+      sock = self.socketobj
+      if sock is not None and _get_tcp_info is not None and not isinstance(sock, _InProcessEndpoint):
+        try:
+          tcp_info = _get_tcp_info(sock)
+        except socket.error:
+          # E.g. the connection was reset. Just leave it out.
+          tcp_info = None
+
+        if tcp_info is not None:
+          statistics.update(tcp_info)
+
+      return statistics
+
+    finally:
+      socket_lock.release()
+
+
+  def setsocketoption(self, name, value):
+    """
+    <Purpose>
+      Sets an option on the socket.
+
+    <Arguments>
+      name: One of "sendbuffer" or "recvbuffer" (the buffer sizes in bytes),
+            "nodelay" (True disables Nagle's algorithm) or "keepalive"
+            (True sends TCP keepalives).
+      value: The new value, an int for the buffer sizes and a bool for the
+             others.
+
+    <Exceptions>
+      RepyArgumentError if the option or value are invalid.
+      ResourceForbiddenError if the buffer sizes may not be changed.
+      SocketClosedLocal if close() has been called.
+
+    <Resource Consumption>
+      Buffer sizes are limited to the socketbuffer resource.
+
+    <Returns>
+      The value that was used, after clamping it to the limits.
+    """
+    value = _check_socket_option(name, value, _SOCKET_OPTIONS)
+
+    socket_lock = self.sock_lock
+    socket_lock.acquire()
+    try:
+      sock = self.socketobj
+      if sock is None:
+        raise SocketClosedLocal("The socket is closed!")
+
+      _set_socket_option(sock, name, value)
+
+      # We send less than the send buffer size, so keep it up to date
+      if name == "sendbuffer":
+        self.send_buffer_size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+
+      return value
+
+    finally:
+      socket_lock.release()
+
+
+  def getsocketoption(self, name):
+    """
+    <Purpose>
+      Reads an option of the socket.
+
+    <Arguments>
+      name: As with setsocketoption().
+
+    <Exceptions>
+      RepyArgumentError if the option is unknown.
+      SocketClosedLocal if close() has been called.
+
+    <Returns>
+      The value of the option as reported by the OS.
+    """
+    if type(name) is not str or name not in _SOCKET_OPTIONS:
+      raise RepyArgumentError("Unknown socket option '"+str(name)+"'!")
+
+    socket_lock = self.sock_lock
+    socket_lock.acquire()
+    try:
+      sock = self.socketobj
+      if sock is None:
+        raise SocketClosedLocal("The socket is closed!")
+
+      return _get_socket_option(sock, name)
+
+    finally:
+      socket_lock.release()
+
+
   def __del__(self):
     # Get the socket lock
     try:
@@ -1940,7 +3821,9 @@ class UDPServerSocket:
   #              This is used for resource accounting.
   # sock_lock: Threading Lock on socket object used for 
   #            synchronization.
-  __slots__ = ["socketobj", "on_loopback", "sock_lock"]
+  # recv_buffer: The reusable buffer(s) used by getmessages(). This is
+  #              allocated on first use.
+  __slots__ = ["socketobj", "on_loopback", "sock_lock", "recv_buffer"]
 
   # UDP listening socket interface
   def __init__(self, sock, on_loopback):
@@ -1965,6 +3848,7 @@ class UDPServerSocket:
     self.socketobj = sock
     self.on_loopback = on_loopback
     self.sock_lock = threading.Lock()
+    self.recv_buffer = None
     
     # Set the socket to non-blocking
     # locking should be unnecessary because there isn't another external
@@ -1994,7 +3878,146 @@ class UDPServerSocket:
 
     """
     # Get the socket lock
-    
+    
+    socket_lock = self.sock_lock
+    # Wait for netrecv resources
+    if self.on_loopback:
+      nanny.tattle_quantity('looprecv',0)
+    else:
+      nanny.tattle_quantity('netrecv',0)
+
+    # Acquire the lock
+    socket_lock.acquire()
+    try:
+      # Get the socket itself. This must be done after
+      # we acquire the lock because it is possible that the
+      # socket was closed/re-opened or that it was set to None,
+      # etc.
+      mysocketobj = self.socketobj
+      if mysocketobj is None:
+        raise KeyError # Indicates socket is closed
+
+      # Try to get a message of any size.   (64K is the max that fits in the 
+      # UDP header)
+      message, addr = mysocketobj.recvfrom(MAX_MESSAGE_SIZE)
+      remote_ip, remote_port = addr
+
+      # Do some resource accounting
+      if self.on_loopback:
+        nanny.tattle_quantity('looprecv', 64 + len(message))
+      else:
+        nanny.tattle_quantity('netrecv', 64 + len(message))
+
+      # Return everything
+      return (remote_ip, remote_port, message)
+
+    except KeyError:
+      # Socket is closed
+      raise SocketClosedLocal("The socket has been closed!")
+  
+    except RepyException:
+      # Let these through from the inner block
+      raise
+
+    except Exception, e:
+      # Check if this is a would-block error
+      if _is_recoverable_network_exception(e):
+        raise SocketWouldBlockError("No messages currently available!")
+
+      else: 
+        # Unexpected, close the socket, and then raise SocketClosedLocal
+        _cleanup_socket(self)       
+        raise SocketClosedLocal("Unexpected error, socket closed!")
+
+    finally:
+      # Release the lock
+      socket_lock.release()
+
+
+
+  def _receive_messages(self, sock, maxcount, messages):
+    """
+    <Purpose>
+      Private helper for getmessages(). Receives datagrams into the
+      socket's reusable buffers until there are maxcount of them or the
+      socket would block. The socket lock should be held.
+
+    <Arguments>
+      sock: The underlying socket object
+      maxcount: The maximum number of datagrams to receive
+      messages: A list which (remote ip, remote port, message) tuples are
+                appended to. This is filled in even if an exception is raised.
+
+    <Exceptions>
+      As with socket.recvfrom(). The last call usually raises a would-block
+      error once the socket is drained.
+
+    <Returns>
+      None
+    """
+    if _recvmmsg_available:
+      receiver = self.recv_buffer
+      if receiver is None:
+        receiver = nonportable.os_api.MessageReceiveVector(MESSAGE_BATCH_SIZE, MAX_MESSAGE_SIZE)
+        self.recv_buffer = receiver
+
+      while len(messages) < maxcount:
+        requested = min(maxcount - len(messages), MESSAGE_BATCH_SIZE)
+        batch = receiver.receive(sock, requested)
+        messages.extend(batch)
+
+        # A short batch means there is nothing more waiting
+        if len(batch) < requested:
+          break
+
+    else:
+      buffer = self.recv_buffer
+      if buffer is None:
+        buffer = _saved_bytearray(MAX_MESSAGE_SIZE)
+        self.recv_buffer = buffer
+
+      while len(messages) < maxcount:
+        length, addr = sock.recvfrom_into(buffer)
+        messages.append((addr[0], addr[1], str(buffer[:length])))
+
+
+
+  def getmessages(self, maxcount):
+    """
+    <Purpose>
+        Obtains up to maxcount incoming messages that were sent to an IP
+        and port. This drains as many waiting messages as possible with as
+        few system calls as possible.
+
+    <Arguments>
+        maxcount:
+            The maximum number of messages to return.
+
+    <Exceptions>
+        RepyArgumentError if maxcount is not a positive int.
+        SocketClosedLocal if UDPServerSocket.close() was called.
+        Raises SocketWouldBlockError if no message is available.
+
+    <Side Effects>
+        None
+
+    <Resource Consumption>
+        This operation consumes 64 + size of message bytes of netrecv for
+        each message returned. This is charged once for the whole batch.
+
+    <Returns>
+        A list of (remote IP, remote port, message) tuples in the order the
+        messages were received. The list holds at least one message.
+    """
+    # Check the input arguments (type)
+    if type(maxcount) is not int:
+      raise RepyArgumentError("Provided maxcount must be an int!")
+
+    # Check the input arguments (sanity)
+    if maxcount < 1:
+      raise RepyArgumentError("Provided maxcount must be positive! maxcount: "+str(maxcount))
+
+    # Get the socket lock
     socket_lock = self.sock_lock
     # Wait for netrecv resources
     if self.on_loopback:
@@ -2013,19 +4036,27 @@ class UDPServerSocket:
       if mysocketobj is None:
         raise KeyError # Indicates socket is closed
 
-      # Try to get a message of any size.   (64K is the max that fits in the 
-      # UDP header)
-      message, addr = mysocketobj.recvfrom(65535)
-      remote_ip, remote_port = addr
+      messages = []
+      try:
+        self._receive_messages(mysocketobj, maxcount, messages)
+      except Exception:
+        # If we already have messages, return those. Any real error will
+        # show up again on the next call.
+        if len(messages) == 0:
+          raise
+
+      # Do the resource accounting for the whole batch
+      bytes_received = 0
+      for remote_ip, remote_port, message in messages:
+        bytes_received += 64 + len(message)
 
-      # Do some resource accounting
       if self.on_loopback:
-        nanny.tattle_quantity('looprecv', 64 + len(message))
+        nanny.tattle_quantity('looprecv', bytes_received)
       else:
-        nanny.tattle_quantity('netrecv', 64 + len(message))
+        nanny.tattle_quantity('netrecv', bytes_received)
 
       # Return everything
-      return (remote_ip, remote_port, message)
+      return messages
 
     except KeyError:
       # Socket is closed
@@ -2079,6 +4110,11 @@ class UDPServerSocket:
     # Acquire the lock
     socket_lock.acquire()
     try:
+      # Stop sendmessage() from using this socket
+      for key in _BOUND_SOCKETS.keys():
+        if _BOUND_SOCKETS[key] is self.socketobj:
+          del _BOUND_SOCKETS[key]
+
       # Clean up the socket
       _cleanup_socket(self)
       # Replace the socket
@@ -2097,6 +4133,247 @@ class UDPServerSocket:
 
 
 
+class PendingConnection(object):
+  """
+  A TCP connection started by openconnectionasync(). The connection makes
+  progress whenever poll() or wait() is called.
+  """
+  # Fields:
+  # socketobj: The connecting socket. This is None once the connection is
+  #            done, has failed or was cancelled.
+  # on_loopback: True if the destination is a loopback address
+  # identity: The ("TCP", localip, localport, destip, destport) tuple
+  # deadline: The runtime at which connecting times out
+  # started: True if a connect() is in progress
+  # result: The EmulatedSocket once connected
+  # error: The exception to raise once connecting failed
+  # sock_lock: Threading Lock used for synchronization.
+  __slots__ = ["socketobj", "on_loopback", "identity", "deadline", "started",
+               "result", "error", "sock_lock"]
+
+  def __init__(self, sock, on_loopback, identity, deadline):
+    """
+    <Purpose>
+      Initializes a PendingConnection object.
+
+    <Arguments>
+      sock: A bound, non-blocking TCP socket which holds an outsocket
+      on_loopback: True/False based on whether remote IP is on loopback
+      identity: The ("TCP", localip, localport, destip, destport) tuple
+      deadline: The runtime at which connecting times out
+
+    <Returns>
+      A PendingConnection object.
+    """
+    self.socketobj = sock
+    self.on_loopback = on_loopback
+    self.identity = identity
+    self.deadline = deadline
+    self.started = False
+    self.result = None
+    self.error = None
+    self.sock_lock = threading.Lock()
+
+
+  def _close(self):
+    # Gives up the connecting socket and its outsocket. The lock must be held.
+    sock = self.socketobj
+    if sock is None:
+      return
+
+    self.socketobj = None
+    try:
+      sock.close()
+    except:
+      pass
+    nanny.tattle_remove_item('outsockets', id(sock))
+
+
+  def _advance(self, timeout):
+    # Makes progress on the connection, waiting for up to timeout seconds.
+    # The lock must be held.
+    if self.result is not None:
+      return self.result
+    if self.error is not None:
+      raise self.error
+
+    family, localip, localport, destip, destport = self.identity
+
+    # Keep trying until the wait is over or connecting times out
+    waituntil = min(nonportable.getruntime() + timeout, self.deadline)
+
+    try:
+      # As in _timed_conn_initialize(), only recoverable errors cause
+      # another attempt, after a short wait which grows each time
+      retry_interval = CONNECT_RETRY_MIN_INTERVAL
+      while True:
+        connected = False
+        try:
+          if not self.started:
+            connected = _start_connect(self.socketobj, destip, destport)
+            self.started = True
+
+          if not connected:
+            remaining = waituntil - nonportable.getruntime()
+            connected = _finish_connect(self.socketobj, max(0, remaining))
+
+        except Exception, e:
+          if not _is_recoverable_connect_exception(e):
+            # Close the socket before looking into why it failed
+            self._close()
+            _check_connection_setup_exception(e, self.identity)
+
+            # Unknown error...
+            raise
+
+          # Start connecting again. Sleep first, avoid busy waiting.
+          self.started = False
+          remaining = waituntil - nonportable.getruntime()
+          if remaining > 0:
+            time.sleep(min(retry_interval, remaining))
+            retry_interval = min(retry_interval * 2, RETRY_INTERVAL)
+
+        if connected:
+          self.result = EmulatedSocket(self.socketobj, self.on_loopback)
+          # The EmulatedSocket owns the socket and its outsocket now
+          self.socketobj = None
+
+          # Tattle the resources used
+          if self.on_loopback:
+            nanny.tattle_quantity('loopsend', 128)
+            nanny.tattle_quantity('looprecv', 64)
+          else:
+            nanny.tattle_quantity('netsend', 128)
+            nanny.tattle_quantity('netrecv', 64)
+
+          return self.result
+
+        # Check if we timed out
+        now = nonportable.getruntime()
+        if now >= self.deadline:
+          raise TimeoutError("Timed-out connecting to the remote host!")
+
+        # Or if the caller is done waiting
+        if now >= waituntil:
+          break
+
+    except Exception, e:
+      # Connecting failed, remember why
+      self._close()
+      self.error = e
+      raise
+
+    raise SocketWouldBlockError("The connection is still in progress!")
+
+
+  def poll(self):
+    """
+    <Purpose>
+      Checks if the connection has been established, without waiting.
+
+    <Arguments>
+      None.
+
+    <Exceptions>
+      SocketWouldBlockError if the connection is still in progress.
+      SocketClosedLocal if cancel() was called.
+      Otherwise, as with openconnection() if connecting failed. The same
+      exception is raised by every later call.
+
+    <Side Effects>
+      None.
+
+    <Resource Consumption>
+      See openconnectionasync().
+
+    <Returns>
+      The socket-like object for the connection. Every call after the
+      connection is established returns the same object.
+    """
+    self.sock_lock.acquire()
+    try:
+      return self._advance(0)
+    finally:
+      self.sock_lock.release()
+
+
+  def wait(self, timeout):
+    """
+    <Purpose>
+      Waits for the connection to be established.
+
+    <Arguments>
+      timeout: The longest time to wait, in seconds. This is separate from
+               the timeout given to openconnectionasync().
+
+    <Exceptions>
+      RepyArgumentError if the timeout is invalid.
+      SocketWouldBlockError if the connection is still in progress after
+      waiting.
+      Otherwise, as with poll().
+
+    <Side Effects>
+      None.
+
+    <Resource Consumption>
+      See openconnectionasync().
+
+    <Returns>
+      The socket-like object for the connection.
+    """
+    if type(timeout) not in [float, int]:
+      raise RepyArgumentError("Provided timeout must be an int or float!")
+    if timeout < 0:
+      raise RepyArgumentError("Provided timeout is not valid, must be non-negative! Timeout: "+str(timeout))
+
+    self.sock_lock.acquire()
+    try:
+      return self._advance(timeout)
+    finally:
+      self.sock_lock.release()
+
+
+  def cancel(self):
+    """
+    <Purpose>
+      Stops trying to connect.
+
+    <Arguments>
+      None.
+
+    <Exceptions>
+      None.
+
+    <Side Effects>
+      Later calls to poll() or wait() raise SocketClosedLocal.
+
+    <Resource Consumption>
+      The outsocket is released.
+
+    <Returns>
+      True if the connection was still in progress, False if it had
+      already been established, failed or been cancelled.
+    """
+    self.sock_lock.acquire()
+    try:
+      if self.result is not None or self.error is not None:
+        return False
+
+      self._close()
+      self.error = SocketClosedLocal("The connection attempt was cancelled!")
+      return True
+
+    finally:
+      self.sock_lock.release()
+
+
+  def __del__(self):
+    # Release the outsocket if the connection was never finished.
+    self.cancel()
+
+
+
+
 class TCPServerSocket (object):
   """
   This object is a wrapper around a listening
@@ -2113,10 +4390,13 @@ class TCPServerSocket (object):
   #            synchronization.
   # on_loopback: true if the remote ip is a loopback address.
   #              this is used for resource accounting.
+  # backlog: The listen backlog of the socket.
+  # in_process_listener: The _InProcessListener for connections from this
+  #                      process, or None if they go through the OS.
   #
 
-  __slots__ = ["socketobj", "on_loopback", "sock_lock"]
-  def __init__(self, sock, on_loopback):
+  __slots__ = ["socketobj", "on_loopback", "sock_lock", "backlog", "in_process_listener"]
+  def __init__(self, sock, on_loopback, backlog):
     """
     <Purpose>
       Initializes the TCPServerSocket. The socket
@@ -2128,6 +4408,8 @@ class TCPServerSocket (object):
       
       on_loopback: True/False based on whether local IP
                    is on loopback or not
+
+      backlog: The backlog that was passed to listen()
       
     <Exceptions>
       None
@@ -2139,6 +4421,8 @@ class TCPServerSocket (object):
     self.socketobj = sock
     self.sock_lock = threading.Lock()
     self.on_loopback = on_loopback     
+    self.backlog = backlog
+    self.in_process_listener = None
 
     # Set the socket to non-blocking
     # locking should be unnecessary because there isn't another external
@@ -2147,6 +4431,35 @@ class TCPServerSocket (object):
         
 
 
+  def _accept(self, listening_socket):
+    """
+    <Purpose>
+      Private accept method. Called when the socket lock is held.
+      In-process connections are accepted first.
+
+    <Arguments>
+      listening_socket: The listening socket object
+
+    <Exceptions>
+      As with socket.accept().
+
+    <Returns>
+      A tuple (socket object, (remote ip, remote port)), as with
+      socket.accept().
+    """
+    listener = self.in_process_listener
+    if listener is not None:
+      _IN_PROCESS_LOCK.acquire()
+      try:
+        if listener.pending:
+          remote_ip, remote_port, endpoint = listener.pending.pop(0)
+          return endpoint, (remote_ip, remote_port)
+      finally:
+        _IN_PROCESS_LOCK.release()
+
+    return listening_socket.accept()
+
+
   def getconnection(self):
     """
     <Purpose>
@@ -2192,7 +4505,7 @@ class TCPServerSocket (object):
         raise KeyError # Indicates socket is closed
 
       # Try to accept
-      new_socket, remote_host_info = socket.accept()
+      new_socket, remote_host_info = self._accept(socket)
       remote_ip, remote_port = remote_host_info
       
       # Get new_socket id to register new_socket with nanny
@@ -2208,7 +4521,7 @@ class TCPServerSocket (object):
         nanny.tattle_quantity('netsend', 64)
 
       try:
-        nanny.tattle_add_item('outsockets', new_sockid)
+        _tattle_add_outsocket(new_sockid)
       except ResourceExhaustedError:
         # Close the socket, and raise
         new_socket.close()
@@ -2246,6 +4559,225 @@ class TCPServerSocket (object):
       socket_lock.release()
 
 
+  def getconnections(self, maxcount):
+    """
+    <Purpose>
+      Accepts up to maxcount incoming connections to a listening TCP
+      socket.
+
+    <Arguments>
+      maxcount: The maximum number of connections to accept.
+
+    <Exceptions>
+      Raises RepyArgumentError if maxcount is not a positive int.
+      Raises SocketClosedLocal if close() has been called.
+      Raises SocketWouldBlockError if there is no connection to accept, or
+          an ECONNABORTED was encountered.
+      Raises ResourcesExhaustedError if there are no free outsockets.
+
+      Once at least one connection was accepted, errors just end the
+      batch. They will be raised by the next call.
+
+    <Resource Consumption>
+      As with getconnection(), for each connection. This is charged once
+      for the whole batch.
+
+    <Returns>
+      A list of (remote ip, remote port, socket object) tuples, in the
+      order the connections were accepted. The list holds at least one
+      connection.
+    """
+    # Check the input arguments (type)
+    if type(maxcount) is not int:
+      raise RepyArgumentError("Provided maxcount must be an int!")
+
+    # Check the input arguments (sanity)
+    if maxcount < 1:
+      raise RepyArgumentError("Provided maxcount must be positive! maxcount: "+str(maxcount))
+
+    # Get the socket lock
+    socket_lock = self.sock_lock
+
+    # Wait for netsend and netrecv resources
+    if self.on_loopback:
+      nanny.tattle_quantity('looprecv',0)
+      nanny.tattle_quantity('loopsend',0)
+    else:
+      nanny.tattle_quantity('netrecv',0)
+      nanny.tattle_quantity('netsend',0)
+
+    # Acquire the lock
+    socket_lock.acquire()
+    try:
+      # Get the socket itself. This must be done after
+      # we acquire the lock because it is possible that the
+      # socket was closed/re-opened or that it was set to None,
+      # etc.
+      listening_socket = self.socketobj
+      if listening_socket is None:
+        raise KeyError # Indicates socket is closed
+
+      connections = []
+
+      # Accepted sockets inherit the buffer size of the listening socket
+      send_buffer_size = None
+
+      try:
+        while len(connections) < maxcount:
+          # Try to accept
+          new_socket, remote_host_info = self._accept(listening_socket)
+          remote_ip, remote_port = remote_host_info
+
+          try:
+            _tattle_add_outsocket(id(new_socket))
+          except ResourceExhaustedError:
+            # Close the socket, and raise
+            new_socket.close()
+            raise
+
+          # Check if remote_ip is on loopback
+          is_on_loopback = _is_loopback_ipaddr(remote_ip)
+
+          # In-process connections have their own buffer size
+          if isinstance(new_socket, _InProcessEndpoint):
+            wrapped_socket = EmulatedSocket(new_socket, is_on_loopback)
+          else:
+            if send_buffer_size is None:
+              send_buffer_size = new_socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+            wrapped_socket = EmulatedSocket(new_socket, is_on_loopback, send_buffer_size)
+          connections.append((remote_ip, remote_port, wrapped_socket))
+
+      except Exception:
+        # Return the connections we have. Any real error will show up again
+        # on the next call.
+        if len(connections) == 0:
+          raise
+
+      # Do some resource accounting
+      count = len(connections)
+      if self.on_loopback:
+        nanny.tattle_quantity('looprecv', 128 * count)
+        nanny.tattle_quantity('loopsend', 64 * count)
+      else:
+        nanny.tattle_quantity('netrecv', 128 * count)
+        nanny.tattle_quantity('netsend', 64 * count)
+
+      # Return everything
+      return connections
+
+    except KeyError:
+      # Socket is closed
+      raise SocketClosedLocal("The socket has been closed!")
+  
+    except RepyException:
+      # Let these through from the inner block
+      raise
+
+    except Exception, e:
+      # Check if this is a would-block error
+      if _is_recoverable_network_exception(e):
+        raise SocketWouldBlockError("No connections currently available!")
+
+      # Check for ECONNABORTED due to client-sent RST
+      elif _is_conn_aborted_exception(e):
+        raise SocketWouldBlockError("The remote side hung up before the connection was established.")
+
+      else: 
+        # Unexpected, close the socket, and then raise SocketClosedLocal
+        _cleanup_socket(self)
+        raise SocketClosedLocal("Unexpected error, socket closed!")
+
+    finally:
+      # Release the lock
+      socket_lock.release()
+
+
+
+  def setsocketoption(self, name, value):
+    """
+    <Purpose>
+      Sets an option on the listening socket. Connections accepted later
+      start out with the same buffer sizes, nodelay and keepalive options.
+
+    <Arguments>
+      name: "backlog" (the number of connections which may wait to be
+            accepted), or any option supported by the setsocketoption()
+            of the sockets returned by getconnection().
+      value: The new value, an int for backlog and the buffer sizes and a
+             bool for the others.
+
+    <Exceptions>
+      RepyArgumentError if the option or value are invalid.
+      ResourceForbiddenError if the buffer sizes may not be changed.
+      SocketClosedLocal if close() has been called.
+
+    <Resource Consumption>
+      The backlog is limited to the listenbacklog resource (or the number
+      of outsockets if that is not set), and buffer sizes are limited to
+      the socketbuffer resource.
+
+    <Returns>
+      The value that was used, after clamping it to the limits.
+    """
+    value = _check_socket_option(name, value, _SERVER_SOCKET_OPTIONS)
+
+    socket_lock = self.sock_lock
+    socket_lock.acquire()
+    try:
+      sock = self.socketobj
+      if sock is None:
+        raise SocketClosedLocal("The socket is closed!")
+
+      if name == "backlog":
+        # Calling listen() again changes the backlog
+        sock.listen(value)
+        self.backlog = value
+        if self.in_process_listener is not None:
+          self.in_process_listener.backlog = value
+      else:
+        _set_socket_option(sock, name, value)
+
+      return value
+
+    finally:
+      socket_lock.release()
+
+
+  def getsocketoption(self, name):
+    """
+    <Purpose>
+      Reads an option of the listening socket.
+
+    <Arguments>
+      name: As with setsocketoption().
+
+    <Exceptions>
+      RepyArgumentError if the option is unknown.
+      SocketClosedLocal if close() has been called.
+
+    <Returns>
+      The value of the option. For the backlog, this is the value that was
+      last set. The others are reported by the OS.
+    """
+    if type(name) is not str or name not in _SERVER_SOCKET_OPTIONS:
+      raise RepyArgumentError("Unknown socket option '"+str(name)+"'!")
+
+    socket_lock = self.sock_lock
+    socket_lock.acquire()
+    try:
+      sock = self.socketobj
+      if sock is None:
+        raise SocketClosedLocal("The socket is closed!")
+
+      if name == "backlog":
+        return self.backlog
+      return _get_socket_option(sock, name)
+
+    finally:
+      socket_lock.release()
+
+
+
   def close(self):
     """
     <Purpose>
@@ -2273,6 +4805,11 @@ class TCPServerSocket (object):
     # Acquire the lock
     socket_lock.acquire()
     try:
+      # Stop accepting in-process connections
+      if self.in_process_listener is not None:
+        _stop_listening_in_process(self.in_process_listener)
+        self.in_process_listener = None
+
       # Clean up the socket
       _cleanup_socket(self)
       # Replace the socket
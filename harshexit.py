@@ -24,6 +24,9 @@ except:
 # need for status retrieval
 import statusstorage
 
+# needed to write out the API profile, if there is one
+import apiprofiler
+
 # This prevents writes to the nanny's status information after we want to stop
 statuslock = statusstorage.statuslock
 
@@ -111,6 +114,13 @@ def harshexit(val):
 
     # We intentionally do not release the lock.   We don't want anyone else 
     # writing over our status information (we're killing them).
+
+    # If the API calls were profiled, this is the last chance to write out
+    # what we know. This does nothing unless profiling was enabled.
+    try:
+      apiprofiler.write_report()
+    except Exception:
+      pass
     
 
   if ostype == 'Linux':
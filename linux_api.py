@@ -10,6 +10,10 @@ Description:
 """
 
 import os           # Provides some convenience functions
+import ctypes       # Allows us to make C calls
+import socket       # Needed for the batched datagram calls
+import struct       # Decodes the addresses in /proc/net
+import time         # Provides time.time
 
 import nix_common_api as nix_api # Import the Common API
 
@@ -25,13 +29,16 @@ if "64" in architecture[0]:
   running_32bit = False
 
 # Manually import the common functions we want
-exists_outgoing_network_socket = nix_api.exists_outgoing_network_socket
-exists_listening_network_socket = nix_api.exists_listening_network_socket
 get_available_interfaces = nix_api.get_available_interfaces
+get_interface_ip_addresses = nix_api.get_interface_ip_addresses
 
 # Libc
 libc = nix_api.libc
 
+# A second handle on libc which saves errno for us, this is needed by the
+# socket calls below which must report the reason they failed
+libc_with_errno = ctypes.CDLL(libc._name, use_errno=True)
+
 # Functions
 myopen = open # This is an annoying restriction of repy
 syscall = libc.syscall # syscall function
@@ -319,41 +326,581 @@ def get_system_thread_count():
 
 
 
-def get_interface_ip_addresses(interfaceName):
+# rtnetlink multicast groups from <linux/rtnetlink.h>
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+
+def get_address_change_socket():
   """
   <Purpose>
-    Returns the IP address associated with the interface.
-  
+    Opens a non-blocking rtnetlink socket which becomes readable whenever
+    a network link goes up or down, an IPv4 address is added or removed,
+    or an IPv4 route changes (which can change the address getmyip()
+    picks, e.g. a new default route on another interface). The messages themselves are not needed, only the fact that
+    something changed.
+
   <Arguments>
-    interfaceName: The string name of the interface, e.g. eth0
-  
+    None
+
+  <Exceptions>
+    None
+
   <Returns>
-    A list of IP addresses associated with the interface.
+    A socket.socket object, or None if rtnetlink is not available.
   """
+  try:
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+  except (AttributeError, socket.error):
+    return None
 
-  # Launch up a shell, get the feed back
-  # We use ifconfig with the interface name.
-  ifconfig_process = portable_popen.Popen(["/sbin/ifconfig", interfaceName.strip()])
+  try:
+    sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+    sock.setblocking(0)
+  except socket.error:
+    sock.close()
+    return None
 
-  ifconfig_output, _ = ifconfig_process.communicate()
-  ifconfig_lines = textops.textops_rawtexttolines(ifconfig_output)
-  
-  # Look for ipv4 addresses
-  target_lines = textops.textops_grep("inet", ifconfig_lines)
-  # and not ipv6
-  target_lines = textops.textops_grep("inet6", target_lines, exclude=True)
+  return sock
 
-  # Only take the ip(s)
-  target_lines = textops.textops_cut(target_lines, delimiter=":", fields=[1])
-  target_lines = textops.textops_cut(target_lines, delimiter=" ", fields=[0])
 
-  # Create an array for the ip's
-  ipaddressList = []
-  
-  for line in target_lines:
-     # Strip the newline and any spacing
-     line = line.strip("\n\t ")
-     ipaddressList.append(line)
 
-  # Done, return the interfaces
-  return ipaddressList
+##### Batched datagram calls
+
+# recvmmsg() has been available since glibc 2.12. If it is missing,
+# callers should loop over recvfrom() instead.
+try:
+  _recvmmsg = libc_with_errno.recvmmsg
+except AttributeError:
+  _recvmmsg = None
+
+# Lets emulcomm know if MessageReceiveVector can be used
+recvmmsg_available = _recvmmsg is not None
+
+# sendmmsg() has been available since glibc 2.14. If it is missing,
+# callers should loop over sendto() instead.
+try:
+  _sendmmsg = libc_with_errno.sendmmsg
+except AttributeError:
+  _sendmmsg = None
+
+# Lets emulcomm know if send_messages() can be used
+sendmmsg_available = _sendmmsg is not None
+
+
+# These mirror the structures from <sys/socket.h> and <netinet/in.h>
+class _sockaddr_in(ctypes.Structure):
+  _fields_ = [("sin_family", ctypes.c_ushort),
+              ("sin_port", ctypes.c_ushort),
+              ("sin_addr", ctypes.c_ubyte * 4),
+              ("sin_zero", ctypes.c_ubyte * 8)]
+
+class _iovec(ctypes.Structure):
+  _fields_ = [("iov_base", ctypes.c_void_p),
+              ("iov_len", ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+  _fields_ = [("msg_name", ctypes.c_void_p),
+              ("msg_namelen", ctypes.c_uint),
+              ("msg_iov", ctypes.POINTER(_iovec)),
+              ("msg_iovlen", ctypes.c_size_t),
+              ("msg_control", ctypes.c_void_p),
+              ("msg_controllen", ctypes.c_size_t),
+              ("msg_flags", ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+  _fields_ = [("msg_hdr", _msghdr),
+              ("msg_len", ctypes.c_uint)]
+
+
+if _recvmmsg is not None:
+  _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint,
+                        ctypes.c_int, ctypes.c_void_p]
+  _recvmmsg.restype = ctypes.c_int
+
+if _sendmmsg is not None:
+  _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint,
+                        ctypes.c_int]
+  _sendmmsg.restype = ctypes.c_int
+
+
+def _raise_socket_error():
+  # Convert the saved errno into the socket.error python would have raised
+  errornum = ctypes.get_errno()
+  raise socket.error(errornum, os.strerror(errornum))
+
+
+class MessageReceiveVector(object):
+  """
+  A set of receive buffers which can be handed to recvmmsg() over and
+  over again. Allocating this once per socket avoids allocating a new
+  buffer for every datagram.
+  """
+
+  def __init__(self, count, buffersize):
+    """
+    <Purpose>
+      Allocates the buffers and wires up the message headers.
+
+    <Arguments>
+      count: The number of datagrams that can be received per call.
+      buffersize: The maximum size of each datagram.
+    """
+    self.count = count
+    self.buffers = ((ctypes.c_char * buffersize) * count)()
+    self.addresses = (_sockaddr_in * count)()
+    self.iovecs = (_iovec * count)()
+    self.headers = (_mmsghdr * count)()
+
+    for index in range(count):
+      self.iovecs[index].iov_base = ctypes.addressof(self.buffers[index])
+      self.iovecs[index].iov_len = buffersize
+
+      header = self.headers[index].msg_hdr
+      header.msg_name = ctypes.addressof(self.addresses[index])
+      header.msg_iov = ctypes.cast(ctypes.addressof(self.iovecs[index]), ctypes.POINTER(_iovec))
+      header.msg_iovlen = 1
+
+
+  def receive(self, sockobj, maxcount):
+    """
+    <Purpose>
+      Receives up to maxcount datagrams from a socket without blocking.
+
+    <Arguments>
+      sockobj: A bound UDP socket.socket object.
+      maxcount: The maximum number of datagrams to receive. This is
+                capped at the number of buffers.
+
+    <Exceptions>
+      socket.error as recvfrom() would raise, e.g. EAGAIN if there are
+      no datagrams waiting.
+
+    <Returns>
+      A list of (remote ip, remote port, message) tuples.
+    """
+    count = min(maxcount, self.count)
+
+    # The address length is a value-result argument, so reset it
+    addresslength = ctypes.sizeof(_sockaddr_in)
+    for index in range(count):
+      self.headers[index].msg_hdr.msg_namelen = addresslength
+
+    received = _recvmmsg(sockobj.fileno(), self.headers, count, socket.MSG_DONTWAIT, None)
+    if received < 0:
+      _raise_socket_error()
+
+    messages = []
+    for index in range(received):
+      address = self.addresses[index]
+      remoteip = "%d.%d.%d.%d" % tuple(address.sin_addr)
+      remoteport = socket.ntohs(address.sin_port)
+      message = ctypes.string_at(ctypes.addressof(self.buffers[index]), self.headers[index].msg_len)
+      messages.append((remoteip, remoteport, message))
+
+    return messages
+
+
+
+def send_messages(sockobj, messages):
+  """
+  <Purpose>
+    Sends a batch of datagrams from a socket with a single sendmmsg() call.
+
+  <Arguments>
+    sockobj: A bound UDP socket.socket object.
+    messages: A list of (destination ip, destination port, message) tuples.
+              The IPs must be IPv4 addresses in dotted quad form.
+
+  <Exceptions>
+    socket.error as sendto() would raise if the first datagram could not
+    be sent.
+
+  <Returns>
+    A list with the number of bytes sent for each datagram that was sent.
+    This may be shorter than messages, in which case the caller should
+    retry the rest.
+  """
+  count = len(messages)
+  addresses = (_sockaddr_in * count)()
+  iovecs = (_iovec * count)()
+  headers = (_mmsghdr * count)()
+
+  # The message strings must stay referenced until the call returns
+  payloads = []
+
+  for index in range(count):
+    destip, destport, message = messages[index]
+
+    address = addresses[index]
+    address.sin_family = socket.AF_INET
+    address.sin_port = socket.htons(destport)
+    address.sin_addr = (ctypes.c_ubyte * 4)(*map(ord, socket.inet_aton(destip)))
+
+    payload = ctypes.c_char_p(message)
+    payloads.append(payload)
+    iovecs[index].iov_base = ctypes.cast(payload, ctypes.c_void_p)
+    iovecs[index].iov_len = len(message)
+
+    header = headers[index].msg_hdr
+    header.msg_name = ctypes.addressof(address)
+    header.msg_namelen = ctypes.sizeof(_sockaddr_in)
+    header.msg_iov = ctypes.cast(ctypes.addressof(iovecs[index]), ctypes.POINTER(_iovec))
+    header.msg_iovlen = 1
+
+  sent = _sendmmsg(sockobj.fileno(), headers, count, 0)
+  if sent < 0:
+    _raise_socket_error()
+
+  bytessent = []
+  for index in range(sent):
+    bytessent.append(headers[index].msg_len)
+
+  return bytessent
+
+
+
+##### Zero-copy file transfers
+
+# sendfile() copies from a file to a socket within the kernel. We use the
+# 64-bit version so that large offsets work on 32-bit systems too.
+try:
+  _sendfile = libc_with_errno.sendfile64
+except AttributeError:
+  _sendfile = None
+
+# Lets emulcomm know if send_file() can be used
+sendfile_available = _sendfile is not None
+
+if _sendfile is not None:
+  _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                        ctypes.c_size_t]
+  _sendfile.restype = ctypes.c_ssize_t
+
+
+def send_file(sockobj, fileobj, offset, count):
+  """
+  <Purpose>
+    Sends part of a file on a connected socket with sendfile(), so the
+    data is not copied into python.
+
+  <Arguments>
+    sockobj: A connected TCP socket.socket object.
+    fileobj: A python file object which is open for reading.
+    offset: The offset in the file to start sending from.
+    count: The maximum number of bytes to send.
+
+  <Exceptions>
+    socket.error as send() would raise.
+
+  <Returns>
+    The number of bytes sent. This is 0 at the end of the file.
+  """
+  fileoffset = ctypes.c_longlong(offset)
+  sent = _sendfile(sockobj.fileno(), fileobj.fileno(), ctypes.byref(fileoffset), count)
+  if sent < 0:
+    _raise_socket_error()
+
+  return sent
+
+
+
+##### TCP connection information
+
+# getsockopt(TCP_INFO) fills in a struct tcp_info from <linux/tcp.h>. We
+# only decode the start of it, which is the same since Linux 2.6: 8 bytes
+# of small fields, then 24 unsigned ints.
+_TCP_INFO = getattr(socket, "TCP_INFO", 11)
+_TCP_INFO_FORMAT = "=8B24I"
+_TCP_INFO_SIZE = struct.calcsize(_TCP_INFO_FORMAT)
+
+
+def get_tcp_info(sockobj):
+  """
+  <Purpose>
+    Reads what the kernel knows about a TCP connection.
+
+  <Arguments>
+    sockobj: A connected TCP socket.socket object.
+
+  <Exceptions>
+    socket.error as getsockopt() would raise.
+
+  <Returns>
+    A dictionary with the smoothed round trip time ("rtt") and its
+    variance ("rttvariance") in seconds, the retransmits of the current
+    segment ("retransmits") and of the whole connection
+    ("totalretransmits"), the congestion window in segments
+    ("congestionwindow"), the sending MSS in bytes ("mss") and the
+    number of segments which are not acknowledged yet ("unacked").
+    None if the kernel returned less than expected.
+  """
+  data = sockobj.getsockopt(socket.IPPROTO_TCP, _TCP_INFO, _TCP_INFO_SIZE)
+  if len(data) < _TCP_INFO_SIZE:
+    return None
+
+  fields = struct.unpack(_TCP_INFO_FORMAT, data[:_TCP_INFO_SIZE])
+
+  # The times are in microseconds
+  return {"rtt" : fields[23] / 1000000.0,
+          "rttvariance" : fields[24] / 1000000.0,
+          "retransmits" : fields[2],
+          "totalretransmits" : fields[31],
+          "congestionwindow" : fields[26],
+          "mss" : fields[10],
+          "unacked" : fields[12]}
+
+
+
+##### Socket table
+
+# Maps the state numbers in /proc/net/tcp to the names netstat uses
+TCP_STATES = {
+"01":"ESTABLISHED",
+"02":"SYN_SENT",
+"03":"SYN_RECV",
+"04":"FIN_WAIT1",
+"05":"FIN_WAIT2",
+"06":"TIME_WAIT",
+"07":"CLOSE",
+"08":"CLOSE_WAIT",
+"09":"LAST_ACK",
+"0A":"LISTEN",
+"0B":"CLOSING"
+}
+
+# Addresses which mean "every local address"
+WILDCARD_ADDRESSES = ["0.0.0.0", "::"]
+
+# How long (in seconds) a parsed socket table may be reused by lookups
+# which don't need a fresh one. A lookup right after a failed bind or
+# connect always needs a fresh table, since an older one does not show
+# the socket that caused the failure.
+SOCKET_TABLE_CACHE_TIME = 0.5
+
+# The last socket table, and when it was read
+last_socket_table = None
+last_socket_table_time = 0.0
+
+
+def _decode_proc_net_address(address):
+  # Converts "0100007F:3039" into ("127.0.0.1", 12345). The address is
+  # printed as 32 bit words in host byte order, the port in hex.
+  hexip, hexport = address.split(":")
+
+  words = []
+  for index in range(0, len(hexip), 8):
+    words.append(struct.pack("=I", int(hexip[index:index+8], 16)))
+  packedip = "".join(words)
+
+  if len(packedip) == 4:
+    ip = socket.inet_ntop(socket.AF_INET, packedip)
+  else:
+    ip = socket.inet_ntop(socket.AF_INET6, packedip)
+    # IPv4 addresses on a dual stack socket look like ::ffff:127.0.0.1
+    if ip.startswith("::ffff:") and "." in ip:
+      ip = ip[len("::ffff:"):]
+
+  return (ip, int(hexport, 16))
+
+
+def parse_proc_net_sockets(contents):
+  """
+  <Purpose>
+    Parses the contents of /proc/net/tcp, tcp6, udp or udp6.
+
+  <Arguments>
+    contents: The text of the file
+
+  <Returns>
+    A list of (local ip, local port, remote ip, remote port, state) tuples.
+    The state is named as netstat would name it, e.g. "LISTEN".
+  """
+  records = []
+
+  # Skip the header line
+  for line in contents.split("\n")[1:]:
+    parts = line.split()
+    if len(parts) < 4:
+      continue
+
+    localip, localport = _decode_proc_net_address(parts[1])
+    remoteip, remoteport = _decode_proc_net_address(parts[2])
+    state = TCP_STATES.get(parts[3].upper(), parts[3])
+
+    records.append((localip, localport, remoteip, remoteport, state))
+
+  return records
+
+
+class SocketTable(object):
+  """
+  The system's sockets, indexed for the lookups done by
+  exists_outgoing_network_socket and exists_listening_network_socket.
+  """
+
+  def __init__(self, tcp_records, udp_records):
+    """
+    <Purpose>
+      Builds the indexes.
+
+    <Arguments>
+      tcp_records: The TCP sockets, as returned by parse_proc_net_sockets
+      udp_records: The UDP sockets, as returned by parse_proc_net_sockets
+    """
+    # Maps (local ip, local port, remote ip, remote port) to the state
+    self.connections = {}
+    # The (local ip, local port) of each listening TCP socket
+    self.tcp_listening = set()
+    # The (local ip, local port) of each UDP socket
+    self.udp_bound = set()
+
+    for (localip, localport, remoteip, remoteport, state) in tcp_records:
+      if state == "LISTEN":
+        self.tcp_listening.add((localip, localport))
+      else:
+        self.connections[(localip, localport, remoteip, remoteport)] = state
+
+    for (localip, localport, remoteip, remoteport, state) in udp_records:
+      self.udp_bound.add((localip, localport))
+
+
+  def get_connection_state(self, localip, localport, remoteip, remoteport):
+    """
+    <Purpose>
+      Looks up a TCP connection by its unique tuple.
+
+    <Returns>
+      The state of the connection, or None if there is no such connection.
+    """
+    return self.connections.get((localip, localport, remoteip, remoteport))
+
+
+  def is_listening(self, ip, port, tcp):
+    """
+    <Purpose>
+      Determines if a listening TCP socket (or any UDP socket) is bound
+      to an IP and port, either directly or through a wildcard address.
+
+    <Returns>
+      True or False.
+    """
+    if tcp:
+      bound = self.tcp_listening
+    else:
+      bound = self.udp_bound
+
+    if (ip, port) in bound:
+      return True
+
+    for wildcard in WILDCARD_ADDRESSES:
+      if (wildcard, port) in bound:
+        return True
+
+    return False
+
+
+
+def _read_proc_net_file(name):
+  # Returns the records from /proc/net/<name>. The IPv6 files are missing
+  # if IPv6 is disabled.
+  try:
+    fileobj = myopen("/proc/net/" + name, "r")
+  except IOError:
+    return []
+
+  try:
+    return parse_proc_net_sockets(fileobj.read())
+  finally:
+    fileobj.close()
+
+
+def get_socket_table(refresh=True):
+  """
+  <Purpose>
+    Returns a SocketTable for the system's sockets, which is read from
+    /proc/net.
+
+  <Arguments>
+    refresh: If this is False, the table from the previous call is reused
+             if it is less than SOCKET_TABLE_CACHE_TIME seconds old.
+
+  <Returns>
+    A SocketTable, or None if /proc/net is not available.
+  """
+  global last_socket_table
+  global last_socket_table_time
+
+  now = time.time()
+  table = last_socket_table
+  if not refresh and table is not None and 0 <= now - last_socket_table_time < SOCKET_TABLE_CACHE_TIME:
+    return table
+
+  if not os.path.exists("/proc/net/tcp"):
+    return None
+
+  table = SocketTable(_read_proc_net_file("tcp") + _read_proc_net_file("tcp6"),
+                      _read_proc_net_file("udp") + _read_proc_net_file("udp6"))
+
+  last_socket_table = table
+  last_socket_table_time = now
+  return table
+
+
+
+def exists_outgoing_network_socket(localip, localport, remoteip, remoteport):
+  """
+  <Purpose>
+    Determines if there exists a network socket with the specified unique tuple.
+    Assumes TCP.
+
+  <Arguments>
+    localip: The IP address of the local socket
+    localport: The port of the local socket
+    remoteip:  The IP of the remote host
+    remoteport: The port of the remote host
+    
+  <Returns>
+    A Tuple, indicating the existence and state of the socket. E.g. (Exists (True/False), State (String or None))
+
+  """
+  # This only works if all are not of the None type
+  if not (localip and localport and remoteip and remoteport):
+    return (False, None)
+
+  # This is the first lookup after an address conflict, so the table must
+  # include the socket which caused it
+  table = get_socket_table(refresh=True)
+  if table is None:
+    return nix_api.exists_outgoing_network_socket(localip, localport, remoteip, remoteport)
+
+  state = table.get_connection_state(localip, localport, remoteip, remoteport)
+  return (state is not None, state)
+
+
+
+def exists_listening_network_socket(ip, port, tcp):
+  """
+  <Purpose>
+    Determines if there exists a network socket with the specified ip and port which is the LISTEN state.
+  
+  <Arguments>
+    ip: The IP address of the listening socket
+    port: The port of the listening socket
+    tcp: Is the socket of TCP type, else UDP
+    
+  <Returns>
+    True or False.
+  """
+  # This only works if both are not of the None type
+  if not (ip and port):
+    return False
+
+  # This is only looked up right after exists_outgoing_network_socket()
+  # (see emulcomm's _conn_cleanup_check), so the table it just read can be
+  # reused
+  table = get_socket_table(refresh=False)
+  if table is None:
+    return nix_api.exists_listening_network_socket(ip, port, tcp)
+
+  return table.is_listening(ip, port, tcp)
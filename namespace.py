@@ -22,8 +22,8 @@
   dealing with have been wrapped by this namespace layer.
   
   All of our own api functions are wrapped in NamespaceAPIFunctionWrapper
-  objects whose wrapped_function() method is mapped in to the untrusted
-  code's context. When called, the wrapped_function() method performs
+  objects whose wrapped_function() is mapped in to the untrusted
+  code's context. When called, the wrapped_function() performs
   argument, return value, and exception validation as well as additional
   wrapping and unwrapping, as needed, that is specific to the function
   that was ultimately being called. If the return value or raised exceptions
@@ -81,6 +81,7 @@
     TCP_SOCKET_OBJECT_WRAPPER_INFO
     TCP_SERVER_SOCKET_OBJECT_WRAPPER_INFO
     UDP_SERVER_SOCKET_OBJECT_WRAPPER_INFO
+    PENDING_CONNECTION_OBJECT_WRAPPER_INFO
     VIRTUAL_NAMESPACE_OBJECT_WRAPPER_INFO
     
       The above four dictionaries define the methods available on the wrapped
@@ -96,14 +97,15 @@
       are never actually allowed in untrusted code. Rather, each function that
       is wrapped has a single NamespaceAPIFunctionWrapper instance created
       when wrap_and_insert_api_functions() is called and what is actually made
-      available to the untrusted code is the wrapped_function() method of each
-      of the corresponding NamespaceAPIFunctionWrapper instances.
+      available to the untrusted code is the wrapped_function() of each of the
+      corresponding NamespaceAPIFunctionWrapper instances. This is built when
+      the instance is created, specialized for the function's signature.
       
     NamespaceInternalError
     
       If this error is raised anywhere (along with any other unexpected exceptions),
       it should result in termination of the running program (see the except blocks
-      in NamespaceAPIFunctionWrapper.wrapped_function).
+      in NamespaceAPIFunctionWrapper._make_wrapped_function).
 """
 
 import types
@@ -111,6 +113,7 @@ import types
 # To check if objects are thread.LockType objects.
 import thread
 
+import apiprofiler
 import emulcomm
 import emulfile
 import emulmisc
@@ -145,7 +148,7 @@ def wrap_and_insert_api_functions(usercontext):
 
   for function_name in USERCONTEXT_WRAPPER_INFO:
     function_info = USERCONTEXT_WRAPPER_INFO[function_name]
-    wrapperobj = NamespaceAPIFunctionWrapper(function_info)
+    wrapperobj = NamespaceAPIFunctionWrapper(function_info, name=function_name)
     usercontext[function_name] = wrapperobj.wrapped_function
 
 
@@ -181,6 +184,7 @@ lock_object_wrapped_functions_dict = {}
 tcp_socket_object_wrapped_functions_dict = {}
 tcp_server_socket_object_wrapped_functions_dict = {}
 udp_server_socket_object_wrapped_functions_dict = {}
+pending_connection_object_wrapped_functions_dict = {}
 virtual_namespace_object_wrapped_functions_dict = {}
 
 def _prepare_wrapped_functions_for_object_wrappers():
@@ -190,17 +194,21 @@ def _prepare_wrapped_functions_for_object_wrappers():
   file_object_wrapped_functions_dict have been populated and therefore can be
   used by functions such as wrap_socket_obj().
   """
-  objects_tuples = [(FILE_OBJECT_WRAPPER_INFO, file_object_wrapped_functions_dict),
-                    (LOCK_OBJECT_WRAPPER_INFO, lock_object_wrapped_functions_dict),
-                    (TCP_SOCKET_OBJECT_WRAPPER_INFO, tcp_socket_object_wrapped_functions_dict),
-                    (TCP_SERVER_SOCKET_OBJECT_WRAPPER_INFO, tcp_server_socket_object_wrapped_functions_dict),
-                    (UDP_SERVER_SOCKET_OBJECT_WRAPPER_INFO, udp_server_socket_object_wrapped_functions_dict),
-                    (VIRTUAL_NAMESPACE_OBJECT_WRAPPER_INFO, virtual_namespace_object_wrapped_functions_dict)]
-
-  for description_dict, wrapped_func_dict in objects_tuples:
+  # The first item of each tuple is the prefix of the method names in the
+  # API profile (see apiprofiler.py).
+  objects_tuples = [("file", FILE_OBJECT_WRAPPER_INFO, file_object_wrapped_functions_dict),
+                    ("lock", LOCK_OBJECT_WRAPPER_INFO, lock_object_wrapped_functions_dict),
+                    ("tcpsocket", TCP_SOCKET_OBJECT_WRAPPER_INFO, tcp_socket_object_wrapped_functions_dict),
+                    ("tcpserversocket", TCP_SERVER_SOCKET_OBJECT_WRAPPER_INFO, tcp_server_socket_object_wrapped_functions_dict),
+                    ("udpserversocket", UDP_SERVER_SOCKET_OBJECT_WRAPPER_INFO, udp_server_socket_object_wrapped_functions_dict),
+                    ("pendingconnection", PENDING_CONNECTION_OBJECT_WRAPPER_INFO, pending_connection_object_wrapped_functions_dict),
+                    ("virtualnamespace", VIRTUAL_NAMESPACE_OBJECT_WRAPPER_INFO, virtual_namespace_object_wrapped_functions_dict)]
+
+  for object_name, description_dict, wrapped_func_dict in objects_tuples:
     for function_name in description_dict:
       function_info = description_dict[function_name]
-      wrapperobj = NamespaceAPIFunctionWrapper(function_info, is_method=True)
+      wrapperobj = NamespaceAPIFunctionWrapper(function_info, is_method=True,
+          name=object_name + "." + function_name)
       wrapped_func_dict[function_name] = wrapperobj.wrapped_function
 
 
@@ -280,6 +288,10 @@ class ObjectProcessor(BaseProcessor):
     raise NotImplementedError
 
   def unwrap(self, val):
+    # Objects are only passed back in through the wrapper they were given
+    # out in
+    if not isinstance(val, NamespaceObjectWrapper):
+      raise RepyArgumentError("Invalid type %s" % type(val))
     return val._wrapped__object
 
 
@@ -340,6 +352,19 @@ class NoneOrInt(ValueProcessor):
 
 
 
+class IntOrBool(ValueProcessor):
+  """Allows an int, long or bool. This doesn't enforce min limit on the
+  ints."""
+
+  def check(self, val):
+    if not _is_in(type(val), [int, long, bool]):
+      raise RepyArgumentError("Invalid type %s" % type(val))
+
+
+
+
+
+
 class StrOrInt(ValueProcessor):
   """Allows a string or int. This doesn't enforce max/min/length limits on the
   strings and ints."""
@@ -545,6 +570,51 @@ class TCPSocket(ObjectProcessor):
 
 
 
+class ListOfConnections(ObjectProcessor):
+  """Allows lists of (remote ip, remote port, TCPSocket) tuples, as returned
+  by TCPServerSocket.getconnections(). The ips and ports are immutable so
+  only the sockets need wrapping."""
+
+  def check(self, val):
+    if type(val) is not list:
+      raise RepyArgumentError("Invalid type %s" % type(val))
+
+    for item in val:
+      if type(item) is not tuple or len(item) != 3:
+        raise RepyArgumentError("Invalid connection %s" % type(item))
+      Str().check(item[0])
+      Int().check(item[1])
+      TCPSocket().check(item[2])
+
+
+
+  def wrap(self, val):
+    wrapped = []
+    for (remote_ip, remote_port, sock) in val:
+      wrapped.append((remote_ip, remote_port, TCPSocket().wrap(sock)))
+    return wrapped
+
+
+
+
+
+class PendingConnection(ObjectProcessor):
+  """Allows PendingConnection objects."""
+
+  def check(self, val):
+    if not isinstance(val, emulcomm.PendingConnection):
+      raise RepyArgumentError("Invalid type %s" % type(val))
+
+
+
+  def wrap(self, val):
+    return NamespaceObjectWrapper("PendingConnection", val,
+                                  pending_connection_object_wrapped_functions_dict)
+
+
+
+
+
 class VirtualNamespace(ObjectProcessor):
   """Allows VirtualNamespace objects."""
 
@@ -609,6 +679,10 @@ USERCONTEXT_WRAPPER_INFO = {
       {'func' : emulcomm.sendmessage,
        'args' : [Str(), Int(), Str(), Str(), Int()],
        'return' : Int()},
+  'sendmessages' :
+      {'func' : emulcomm.sendmessages,
+       'args' : [Str(), Int(), List()],
+       'return' : List()},
   'listenformessage' :
       {'func' : emulcomm.listenformessage,
        'args' : [Str(), Int()],
@@ -619,6 +693,10 @@ USERCONTEXT_WRAPPER_INFO = {
 #      'raise' : [AddressBindingError, PortRestrictedError, PortInUseError,
 #                 ConnectionRefusedError, TimeoutError, RepyArgumentError],
        'return' : TCPSocket()},
+  'openconnectionasync' :
+      {'func' : emulcomm.openconnectionasync,
+       'args' : [Str(), Int(), Str(), Int(), Float()],
+       'return' : PendingConnection()},
   'listenforconnection' :
       {'func' : emulcomm.listenforconnection,
        'args' : [Str(), Int()],
@@ -705,6 +783,22 @@ TCP_SOCKET_OBJECT_WRAPPER_INFO = {
       {'func' : emulcomm.EmulatedSocket.send,
        'args' : [Str()],
        'return' : Int(min=0)},
+  'sendfile' :
+      {'func' : emulcomm.EmulatedSocket.sendfile,
+       'args' : [File(), Int(min=0), Int(min=0)],
+       'return' : Int(min=0)},
+  'getstatistics' :
+      {'func' : emulcomm.EmulatedSocket.getstatistics,
+       'args' : [],
+       'return' : Dict()},
+  'setsocketoption' :
+      {'func' : emulcomm.EmulatedSocket.setsocketoption,
+       'args' : [Str(), IntOrBool()],
+       'return' : IntOrBool()},
+  'getsocketoption' :
+      {'func' : emulcomm.EmulatedSocket.getsocketoption,
+       'args' : [Str()],
+       'return' : IntOrBool()},
 }
 
 # TODO: Figure out which real object should be wrapped. It doesn't appear
@@ -718,6 +812,18 @@ TCP_SERVER_SOCKET_OBJECT_WRAPPER_INFO = {
       {'func' : emulcomm.TCPServerSocket.getconnection,
        'args' : [],
        'return' : (Str(), Int(), TCPSocket())},
+  'getconnections' :
+      {'func' : emulcomm.TCPServerSocket.getconnections,
+       'args' : [Int(min=1)],
+       'return' : ListOfConnections()},
+  'setsocketoption' :
+      {'func' : emulcomm.TCPServerSocket.setsocketoption,
+       'args' : [Str(), IntOrBool()],
+       'return' : IntOrBool()},
+  'getsocketoption' :
+      {'func' : emulcomm.TCPServerSocket.getsocketoption,
+       'args' : [Str()],
+       'return' : IntOrBool()},
 }
 
 UDP_SERVER_SOCKET_OBJECT_WRAPPER_INFO = {
@@ -729,6 +835,25 @@ UDP_SERVER_SOCKET_OBJECT_WRAPPER_INFO = {
       {'func' : emulcomm.UDPServerSocket.getmessage,
        'args' : [],
        'return' : (Str(), Int(), Str())},
+  'getmessages' :
+      {'func' : emulcomm.UDPServerSocket.getmessages,
+       'args' : [Int(min=1)],
+       'return' : List()},
+}
+
+PENDING_CONNECTION_OBJECT_WRAPPER_INFO = {
+  'poll' :
+      {'func' : emulcomm.PendingConnection.poll,
+       'args' : [],
+       'return' : TCPSocket()},
+  'wait' :
+      {'func' : emulcomm.PendingConnection.wait,
+       'args' : [Float()],
+       'return' : TCPSocket()},
+  'cancel' :
+      {'func' : emulcomm.PendingConnection.cancel,
+       'args' : [],
+       'return' : Bool()},
 }
 
 LOCK_OBJECT_WRAPPER_INFO = {
@@ -761,6 +886,31 @@ VIRTUAL_NAMESPACE_OBJECT_WRAPPER_INFO = {
 # The classes we define from which actual wrappers are instantiated.
 ##############################################################################
 
+# Types whose values are passed through _copy unchanged, either because they
+# are immutable or because they are handles that must not be duplicated (see
+# _copy_value). The table is keyed by the id of the type rather than by the
+# type itself so that a lookup is always an identity check and never calls
+# into __eq__ or __hash__ of some type the user created.
+#
+# types.InstanceType is included because the user can provide an instance
+# of a class of their own in the list of callback args to settimer.
+_UNCOPIED_TYPE_IDS = {}
+for _uncopied_type in [str, unicode, int, long, float, complex, bool,
+                       frozenset, types.NoneType, types.FunctionType,
+                       types.LambdaType, types.MethodType, types.InstanceType]:
+  _UNCOPIED_TYPE_IDS[_saved_id(_uncopied_type)] = True
+del _uncopied_type
+
+# Objects of these types (and subclasses) are not copied either. This is
+# because copying an emulated file object, for example, will cause the
+# destructor of the original one to be invoked, which will close the actual
+# underlying file. As the object is wrapped and the client does not have
+# access to it, it's safe to not wrap it. This is filled in after the
+# NamespaceObjectWrapper is defined.
+_UNCOPIED_HANDLE_TYPES = ()
+
+
+
 def _copy(obj, objectmap=None):
   """
   <Purpose>
@@ -782,107 +932,155 @@ def _copy(obj, objectmap=None):
       function call.
   <Side Effects>
     A new reference is created to every non-simple type of object. That is,
-    everything except objects of type str, unicode, int, etc.
+    everything except objects of type str, unicode, int, etc. Tuples that
+    only contain such objects (directly or through other tuples) are not
+    copied either, as there is nothing in them that could be modified.
   <Returns>
     The deep copy of obj with circular/recursive references preserved.
   """
+  # Most arguments and return values are plain strings and numbers, so check
+  # for those before setting up anything else.
+  if _saved_id(type(obj)) in _UNCOPIED_TYPE_IDS:
+    return obj
+
   try:
     # If this is a top-level call to _copy, create a new objectmap for use
-    # by recursive calls to _copy.
+    # by recursive calls.
     if objectmap is None:
       objectmap = {}
-    # If this is a circular reference, use the copy we already made.
-    elif _saved_id(obj) in objectmap:
-      return objectmap[_saved_id(obj)]
-
-    # types.InstanceType is included because the user can provide an instance
-    # of a class of their own in the list of callback args to settimer.
-    if _is_in(type(obj), [str, unicode, int, long, float, complex, bool, frozenset,
-                          types.NoneType, types.FunctionType, types.LambdaType,
-                          types.MethodType, types.InstanceType]):
-      return obj
-
-    elif type(obj) is list:
-      temp_list = []
-      # Need to save this in the objectmap before recursing because lists
-      # might have circular references.
-      objectmap[_saved_id(obj)] = temp_list
-
-      for item in obj:
-        temp_list.append(_copy(item, objectmap))
-
-      return temp_list
-
-    elif type(obj) is tuple:
-      temp_list = []
-
-      for item in obj:
-        temp_list.append(_copy(item, objectmap))
-
-      # I'm not 100% confident on my reasoning here, so feel free to point
-      # out where I'm wrong: There's no way for a tuple to directly contain
-      # a circular reference to itself. Instead, it has to contain, for
-      # example, a dict which has the same tuple as a value. In that
-      # situation, we can avoid infinite recursion and properly maintain
-      # circular references in our copies by checking the objectmap right
-      # after we do the copy of each item in the tuple. The existence of the
-      # dictionary would keep the recursion from being infinite because those
-      # are properly handled. That just leaves making sure we end up with
-      # only one copy of the tuple. We do that here by checking to see if we
-      # just made a copy as a result of copying the items above. If so, we
-      # return the one that's already been made.
-      if _saved_id(obj) in objectmap:
-        return objectmap[_saved_id(obj)]
-
-      retval = tuple(temp_list)
-      objectmap[_saved_id(obj)] = retval
-      return retval
-
-    elif type(obj) is set:
-      temp_list = []
-      # We can't just store this list object in the objectmap because it isn't
-      # a set yet. If it's possible to have a set contain a reference to
-      # itself, this could result in infinite recursion. However, sets can
-      # only contain hashable items so I believe this can't happen.
-
-      for item in obj:
-        temp_list.append(_copy(item, objectmap))
-
-      retval = set(temp_list)
-      objectmap[_saved_id(obj)] = retval
-      return retval
-
-    elif type(obj) is dict:
-      temp_dict = {}
-      # Need to save this in the objectmap before recursing because dicts
-      # might have circular references.
-      objectmap[_saved_id(obj)] = temp_dict
-
-      for key, value in obj.items():
-        temp_key = _copy(key, objectmap)
-        temp_dict[temp_key] = _copy(value, objectmap)
-
-      return temp_dict
-
-    # We don't copy certain objects. This is because copying an emulated file
-    # object, for example, will cause the destructor of the original one to
-    # be invoked, which will close the actual underlying file. As the object
-    # is wrapped and the client does not have access to it, it's safe to not
-    # wrap it.
-    elif isinstance(obj, (NamespaceObjectWrapper, emulfile.emulated_file,
-                          emulcomm.EmulatedSocket, emulcomm.TCPServerSocket,
-                          emulcomm.UDPServerSocket, thread.LockType,
-                          virtual_namespace.VirtualNamespace)):
-      return obj
-
-    else:
-      raise TypeError("_copy is not implemented for objects of type " + str(type(obj)))
+    return _copy_value(obj, objectmap)
 
   except Exception, e:
     raise NamespaceInternalError("_copy failed on " + str(obj) + " with message " + str(e))
 
 
 
+def _copy_value(obj, objectmap):
+  """
+  The worker for _copy(). Exceptions are left to the caller to handle.
+  """
+  # If this is a circular reference, use the copy we already made.
+  if _saved_id(obj) in objectmap:
+    return objectmap[_saved_id(obj)]
+
+  copier = _COPIERS.get(_saved_id(type(obj)))
+  if copier is not None:
+    return copier(obj, objectmap)
+
+  if _saved_id(type(obj)) in _UNCOPIED_TYPE_IDS or isinstance(obj, _UNCOPIED_HANDLE_TYPES):
+    return obj
+
+  raise TypeError("_copy is not implemented for objects of type " + str(type(obj)))
+
+
+
+def _copy_items(obj, objectmap):
+  """
+  Copy each item of the iterable obj. Returns a list of the copies and
+  whether every copy is the original item itself.
+  """
+  uncopied_type_ids = _UNCOPIED_TYPE_IDS
+  temp_list = []
+  unchanged = True
+
+  for item in obj:
+    if _saved_id(type(item)) not in uncopied_type_ids:
+      copied_item = _copy_value(item, objectmap)
+      if copied_item is not item:
+        unchanged = False
+      item = copied_item
+    temp_list.append(item)
+
+  return temp_list, unchanged
+
+
+
+def _copy_list(obj, objectmap):
+  temp_list = []
+  # Need to save this in the objectmap before recursing because lists
+  # might have circular references.
+  objectmap[_saved_id(obj)] = temp_list
+
+  uncopied_type_ids = _UNCOPIED_TYPE_IDS
+  for item in obj:
+    if _saved_id(type(item)) not in uncopied_type_ids:
+      item = _copy_value(item, objectmap)
+    temp_list.append(item)
+
+  return temp_list
+
+
+
+def _copy_tuple(obj, objectmap):
+  temp_list, unchanged = _copy_items(obj, objectmap)
+
+  # I'm not 100% confident on my reasoning here, so feel free to point
+  # out where I'm wrong: There's no way for a tuple to directly contain
+  # a circular reference to itself. Instead, it has to contain, for
+  # example, a dict which has the same tuple as a value. In that
+  # situation, we can avoid infinite recursion and properly maintain
+  # circular references in our copies by checking the objectmap right
+  # after we do the copy of each item in the tuple. The existence of the
+  # dictionary would keep the recursion from being infinite because those
+  # are properly handled. That just leaves making sure we end up with
+  # only one copy of the tuple. We do that here by checking to see if we
+  # just made a copy as a result of copying the items above. If so, we
+  # return the one that's already been made.
+  if _saved_id(obj) in objectmap:
+    return objectmap[_saved_id(obj)]
+
+  # A tuple can't be modified, so if none of its items needed copying the
+  # tuple itself doesn't either.
+  if unchanged:
+    retval = obj
+  else:
+    retval = tuple(temp_list)
+  objectmap[_saved_id(obj)] = retval
+  return retval
+
+
+
+def _copy_set(obj, objectmap):
+  # We can't just store this list object in the objectmap because it isn't
+  # a set yet. If it's possible to have a set contain a reference to
+  # itself, this could result in infinite recursion. However, sets can
+  # only contain hashable items so I believe this can't happen.
+  temp_list = _copy_items(obj, objectmap)[0]
+
+  retval = set(temp_list)
+  objectmap[_saved_id(obj)] = retval
+  return retval
+
+
+
+def _copy_dict(obj, objectmap):
+  temp_dict = {}
+  # Need to save this in the objectmap before recursing because dicts
+  # might have circular references.
+  objectmap[_saved_id(obj)] = temp_dict
+
+  uncopied_type_ids = _UNCOPIED_TYPE_IDS
+  for key, value in obj.items():
+    if _saved_id(type(key)) not in uncopied_type_ids:
+      key = _copy_value(key, objectmap)
+    if _saved_id(type(value)) not in uncopied_type_ids:
+      value = _copy_value(value, objectmap)
+    temp_dict[key] = value
+
+  return temp_dict
+
+
+
+# Maps the id of each container type to the function that copies it.
+_COPIERS = {
+  _saved_id(list) : _copy_list,
+  _saved_id(tuple) : _copy_tuple,
+  _saved_id(set) : _copy_set,
+  _saved_id(dict) : _copy_dict,
+}
+
+
+
 
 
 class NamespaceInternalError(Exception):
@@ -902,8 +1100,15 @@ class NamespaceObjectWrapper(object):
   exception is that a simple __repr__() is defined as well as an __iter__()
   and next(). However, instances won't really be iterable unless a next()
   method is defined in the allowed_functions_dict.
+
+  Instances have no __dict__, so untrusted code cannot add attributes to
+  them. The callables handed out for method access are created on first
+  use and then reused for the lifetime of the instance.
   """
 
+  __slots__ = ["_wrapped__type_name", "_wrapped__object",
+               "_wrapped__allowed_functions_dict", "_wrapped__bound_methods"]
+
   def __init__(self, wrapped_type_name, wrapped_object, allowed_functions_dict):
     """
     <Purpose>
@@ -928,6 +1133,9 @@ class NamespaceObjectWrapper(object):
     self._wrapped__type_name = wrapped_type_name
     self._wrapped__object = wrapped_object
     self._wrapped__allowed_functions_dict = allowed_functions_dict
+    # Created lazily by __getattr__ so that wrappers whose methods are never
+    # called (e.g. values that are only passed back into the API) stay small.
+    self._wrapped__bound_methods = None
 
 
 
@@ -937,12 +1145,30 @@ class NamespaceObjectWrapper(object):
     allowed_functions_dict that was provided to the constructor. If there
     is such a method in there, we return a function that will properly
     invoke the method with the correct 'self' as the first argument.
+
+    The function is cached on the instance, so repeated calls such as
+    lock.acquire(True) in a loop don't allocate a new closure each time.
     """
+    bound_methods = self._wrapped__bound_methods
+    if bound_methods is not None and name in bound_methods:
+      return bound_methods[name]
+
     if name in self._wrapped__allowed_functions_dict:
       wrapped_func = self._wrapped__allowed_functions_dict[name]
 
+      # Close over the wrapped object rather than self. The cache lives on
+      # self, so referring to self here would create a reference cycle and
+      # keep the wrapper (and the object it wraps) alive until the cyclic
+      # garbage collector runs.
+      wrapped_object = self._wrapped__object
+
       def __do_func_call(*args, **kwargs):
-        return wrapped_func(self._wrapped__object, *args, **kwargs)
+        return wrapped_func(wrapped_object, *args, **kwargs)
+
+      if bound_methods is None:
+        bound_methods = {}
+        self._wrapped__bound_methods = bound_methods
+      bound_methods[name] = __do_func_call
 
       return __do_func_call
 
@@ -1009,6 +1235,13 @@ class NamespaceObjectWrapper(object):
 
 
 
+_UNCOPIED_HANDLE_TYPES = (NamespaceObjectWrapper, emulfile.emulated_file,
+                          emulcomm.EmulatedSocket, emulcomm.TCPServerSocket,
+                          emulcomm.UDPServerSocket, emulcomm.PendingConnection,
+                          thread.LockType, virtual_namespace.VirtualNamespace)
+
+
+
 
 class NamespaceAPIFunctionWrapper(object):
   """
@@ -1018,7 +1251,7 @@ class NamespaceAPIFunctionWrapper(object):
   to call the wrapped version of the function.
   """
 
-  def __init__(self, func_dict, is_method=False):
+  def __init__(self, func_dict, is_method=False, name=None):
     """
     <Purpose>
       Constructor.
@@ -1033,6 +1266,8 @@ class NamespaceAPIFunctionWrapper(object):
           return (required)
       is_method -- if this is an object's method being wrapped
             rather than a regular function.
+      name -- the name the function is reported under when API profiling
+            is enabled. Defaults to the name of the function.
     <Exceptions>
       None
     <Side Effects>
@@ -1060,161 +1295,305 @@ class NamespaceAPIFunctionWrapper(object):
     else:
       self.__func_name = self.__func.__name__
 
+    # The function that is mapped in to the untrusted code
+    self.wrapped_function = self._make_wrapped_function()
 
+    # Profiling is decided once here, so the calls don't pay for it when
+    # it is disabled.
+    if apiprofiler.enabled:
+      if name is None:
+        name = self.__func_name
+      self.wrapped_function = apiprofiler.profile_function(name,
+          self.wrapped_function)
 
-  def _process_args(self, args):
-    args_to_return = []
 
-    for index in range(len(args)):
-      # Armon: If there are more arguments than there are type specifications
-      # and we are using NonCopiedVarArgs, then check against that.
-      if index >= len(self.__args) and isinstance(self.__args[-1], NonCopiedVarArgs):
-        arg_type = self.__args[-1]
-      else:
-        arg_type = self.__args[index]
 
-      # We only copy simple types, which means we only copy ValueProcessor not
-      # ObjectProcessor arguments.
+  def _make_arg_processor(self):
+    """
+    Returns a function which copies or unwraps, and checks, the arguments
+    passed to the wrapped function. The usual signatures get a function
+    which does not need to loop or look at the argument types.
+    """
+    # For each argument, how to get our own copy and how to check it. We
+    # only copy simple types, which means we only copy ValueProcessor not
+    # ObjectProcessor arguments.
+    steps = []
+    for arg_type in self.__args:
       if isinstance(arg_type, ValueProcessor):
-        temparg = arg_type.copy(args[index])
+        steps.append((arg_type.copy, arg_type.check))
       elif isinstance(arg_type, ObjectProcessor):
-        temparg = arg_type.unwrap(args[index])
+        steps.append((arg_type.unwrap, arg_type.check))
       else:
         raise NamespaceInternalError("Unknown argument expectation.")
 
-      arg_type.check(temparg)
+    # Armon: If there are more arguments than there are type specifications
+    # and we are using NonCopiedVarArgs, then check against that.
+    if self.__args and isinstance(self.__args[-1], NonCopiedVarArgs):
+      last_step = steps[-1]
+
+      def process_args(args):
+        args_to_return = []
+        for index in range(len(args)):
+          if index < len(steps):
+            convert, check = steps[index]
+          else:
+            convert, check = last_step
+          temparg = convert(args[index])
+          check(temparg)
+          args_to_return.append(temparg)
+        return args_to_return
+
+    elif len(steps) == 0:
+      def process_args(args):
+        return []
+
+    elif len(steps) == 1:
+      convert0, check0 = steps[0]
+
+      def process_args(args):
+        arg0 = convert0(args[0])
+        check0(arg0)
+        return [arg0]
+
+    elif len(steps) == 2:
+      convert0, check0 = steps[0]
+      convert1, check1 = steps[1]
+
+      def process_args(args):
+        arg0 = convert0(args[0])
+        check0(arg0)
+        arg1 = convert1(args[1])
+        check1(arg1)
+        return [arg0, arg1]
 
-      args_to_return.append(temparg)
+    else:
+      def process_args(args):
+        args_to_return = []
+        for index in range(len(steps)):
+          convert, check = steps[index]
+          temparg = convert(args[index])
+          check(temparg)
+          args_to_return.append(temparg)
+        return args_to_return
 
-    return args_to_return
+    return process_args
 
 
 
-  def _process_retval_helper(self, processor, retval):
-    try:
-      if isinstance(processor, ValueProcessor):
-        tempretval = processor.copy(retval)
-        processor.check(tempretval)
-      elif isinstance(processor, ObjectProcessor):
-        processor.check(retval)
-        tempretval = processor.wrap(retval)
-      elif processor is None:
+  def _make_retval_helper(self, processor):
+    """
+    Returns a function which copies or wraps, and checks, a single return
+    value as the processor says.
+    """
+    if isinstance(processor, ValueProcessor):
+      copy = processor.copy
+      check = processor.check
+
+      def process_retval(retval):
+        tempretval = copy(retval)
+        check(tempretval)
+        return tempretval
+
+    elif isinstance(processor, ObjectProcessor):
+      check = processor.check
+      wrap = processor.wrap
+
+      def process_retval(retval):
+        check(retval)
+        return wrap(retval)
+
+    elif processor is None:
+      def process_retval(retval):
         if retval is not None:
           raise InternalRepyError("Expected None but wasn't.")
-        tempretval = None
-      else:
-        raise InternalRepyError("Unknown retval expectation.")
-      return tempretval
+        return None
 
-    except RepyArgumentError, err:
-      raise InternalRepyError("Invalid retval type: %s" % err)
+    else:
+      raise InternalRepyError("Unknown retval expectation.")
 
+    return process_retval
 
 
-  def _process_retval(self, retval):
 
-    try:
-      # Allow the return value to be a tuple of processors.
-      if type(retval) is tuple:
-        if len(retval) != len(self.__return):
+  def _make_retval_processor(self):
+    """
+    Returns a function which copies or wraps, and checks, the value
+    returned by the underlying function.
+    """
+    func_name = self.__func_name
+
+    # Allow the return value to be a tuple of processors.
+    if type(self.__return) is tuple:
+      helpers = []
+      for processor in self.__return:
+        helpers.append(self._make_retval_helper(processor))
+
+      def process_retval(retval):
+        if type(retval) is not tuple:
+          # Without a tuple, this would only be accepted by a single processor
+          raise InternalRepyError("Expected a tuple but wasn't.")
+        if len(retval) != len(helpers):
           raise InternalRepyError("Returned tuple of wrong size: %s" % str(retval))
         tempretval = []
         for index in range(len(retval)):
-          tempitem = self._process_retval_helper(self.__return[index], retval[index])
-          tempretval.append(tempitem)
-        tempretval = tuple(tempretval)
-      else:
-        tempretval = self._process_retval_helper(self.__return, retval)
+          tempretval.append(helpers[index](retval[index]))
+        return tuple(tempretval)
 
-    except Exception, e:
-      raise InternalRepyError(
-          "Function '" + self.__func_name + "' returned with unallowed return type " +
-          str(type(retval)) + " : " + str(e))
+    else:
+      helper = self._make_retval_helper(self.__return)
+
+      def process_retval(retval):
+        if type(retval) is tuple:
+          # A tuple needs a tuple of processors
+          raise InternalRepyError("Returned tuple of wrong size: %s" % str(retval))
+        return helper(retval)
 
+    def checked_process_retval(retval):
+      try:
+        return process_retval(retval)
+      except Exception, e:
+        if isinstance(e, RepyArgumentError):
+          e = "Invalid retval type: %s" % e
+        raise InternalRepyError(
+            "Function '" + func_name + "' returned with unallowed return type " +
+            str(type(retval)) + " : " + str(e))
 
-    return tempretval
+    return checked_process_retval
 
 
 
-  def wrapped_function(self, *args, **kwargs):
+  def _make_wrapped_function(self):
     """
     <Purpose>
-      Act as the function that is wrapped but perform all required sanitization
+      Builds the function which is mapped in to the untrusted code. It acts
+      as the function that is wrapped but performs all required sanitization
       and checking of data that goes into and comes out of the underlying
-      function.
+      function. Everything that only depends on the function's description
+      is worked out here, once, rather than on every call.
     <Arguments>
       self
-      *args
-      **kwargs
-        The arguments to the underlying function.
     <Exceptions>
-      NamespaceViolationError
-        If some aspect of the arguments or function call is not allowed.
-      Anything else that the underlying function may raise.
+      NamespaceInternalError if an argument description is not known.
     <Side Effects>
-      Anything that the underyling function may do.
+      None
     <Returns>
-      Anything that the underlying function may return.
+      The wrapped function. When called, it may raise:
+        NamespaceViolationError
+          If some aspect of the arguments or function call is not allowed.
+        Anything else that the underlying function may raise.
     """
-    try:
-      # We don't allow keyword args.
-      if kwargs:
-        raise RepyArgumentError("Keyword arguments not allowed when calling %s." %
-                                self.__func_name)
-
-      if self.__is_method:
-        # This is a method of an object instance rather than a standalone function.
-        # The "self" argument will be passed implicitly by python in some cases, so
-        # we remove it from the args we check. For the others, we'll add it back in
-        # after the check.
-        args_to_check = args[1:]
-      else:
-        args_to_check = args
-
-      if len(args_to_check) != len(self.__args):
-        if not self.__args or not isinstance(self.__args[-1:][0], NonCopiedVarArgs):
-          raise RepyArgumentError("Function '" + self.__func_name + 
-              "' takes " + str(len(self.__args)) + " arguments, not " + 
-              str(len(args_to_check)) + " as you provided.")
-
-      args_copy = self._process_args(args_to_check)
-
-      args_to_use = None
-
+    func = self.__func
+    func_name = self.__func_name
+    process_args = self._make_arg_processor()
+    process_retval = self._make_retval_processor()
+
+    # How many arguments must be passed. With NonCopiedVarArgs, any number is
+    # allowed.
+    if self.__args and isinstance(self.__args[-1], NonCopiedVarArgs):
+      argcount = None
+    else:
+      argcount = len(self.__args)
+
+    def raise_argcount_error(args_to_check):
+      raise RepyArgumentError("Function '" + func_name + 
+          "' takes " + str(argcount) + " arguments, not " + 
+          str(len(args_to_check)) + " as you provided.")
+
+    def raise_kwargs_error():
+      raise RepyArgumentError("Keyword arguments not allowed when calling %s." %
+                              func_name)
+
+    # The types that may be passed as the "self" argument of a method
+    self_types = (NamespaceObjectWrapper, emulfile.emulated_file,
+                  emulcomm.EmulatedSocket, emulcomm.TCPServerSocket,
+                  emulcomm.UDPServerSocket, emulcomm.PendingConnection,
+                  thread.LockType, virtual_namespace.VirtualNamespace)
+
+    # Each of these does the same checks, in the same order, as the others.
+    # They differ in how the underlying function is called.
+    if type(func) is str:
       # If it's a string rather than a function, then this is our convention
       # for indicating that we want to wrap the function of this particular
       # object. We use this if the function to wrap isn't available without
       # having the object around, such as with real lock objects.
-      if type(self.__func) is str:
-        func_to_call = _saved_getattr(args[0], self.__func)
-        args_to_use = args_copy
-      else:
-        func_to_call = self.__func
-        if self.__is_method:
+      def wrapped_function(*args, **kwargs):
+        try:
+          # We don't allow keyword args.
+          if kwargs:
+            raise_kwargs_error()
+
+          # The "self" argument will be passed implicitly by python in some
+          # cases, so we remove it from the args we check.
+          args_to_check = args[1:]
+          if argcount is not None and len(args_to_check) != argcount:
+            raise_argcount_error(args_to_check)
+
+          args_copy = process_args(args_to_check)
+          func_to_call = _saved_getattr(args[0], func)
+          return process_retval(func_to_call(*args_copy))
+
+        except RepyException:
+          # We allow any RepyError to continue up to the client code.
+          raise
+
+        except:
+          # Any other exception is unexpected and thus is a programming error on
+          # our side, so we terminate.
+          _handle_internalerror("Unexpected exception from within Repy API", 843)
+
+    elif self.__is_method:
+      # This is a method of an object instance rather than a standalone function.
+      def wrapped_function(*args, **kwargs):
+        try:
+          # We don't allow keyword args.
+          if kwargs:
+            raise_kwargs_error()
+
+          args_to_check = args[1:]
+          if argcount is not None and len(args_to_check) != argcount:
+            raise_argcount_error(args_to_check)
+
+          args_copy = process_args(args_to_check)
+
           # Sanity check the object we're adding back in as the "self" argument.
-          if not isinstance(args[0], (NamespaceObjectWrapper, emulfile.emulated_file,
-                                      emulcomm.EmulatedSocket, emulcomm.TCPServerSocket,
-                                      emulcomm.UDPServerSocket, thread.LockType,
-                                      virtual_namespace.VirtualNamespace)):
+          if not isinstance(args[0], self_types):
             raise NamespaceInternalError("Wrong type for 'self' argument.")
+
           # If it's a method but the function was not provided as a string, we
-          # actually do have to add the first argument back in. Yes, this whole
-          # area of code is ugly.
-          args_to_use = [args[0]] + args_copy
-        else:
-          args_to_use = args_copy
-      
-      retval = func_to_call(*args_to_use)
+          # actually do have to add the first argument back in.
+          return process_retval(func(args[0], *args_copy))
 
-      return self._process_retval(retval)
+        except RepyException:
+          # We allow any RepyError to continue up to the client code.
+          raise
 
-    except RepyException:
-      # TODO: this should be changed to RepyError along with all references to
-      # RepyException in the rest of the repy code.
-      # We allow any RepyError to continue up to the client code.
-      raise
+        except:
+          # Any other exception is unexpected and thus is a programming error on
+          # our side, so we terminate.
+          _handle_internalerror("Unexpected exception from within Repy API", 843)
 
-    except:
-      # Any other exception is unexpected and thus is a programming error on
-      # our side, so we terminate.
-      _handle_internalerror("Unexpected exception from within Repy API", 843)
+    else:
+      def wrapped_function(*args, **kwargs):
+        try:
+          # We don't allow keyword args.
+          if kwargs:
+            raise_kwargs_error()
+
+          if argcount is not None and len(args) != argcount:
+            raise_argcount_error(args)
+
+          args_copy = process_args(args)
+          return process_retval(func(*args_copy))
+
+        except RepyException:
+          # TODO: this should be changed to RepyError along with all references to
+          # RepyException in the rest of the repy code.
+          # We allow any RepyError to continue up to the client code.
+          raise
+
+        except:
+          # Any other exception is unexpected and thus is a programming error on
+          # our side, so we terminate.
+          _handle_internalerror("Unexpected exception from within Repy API", 843)
+
+    return wrapped_function
@@ -9,6 +9,8 @@ Description:
 
 import ctypes       # Allows us to make C calls
 import ctypes.util  # Helps to find the C library
+import socket       # For the address family constants and inet_ntop
+import sys          # To tell the BSDs from Linux
 
 # Import for Popen
 import portable_popen
@@ -136,41 +138,260 @@ def exists_listening_network_socket(ip, port, tcp):
   return (number_of_sockets > 0)
 
 
-def get_available_interfaces():
+##### Interface enumeration
+
+# struct sockaddr from <sys/socket.h>. The BSDs (and so Darwin) start it
+# with a length byte, and have a one byte family.
+if sys.platform.startswith("linux"):
+  class _sockaddr(ctypes.Structure):
+    _fields_ = [("sa_family", ctypes.c_ushort),
+                ("sa_data", ctypes.c_char * 14)]
+else:
+  class _sockaddr(ctypes.Structure):
+    _fields_ = [("sa_len", ctypes.c_ubyte),
+                ("sa_family", ctypes.c_ubyte),
+                ("sa_data", ctypes.c_char * 14)]
+
+# struct ifaddrs from <ifaddrs.h>
+class _ifaddrs(ctypes.Structure):
+  pass
+
+_ifaddrs._fields_ = [("ifa_next", ctypes.POINTER(_ifaddrs)),
+                     ("ifa_name", ctypes.c_char_p),
+                     ("ifa_flags", ctypes.c_uint),
+                     ("ifa_addr", ctypes.POINTER(_sockaddr)),
+                     ("ifa_netmask", ctypes.POINTER(_sockaddr)),
+                     ("ifa_dstaddr", ctypes.POINTER(_sockaddr)),
+                     ("ifa_data", ctypes.c_void_p)]
+
+# Where the address lives within struct sockaddr_in and sockaddr_in6.
+# This is the same on every platform we support.
+_ADDRESS_OFFSETS = {socket.AF_INET: (4, 4), socket.AF_INET6: (8, 16)}
+
+# getifaddrs() is missing from some old C libraries (e.g. older Android)
+try:
+  _getifaddrs = libc.getifaddrs
+  _getifaddrs.argtypes = [ctypes.POINTER(ctypes.POINTER(_ifaddrs))]
+  _getifaddrs.restype = ctypes.c_int
+  _freeifaddrs = libc.freeifaddrs
+  _freeifaddrs.argtypes = [ctypes.POINTER(_ifaddrs)]
+  _freeifaddrs.restype = None
+except AttributeError:
+  _getifaddrs = None
+
+
+def _get_ifaddrs_entries():
   """
   <Purpose>
-    Returns a list of available network interfaces.
-  
+    Calls getifaddrs() and converts the result into python objects.
+
+  <Arguments>
+    None
+
+  <Exceptions>
+    OSError if getifaddrs() is not available or fails.
+
   <Returns>
-    An array of string interfaces
+    A list of (interface, family, address) tuples, one per entry. For
+    entries which are not IPv4 or IPv6 addresses (e.g. link layer entries)
+    family and address are None.
+  """
+  if _getifaddrs is None:
+    raise OSError("getifaddrs() is not available!")
+
+  head = ctypes.POINTER(_ifaddrs)()
+  if _getifaddrs(ctypes.byref(head)) != 0:
+    raise OSError("getifaddrs() failed!")
+
+  entries = []
+  try:
+    current = head
+    while current:
+      entry = current.contents
+      family = None
+      address = None
+
+      # Some entries have no address at all
+      if entry.ifa_addr:
+        sockaddr_family = entry.ifa_addr.contents.sa_family
+        if sockaddr_family in _ADDRESS_OFFSETS:
+          offset, length = _ADDRESS_OFFSETS[sockaddr_family]
+          packed = ctypes.string_at(ctypes.addressof(entry.ifa_addr.contents) + offset, length)
+          family = sockaddr_family
+          address = socket.inet_ntop(family, packed)
+
+      entries.append((entry.ifa_name, family, address))
+      current = entry.ifa_next
+
+  finally:
+    _freeifaddrs(head)
+
+  return entries
+
+
+
+def parse_ifconfig_addresses(ifconfig_output):
+  """
+  <Purpose>
+    Parses the output of ifconfig into address records. Both the Linux
+    net-tools formats ("inet addr:10.0.0.1" and "inet 10.0.0.1") and the
+    BSD / Darwin format are understood.
+
+  <Arguments>
+    ifconfig_output: The text printed by ifconfig
+
+  <Returns>
+    A list of (interface, family, address) tuples, where family is
+    socket.AF_INET or socket.AF_INET6.
+  """
+  records = []
+  interface = None
+
+  for line in ifconfig_output.split("\n"):
+    if not line.strip():
+      continue
+
+    # Lines which are not indented start a new interface,
+    # e.g. "eth0      Link encap:Ethernet" or "en0: flags=8863<UP>"
+    if not line[0].isspace():
+      interface = line.split()[0].rstrip(":")
+      continue
+
+    parts = line.split()
+    if interface is None or len(parts) < 2:
+      continue
+
+    if parts[0] == "inet":
+      family = socket.AF_INET
+    elif parts[0] == "inet6":
+      family = socket.AF_INET6
+    else:
+      continue
+
+    # Old Linux ifconfig prints "inet addr:1.2.3.4" and "inet6 addr: ::1/128"
+    address = parts[1]
+    if address == "addr:" and len(parts) > 2:
+      address = parts[2]
+    elif address.startswith("addr:"):
+      address = address[len("addr:"):]
+
+    # Strip any prefix length or scope
+    address = address.split("/")[0].split("%")[0]
+
+    records.append((interface, family, address))
+
+  return records
+
+
+
+def parse_netstat_interfaces(netstat_output):
+  """
+  <Purpose>
+    Parses the output of "netstat -i" into a list of interface names.
+
+  <Arguments>
+    netstat_output: The text printed by netstat
+
+  <Returns>
+    A list of unique interface names, in the order netstat printed them.
   """
   # Common headers
   # This list contains common header elements so that they can be stripped
   common_headers_list = ["Name", "Kernel", "Iface"]
+
+  # Create an array for the interfaces
+  interfaces_list = []
+
+  for line in netstat_output.split("\n"):
+    parts = line.split()
+    if len(parts) == 0:
+      continue
+
+    # The interface name is the first field. There may be one line for
+    # each address of an interface.
+    interface = parts[0]
+    if interface in common_headers_list or interface in interfaces_list:
+      continue
+    interfaces_list.append(interface)
+
+  return interfaces_list
+
+
+
+def get_interface_addresses():
+  """
+  <Purpose>
+    Returns the IPv4 and IPv6 addresses of every network interface.
+    getifaddrs() is used where possible, and the output of ifconfig is
+    parsed otherwise.
+
+  <Returns>
+    A list of (interface, family, address) tuples, where family is
+    socket.AF_INET or socket.AF_INET6.
+  """
+  try:
+    entries = _get_ifaddrs_entries()
+  except OSError:
+    ifconfig_process = portable_popen.Popen(["/sbin/ifconfig", "-a"])
+    ifconfig_output, _ = ifconfig_process.communicate()
+    return parse_ifconfig_addresses(ifconfig_output)
+
+  records = []
+  for entry in entries:
+    if entry[1] is not None:
+      records.append(entry)
+
+  return records
+
+
+
+def get_interface_ip_addresses(interfaceName):
+  """
+  <Purpose>
+    Returns the IP address associated with the interface.
   
-  # Netstat will return all interfaces, but also has some duplication.
-  # Cut will get the first field from each line, which is the interface name.
-  # Sort prepares the input for uniq, which only works on sorted lists.
-  # Uniq, is somewhat obvious, it will only return the unique interfaces to remove duplicates.
-  # Launch up a shell, get the feedback
-  netstat_process = portable_popen.Popen(["netstat", "-i"])
-  netstat_stdout, _ = netstat_process.communicate()
-  netstat_lines = textops.textops_rawtexttolines(netstat_stdout)
+  <Arguments>
+    interfaceName: The string name of the interface, e.g. eth0
+  
+  <Returns>
+    A list of IP addresses associated with the interface.
+  """
+  interfaceName = interfaceName.strip()
+
+  # Create an array for the ip's
+  ipaddressList = []
+
+  for (interface, family, address) in get_interface_addresses():
+    if interface == interfaceName and family == socket.AF_INET:
+      ipaddressList.append(address)
+
+  return ipaddressList
 
-  target_lines = textops.textops_cut(netstat_lines, delimiter=" ", fields=[0])
 
-  unique_lines = set(target_lines)
+
+def get_available_interfaces():
+  """
+  <Purpose>
+    Returns a list of available network interfaces.
+  
+  <Returns>
+    An array of string interfaces
+  """
+  try:
+    entries = _get_ifaddrs_entries()
+  except OSError:
+    # Launch up a shell, get the feedback
+    netstat_process = portable_popen.Popen(["netstat", "-i"])
+    netstat_stdout, _ = netstat_process.communicate()
+    return parse_netstat_interfaces(netstat_stdout)
 
   # Create an array for the interfaces
   interfaces_list = []
-  
-  for line in unique_lines:
-    # Strip the newline
-    line = line.strip("\n")
-    # Check if this is a header
-    if line in common_headers_list:
-      continue
-    interfaces_list.append(line)
+
+  # There is one entry for each address of an interface
+  for (interface, family, address) in entries:
+    if interface not in interfaces_list:
+      interfaces_list.append(interface)
   
   # Done, return the interfaces
   return interfaces_list
@@ -38,6 +38,13 @@
   --status filename.txt  : Write status information into this file
   --cwd dir              : Set Current working directory
   --servicelog           : Enable usage of the servicelogger for internal errors
+  --loopbackfastpath     : TCP connections between two ends in this process skip the OS.
+  --resolvertimeout secs : How long gethostbyname() waits for a hostname lookup (default 10).
+  --profileapi filename  : Record the calls to each API function and their latencies.
+                         : The report is written to filename at exit and on SIGUSR1.
+  --codecache dir        : Remember code that passed the safety check in dir, and don't check it again.
+                         : The compiled code is kept there as well. dir must not be the vessel's directory,
+                         : and must be owned by the user running repy and not writable by anyone else.
 """
 
 import json
@@ -79,6 +86,7 @@ import safe
 import nanny
 import emulcomm
 import idhelper
+import apiprofiler
 import harshexit
 import namespace
 import nonportable
@@ -261,6 +269,22 @@ def add_repy_options(parser):
                     action="store_true", dest="servicelog",
                     help="Enable usage of the servicelogger for internal errors"
                     )
+  parser.add_option('--loopbackfastpath',
+                    action="store_true", dest="loopbackfastpath", default=False,
+                    help="Pass data between TCP connections within this process without going through the OS"
+                    )
+  parser.add_option('--resolvertimeout',
+                    action="store", type="float", dest="resolvertimeout",
+                    help="Wait at most resolvertimeout seconds for a hostname lookup"
+                    )
+  parser.add_option('--profileapi',
+                    action="store", type="string", dest="profileapi",
+                    help="Profile the API calls of the program and write the report to profileapi"
+                    )
+  parser.add_option('--codecache',
+                    action="store", type="string", dest="codecache",
+                    help="Cache the results of code safety checks and the compiled code in the directory codecache"
+                    )
     
 def parse_options(options):
   """ Parse the specified options and initialize all required structures
@@ -288,6 +312,36 @@ def parse_options(options):
     emulcomm.user_ip_interface_preferences = True
     # Disable nonspecified IP's
     emulcomm.allow_nonspecified_ips = False
+
+  # Check if connections within this process should skip the OS
+  if options.loopbackfastpath:
+    emulcomm.loopback_fast_path = True
+
+  # Set how long hostname lookups may take
+  if options.resolvertimeout is not None:
+    emulcomm.resolver_timeout = options.resolvertimeout
+
+  # Check if the API calls should be profiled
+  if options.profileapi:
+    apiprofiler.enabled = True
+    apiprofiler.report_filename = os.path.abspath(options.profileapi)
+    apiprofiler.install_report_signal_handler()
+
+  # Set up the cache of safety check results and compiled code. The program can create files
+  # in the directory it runs in (see --cwd below), so the cache must not be
+  # there or it could add entries for code that isn't safe. For the same
+  # reason, no other user may be able to write to it.
+  if options.codecache:
+    codecachedir = os.path.realpath(options.codecache)
+    if codecachedir == os.path.realpath(options.cwd or os.getcwd()):
+      print "The code cache directory must not be the directory the program runs in!"
+      sys.exit(1)
+    if not os.path.isdir(codecachedir):
+      os.makedirs(codecachedir, 0700)
+    if not safe.is_private_cache_dir(codecachedir):
+      print "The code cache directory must be owned by the user running repy, and must not be writable by anyone else!"
+      sys.exit(1)
+    safe.SAFE_CHECK_CACHE_DIR = codecachedir
     
   # set up the circular log buffer...
   # Armon: Initialize the circular logger before starting the nanny
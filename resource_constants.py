@@ -37,9 +37,14 @@ individual_item_resources = ['messport', 'connport']
 # Include resources that are fungible vs those that are individual...
 item_resources = fungible_item_resources + individual_item_resources
 
+# resources which are never consumed, they only limit the value of a
+# setting. socketbuffer is the largest socket send / receive buffer (in bytes)
+# and listenbacklog the largest listen backlog.
+limit_resources = ['socketbuffer', 'listenbacklog']
+
 
 # all resource names
-known_resources = quantity_resources + item_resources 
+known_resources = quantity_resources + item_resources + limit_resources
 
 # Whenever a resource file is attached to a vessel, an exception should
 # be thrown if these resources are not present.  If any of these are left
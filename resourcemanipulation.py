@@ -188,10 +188,13 @@ def parse_resourcedict_from_string(resourcestring):
         # Item resources (bytes of space, port numbers) are integers as well.
         elif knownresourcename in resource_constants.item_resources:
           resourcevalue = int(resourcevaluestring)
+        # So are the limits (bytes, number of connections).
+        elif knownresourcename in resource_constants.limit_resources:
+          resourcevalue = int(resourcevaluestring)
         else:
           raise ResourceParseError("Resource " + knownresourcename + 
-            " in line " + line + " is neither renewable, quantity-based " + 
-            " nor item-based.")
+            " in line " + line + " is neither renewable, quantity-based, " + 
+            " item-based nor a limit.")
       except ValueError:
         raise ResourceParseError("Line '"+line+"' has an invalid resource value '"+resourcevaluestring+"'")
 
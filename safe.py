@@ -60,8 +60,9 @@
 # Built-in Objects
 # http://docs.python.org/lib/builtin.html
 
-# AST Nodes - compiler
+# AST Nodes - compiler (_NODE_CLASS_OK uses these names) and _ast
 # http://docs.python.org/lib/module-compiler.ast.html
+# http://docs.python.org/2/library/ast.html#abstract-grammar
 
 # Types and members - inspection
 # http://docs.python.org/lib/inspect-types.html
@@ -79,6 +80,8 @@
 import os           # This is for some path manipulation
 import sys          # This is to get sys.executable to launch the external process
 import time         # This is to sleep
+import errno        # This is to retry select() when interrupted
+import select       # This is to wait for safe_check.py workers to reply
 
 # Currently required to filter out Android-specific debug messages, cf #1080
 # and safe_check() below
@@ -88,12 +91,7 @@ try:
 except ImportError:
   IS_ANDROID = False
 
-# Hide the DeprecationWarning for compiler
-import warnings
-warnings.simplefilter('ignore')
-import compiler     # Required for the code safety check
-warnings.resetwarnings()
-
+import _ast         # Required for the code safety check
 import UserDict     # This is to get DictMixin
 import platform     # This is for detecting Nokia tablets
 import threading    # This is to get a lock
@@ -103,6 +101,10 @@ import __builtin__
 import nonportable  # This is to get the current runtime
 import repy_constants # This is to get our start-up directory
 import exception_hierarchy # This is for exception classes shared with tracebackrepy
+import hashlib      # This is to name the entries of the safety check cache
+import marshal      # This is to store compiled code in the cache
+import imp          # This is to get the bytecode version of the interpreter
+import stat         # This is to check the permissions of the cache directory
 
 # Fix to make repy compatible with Python 2.7.2 on Ubuntu 11.10 (ticket #1049)
 subprocess.getattr = getattr
@@ -218,55 +220,192 @@ _NODE_CLASS_OK = [
 _NODE_ATTR_OK = ['value']
 
 
-def _check_node(node):
+# The checks below work on the tree of _ast nodes. The policy above is
+# written in terms of the nodes of the old compiler module though, so these
+# tables describe each _ast node as the compiler node it corresponds to.
+# Nodes that have no counterpart there (like _ast.Index) map to None and
+# are not checked themselves, only their children are.
+_AST_NODE_NAMES = {
+    _ast.Module: 'Module', _ast.Expression: 'Expression',
+    _ast.FunctionDef: 'Function', _ast.ClassDef: 'Class',
+    _ast.Return: 'Return', _ast.Delete: None, _ast.Assign: 'Assign',
+    _ast.AugAssign: 'AugAssign', _ast.For: 'For', _ast.While: 'While',
+    _ast.If: 'If', _ast.With: 'With', _ast.Raise: 'Raise',
+    _ast.TryExcept: 'TryExcept', _ast.TryFinally: 'TryFinally',
+    _ast.Assert: 'Assert', _ast.Import: 'Import', _ast.ImportFrom: 'From',
+    _ast.Exec: 'Exec', _ast.Global: 'Global', _ast.Expr: 'Discard',
+    _ast.Pass: 'Pass', _ast.Break: 'Break', _ast.Continue: 'Continue',
+    _ast.Lambda: 'Lambda', _ast.IfExp: 'IfExp', _ast.Dict: 'Dict',
+    _ast.Set: 'Set', _ast.ListComp: 'ListComp', _ast.SetComp: 'SetComp',
+    _ast.DictComp: 'DictComp', _ast.GeneratorExp: 'GenExpr',
+    _ast.Yield: 'Yield', _ast.Compare: 'Compare', _ast.Call: 'CallFunc',
+    _ast.Repr: 'Backquote', _ast.Num: 'Const', _ast.Str: 'Const',
+    _ast.Subscript: 'Subscript', _ast.Ellipsis: 'Ellipsis',
+    _ast.Slice: 'Sliceobj', _ast.ExtSlice: None, _ast.Index: None,
+    _ast.ExceptHandler: None, _ast.arguments: None, _ast.keyword: 'Keyword',
+    _ast.comprehension: 'ListCompFor', _ast.alias: None,
+    }
+
+# Nodes whose compiler name depends on whether they are assigned to
+_AST_ASSIGNED_NODE_NAMES = {
+    _ast.Name: ('Name', 'AssName'), _ast.Attribute: ('Getattr', 'AssAttr'),
+    _ast.List: ('List', 'AssList'), _ast.Tuple: ('Tuple', 'AssTuple'),
+    }
+
+# Nodes whose compiler name is the name of their operator
+_AST_OPERATOR_NAMES = {
+    _ast.Add: 'Add', _ast.Sub: 'Sub', _ast.Mult: 'Mul', _ast.Div: 'Div',
+    _ast.Mod: 'Mod', _ast.Pow: 'Power', _ast.LShift: 'LeftShift',
+    _ast.RShift: 'RightShift', _ast.BitOr: 'Bitor', _ast.BitXor: 'Bitxor',
+    _ast.BitAnd: 'Bitand', _ast.FloorDiv: 'FloorDiv', _ast.Invert: 'Invert',
+    _ast.Not: 'Not', _ast.UAdd: 'UnaryAdd', _ast.USub: 'UnarySub',
+    _ast.And: 'And', _ast.Or: 'Or',
+    }
+
+# The string attributes of each node which are checked, as pairs of the
+# name the compiler node has for the attribute and the _ast field. Other
+# strings, such as the names of function arguments, were never checked.
+# They can't be used without also appearing in a Name node, which is.
+_AST_STRING_FIELDS = {
+    _ast.FunctionDef: [('name', 'name')], _ast.ClassDef: [('name', 'name')],
+    _ast.Name: [('name', 'id')], _ast.Attribute: [('attrname', 'attr')],
+    _ast.keyword: [('name', 'arg')], _ast.Str: [('value', 's')],
+    }
+
+# Contexts in which a node is being assigned to (or deleted)
+_AST_ASSIGNED_CONTEXTS = (_ast.Store, _ast.Del, _ast.Param, _ast.AugStore)
+
+# Parts of nodes that are not nodes in the compiler's tree, and are
+# described by the node they are part of instead
+_AST_NODE_PARTS = (_ast.expr_context, _ast.cmpop, _ast.operator,
+    _ast.unaryop, _ast.boolop)
+
+
+def _get_ast_node_name(node):
   """
   <Purpose>
-    Examines a node, its attributes, and all of its children (recursively) for safety.
-    A node is safe if it is in _NODE_CLASS_OK and an attribute is safe if it is
-    not a unicode string and either in _NODE_ATTR_OK or is safe as is 
-    defined by _is_string_safe()
-  
+    Returns the name of the compiler node which corresponds to an _ast node.
+
   <Arguments>
-    node: A node in an AST
-    
+    node: A node in an _ast tree
+
+  <Exceptions>
+    None
+
+  <Return>
+    The name, or None if there is no corresponding node.
+  """
+  nodetype = type(node)
+
+  if nodetype in _AST_NODE_NAMES:
+    return _AST_NODE_NAMES[nodetype]
+
+  if nodetype in _AST_ASSIGNED_NODE_NAMES:
+    loadname, assignedname = _AST_ASSIGNED_NODE_NAMES[nodetype]
+    if isinstance(node.ctx, _AST_ASSIGNED_CONTEXTS):
+      return assignedname
+    return loadname
+
+  if nodetype is _ast.BinOp or nodetype is _ast.UnaryOp or nodetype is _ast.BoolOp:
+    return _AST_OPERATOR_NAMES[type(node.op)]
+
+  if nodetype is _ast.Print:
+    if node.nl:
+      return 'Printnl'
+    return 'Print'
+
+  # A kind of node we don't know about, so we must not allow it
+  return nodetype.__name__
+
+
+
+def _check_ast(tree):
+  """
+  <Purpose>
+    Examines every node of an _ast tree for safety. A node is safe if it is
+    in _NODE_CLASS_OK and its attributes (see _AST_STRING_FIELDS) are safe.
+    An attribute is safe if it is not a unicode string and either in
+    _NODE_ATTR_OK or is safe as is defined by _is_string_safe().
+    The tree is walked using a stack rather than recursion, so that deeply
+    nested code can't exhaust the recursion limit.
+
+  <Arguments>
+    tree: The root of the tree, usually an _ast.Module
+
   <Exceptions>
     CheckNodeException if an unsafe node is used
-    CheckStrException if an attribute has an unsafe string 
-  
+    CheckStrException if an attribute has an unsafe string
+
   <Return>
     None
   """
-  if node.__class__.__name__ not in _NODE_CLASS_OK:
-    raise exception_hierarchy.CheckNodeException(node.lineno,node.__class__.__name__)
-  
-  for attribute, value in node.__dict__.iteritems():
-    # Don't allow the construction of unicode literals
-    if type(value) == unicode:
-      raise exception_hierarchy.CheckStrException(node.lineno, attribute, value)
+  # The nodes left to check, each with the line number to report for it if
+  # it has none of its own.
+  pending = [(tree, 0)]
+  ast_type = _ast.AST
+  node_parts = _AST_NODE_PARTS
+
+  while pending:
+    node, lineno = pending.pop()
+    nodetype = type(node)
+    nodedict = node.__dict__
+
+    if 'lineno' in nodedict:
+      lineno = nodedict['lineno']
+
+    if nodetype in _AST_NODE_NAMES:
+      nodename = _AST_NODE_NAMES[nodetype]
+    else:
+      nodename = _get_ast_node_name(node)
+    if nodename is not None and nodename not in _NODE_CLASS_OK:
+      raise exception_hierarchy.CheckNodeException(lineno, nodename)
 
-    if attribute in _NODE_ATTR_OK: 
-      continue
+    # Decorators were a node of their own
+    if (nodetype is _ast.FunctionDef or nodetype is _ast.ClassDef) and \
+        node.decorator_list and 'Decorators' not in _NODE_CLASS_OK:
+      raise exception_hierarchy.CheckNodeException(lineno, 'Decorators')
 
-    # JAC: don't check doc strings for __ and the like... (#889)
-    if attribute == 'doc' and (node.__class__.__name__ in
-      ['Module', 'Function', 'Class']):
-      continue
+    if nodetype in _AST_STRING_FIELDS:
+      for attribute, field in _AST_STRING_FIELDS[nodetype]:
+        value = nodedict[field]
 
+        # Don't allow the construction of unicode literals
+        if type(value) is unicode:
+          raise exception_hierarchy.CheckStrException(lineno, attribute, value)
 
-    # Check the safety of any strings
-    if not _is_string_safe(value):
-      raise exception_hierarchy.CheckStrException(node.lineno, attribute, value)
+        if attribute in _NODE_ATTR_OK:
+          continue
+
+        # Check the safety of any strings
+        if not _is_string_safe(value):
+          raise exception_hierarchy.CheckStrException(lineno, attribute, value)
+
+    # Only the default values of arguments are nodes in the compiler's tree
+    if nodetype is _ast.arguments:
+      fields = ('defaults',)
+    else:
+      fields = node._fields
+
+    # Push the children in reverse, so they are checked in order
+    for field in fields[::-1]:
+      value = nodedict.get(field)
+      if type(value) is list:
+        for child in value[::-1]:
+          if isinstance(child, ast_type) and not isinstance(child, node_parts):
+            pending.append((child, lineno))
+      elif isinstance(value, ast_type) and not isinstance(value, node_parts):
+        pending.append((value, lineno))
 
-  for child in node.getChildNodes():
-    _check_node(child)
 
 
+# The builtin may have been replaced by the time safe_check is called
+_saved_compile = compile
 
 def safe_check(code):
   """
   <Purpose>
     Takes the code as input, and parses it into an AST.
-    It then calls _check_node, which does a recursive safety check for every node.
+    It then calls _check_ast, which does a safety check for every node.
   
   <Arguments>
     code: A string representation of python code
@@ -278,36 +417,270 @@ def safe_check(code):
   <Return>
     None
   """
-  parsed_ast = compiler.parse(code)
-  _check_node(parsed_ast)
+  parsed_ast = _saved_compile(code, "<string>", "exec", _ast.PyCF_ONLY_AST)
+  _check_ast(parsed_ast)
 
 
 # End of the code safety checking implementation
 # Start code safety checking wrappers
 
 
-def safe_check_subprocess(code):
+# Whether checks are handed to long-lived safe_check.py worker processes.
+# Waiting for a worker's reply with a timeout needs select() on a pipe,
+# which Windows doesn't support, so there every check starts a new process.
+SAFE_CHECK_WORKERS_SUPPORTED = os.name == "posix"
+
+# The most checks that run at the same time, each in its own process
+SAFE_CHECK_WORKERS = 2
+
+# A worker exits after this many checks, or once it uses this much memory.
+# This way the memory used by the AST is still reclaimed, which is why the
+# checks run in another process in the first place.
+SAFE_CHECK_WORKER_MAX_CHECKS = 50
+SAFE_CHECK_WORKER_MAX_MEMORY = 64 * 1024 * 1024
+
+# How long (in seconds) a worker may sit idle before it is told to exit.
+# Most programs only have code checked while they start up, so there is no
+# point in keeping the workers around after that.
+SAFE_CHECK_WORKER_IDLE_TIMEOUT = 10.0
+
+
+def _get_path_to_safe_check():
+  # Get the path to safe_check.py by using the original start directory of python
+  return os.path.join(repy_constants.REPY_START_DIR, "safe_check.py")
+
+
+
+class _SafeCheckWorker(object):
+  """
+  A safe_check.py process started with --worker, which checks one piece of
+  code after another. See safe_check.py for the protocol.
+  """
+
+  def __init__(self):
+    # The worker outlives the call that starts it, so it must not hold on to
+    # the program's sockets and files. Otherwise, for example, closing a
+    # connection wouldn't close it until the worker exits.
+    self.proc = subprocess.Popen([sys.executable, _get_path_to_safe_check(),
+        "--worker", str(SAFE_CHECK_WORKER_MAX_CHECKS),
+        str(SAFE_CHECK_WORKER_MAX_MEMORY)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+
+    # Set once the worker has exited or must not be used again
+    self.retired = False
+
+    # The runtime at which the worker last finished a check
+    self.lastused = nonportable.getruntime()
+
+
+  def send(self, code):
+    """
+    Sends code to be checked. Returns False if the worker is gone.
+    """
+    try:
+      self.proc.stdin.write(str(len(code)) + "\n" + code)
+      self.proc.stdin.flush()
+    except (IOError, OSError):
+      self.close()
+      return False
+    return True
+
+
+  def receive(self):
+    """
+    Waits up to EVALUTATION_TIMEOUT seconds for the output of the check.
+    """
+    stdoutfd = self.proc.stdout.fileno()
+    starttime = nonportable.getruntime()
+    data = ""
+    length = None
+
+    while True:
+      if length is None:
+        # Anything before the header is debugging output from the
+        # interpreter, like on Android (#1080).
+        headerstart = data.find("SAFECHECK ")
+        if headerstart != -1 and "\n" in data[headerstart:]:
+          headerend = data.index("\n", headerstart)
+          header = data[headerstart:headerend].split()
+          length = int(header[1])
+          if header[2] == "1":
+            self.retired = True
+          data = data[headerend + 1:]
+
+      if length is not None and len(data) >= length:
+        if self.retired:
+          self.close()
+        return data[:length]
+
+      remaining = EVALUTATION_TIMEOUT - (nonportable.getruntime() - starttime)
+      if remaining <= 0:
+        # Kill the timed-out process
+        self.kill()
+        raise Exception, "Evaluation of code safety exceeded timeout threshold \
+                    ("+str(nonportable.getruntime() - starttime)+" seconds)"
+
+      try:
+        readable = select.select([stdoutfd], [], [], remaining)[0]
+      except select.error, e:
+        if e[0] == errno.EINTR:
+          continue
+        raise
+
+      if readable:
+        chunk = os.read(stdoutfd, 65536)
+        if not chunk:
+          # The worker died. The caller treats no output as a fatal error.
+          self.close()
+          return ""
+        data += chunk
+
+
+  def close(self):
+    """
+    Makes the worker exit, if it hasn't already, and waits for it.
+    """
+    self.retired = True
+    try:
+      self.proc.stdin.close()
+      self.proc.stdout.close()
+      self.proc.wait()
+    except (IOError, OSError):
+      pass
+
+
+  def kill(self):
+    """
+    Kills the worker, for when it can't be trusted to exit by itself.
+    """
+    # Once the worker was waited for, its pid may belong to another process
+    if self.proc.poll() is None:
+      try:
+        harshexit.portablekill(self.proc.pid)
+      except:
+        pass
+    self.close()
+
+
+
+# The workers which aren't checking anything right now, the one used least
+# recently first
+_idle_safe_check_workers = []
+_idle_safe_check_workers_lock = threading.Lock()
+
+# The threading.Timer which retires idle workers, or None if it isn't
+# pending. Protected by _idle_safe_check_workers_lock.
+_idle_safe_check_worker_sweeper = None
+
+
+# Runs from a timer, so that idle workers exit even when no more code is
+# checked
+def _sweep_idle_safe_check_workers():
+  global _idle_safe_check_worker_sweeper
+
+  expired = []
+  _idle_safe_check_workers_lock.acquire()
+  try:
+    _idle_safe_check_worker_sweeper = None
+    now = nonportable.getruntime()
+    while _idle_safe_check_workers and \
+        now - _idle_safe_check_workers[0].lastused >= SAFE_CHECK_WORKER_IDLE_TIMEOUT:
+      expired.append(_idle_safe_check_workers.pop(0))
+    _schedule_idle_safe_check_worker_sweep()
+  finally:
+    _idle_safe_check_workers_lock.release()
+
+  # Waiting for them to exit doesn't need the lock
+  for worker in expired:
+    worker.close()
+
+
+
+# Starts the timer which retires idle workers, unless it is already pending
+# or there are no idle workers. The lock must be held.
+def _schedule_idle_safe_check_worker_sweep():
+  global _idle_safe_check_worker_sweeper
+
+  if _idle_safe_check_worker_sweeper is not None or not _idle_safe_check_workers:
+    return
+
+  # Wake up when the worker that was idle the longest expires. Don't spin
+  # if the clock is slightly off.
+  delay = _idle_safe_check_workers[0].lastused + SAFE_CHECK_WORKER_IDLE_TIMEOUT - nonportable.getruntime()
+  delay = max(delay, 0.1)
+
+  _idle_safe_check_worker_sweeper = threading.Timer(delay, _sweep_idle_safe_check_workers)
+  _idle_safe_check_worker_sweeper.setDaemon(True)
+  _idle_safe_check_worker_sweeper.start()
+
+
+def _safe_check_in_worker(code):
   """
   <Purpose>
-    Runs safe_check() in a subprocess. This is done because the AST safe_check()
-    creates uses a large amount of RAM. By running safe_check() in a subprocess
-    we can guarantee that the memory will be reclaimed when the process ends.
-  
+    Has an idle worker check code, starting a new one if there is none.
+
   <Arguments>
     code: See safe_check.
-    
+
   <Exceptions>
-    As with safe_check.
-  
+    Exception if the check takes longer than EVALUTATION_TIMEOUT.
+
   <Return>
-    See safe_check.
+    The output of safe_check.py.
+  """
+  _idle_safe_check_workers_lock.acquire()
+  try:
+    if _idle_safe_check_workers:
+      worker = _idle_safe_check_workers.pop()
+    else:
+      worker = None
+  finally:
+    _idle_safe_check_workers_lock.release()
+
+  # An idle worker may have been killed since it was last used. If so, this
+  # is no fault of the code, so try again with a new one.
+  if worker is None or not worker.send(code):
+    worker = _SafeCheckWorker()
+    if not worker.send(code):
+      return ""
+
+  try:
+    output = worker.receive()
+  except:
+    # E.g. garbage where the reply header should be. The worker may be out
+    # of step with us or stuck, so it must not be used or waited for.
+    worker.kill()
+    raise
+
+  if not worker.retired:
+    worker.lastused = nonportable.getruntime()
+    _idle_safe_check_workers_lock.acquire()
+    try:
+      _idle_safe_check_workers.append(worker)
+      _schedule_idle_safe_check_worker_sweep()
+    finally:
+      _idle_safe_check_workers_lock.release()
+
+  return output
+
+
+
+def _safe_check_in_new_process(code):
+  """
+  <Purpose>
+    Runs safe_check.py in a new process to check code.
+
+  <Arguments>
+    code: See safe_check.
+
+  <Exceptions>
+    Exception if the check takes longer than EVALUTATION_TIMEOUT.
+
+  <Return>
+    The output of safe_check.py.
   """
-  
-  # Get the path to safe_check.py by using the original start directory of python
-  path_to_safe_check = os.path.join(repy_constants.REPY_START_DIR, "safe_check.py")
-  
   # Start a safety check process, reading from the user code and outputing to a pipe we can read
-  proc = subprocess.Popen([sys.executable, path_to_safe_check],stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  proc = subprocess.Popen([sys.executable, _get_path_to_safe_check()],stdin=subprocess.PIPE, stdout=subprocess.PIPE)
   
   # Write out the user code, close so the other end gets an EOF
   proc.stdin.write(code)
@@ -373,6 +746,35 @@ def safe_check_subprocess(code):
   else: # We are *not* running on Android, proceed with unfiltered output
     output = rawoutput
 
+  return output
+
+
+
+def safe_check_subprocess(code):
+  """
+  <Purpose>
+    Runs safe_check() in a subprocess. This is done because the AST safe_check()
+    creates uses a large amount of RAM. By running safe_check() in a subprocess
+    we can guarantee that the memory will be reclaimed when the process ends.
+
+    Where possible the subprocess is a worker which is reused for later
+    checks, until it has done SAFE_CHECK_WORKER_MAX_CHECKS checks, uses
+    SAFE_CHECK_WORKER_MAX_MEMORY bytes, or has been idle for
+    SAFE_CHECK_WORKER_IDLE_TIMEOUT seconds.
+  
+  <Arguments>
+    code: See safe_check.
+    
+  <Exceptions>
+    As with safe_check.
+  
+  <Return>
+    See safe_check.
+  """
+  if SAFE_CHECK_WORKERS_SUPPORTED:
+    output = _safe_check_in_worker(code)
+  else:
+    output = _safe_check_in_new_process(code)
 
   # Check the output, None is success, else it is a failure
   if output == "None":
@@ -386,16 +788,216 @@ def safe_check_subprocess(code):
     # Raise the error from the output
     raise exception_hierarchy.SafeException, output
 
-# Get a lock for serial_safe_check
-SAFE_CHECK_LOCK = threading.Lock()
+# The directory where the results of safety checks and the compiled code
+# are cached, or None to always check and compile the code. This is set by
+# repy.py's --codecache option. The directory must not be writable by the
+# sandboxed code or by other users (see is_private_cache_dir()), since
+# anyone who can create an entry there can have any code treated as safe,
+# or replace the compiled code.
+SAFE_CHECK_CACHE_DIR = None
+
+# Saved while we still can, since getattr is not available later. This is
+# None on Windows.
+_geteuid = getattr(os, "geteuid", None)
+
+# Increase this whenever the way code is checked changes in a way that is not
+# reflected in the tables below, so that old cache entries are ignored.
+SAFE_CHECK_CACHE_VERSION = 2
+
+# Identifies the bytecode format of compiled code in the cache
+_BYTECODE_MAGIC = imp.get_magic()
+
+
+def is_private_cache_dir(dirpath):
+  """
+  <Purpose>
+    Checks that nobody but the user running repy can create files in a
+    directory, so that it can be used as SAFE_CHECK_CACHE_DIR.
+
+  <Arguments>
+    dirpath: The path of the directory.
+
+  <Exceptions>
+    None
+
+  <Return>
+    True if dirpath is a directory owned by the effective user which its
+    group and others can't write to, False otherwise. Always False on
+    systems without user ids (Windows), since there is no portable way to
+    check the permissions there.
+  """
+  if _geteuid is None:
+    return False
+
+  try:
+    dirstat = os.stat(dirpath)
+  except OSError:
+    return False
+
+  return (stat.S_ISDIR(dirstat.st_mode) and dirstat.st_uid == _geteuid()
+      and dirstat.st_mode & 022 == 0)
+
+
+
+def _get_safe_check_policy():
+  """
+  <Purpose>
+    Describes everything that decides whether code passes the safety check
+    and is allowed to run, so that cache entries made under one policy are
+    never used under another.
+
+  <Arguments>
+    None
+
+  <Exceptions>
+    None
+
+  <Return>
+    A string.
+  """
+  replaced_builtins = _BUILTIN_REPLACE.keys()
+  replaced_builtins.sort()
+
+  return repr((SAFE_CHECK_CACHE_VERSION, sys.version, _STR_OK,
+      _STR_NOT_CONTAIN, _STR_NOT_BEGIN, _STR_NOT_ALLOWED, _NODE_CLASS_OK,
+      _NODE_ATTR_OK, _BUILTIN_OK, replaced_builtins, _BUILTIN_STR))
+
+
+
+def _get_safe_check_cache_entry(code):
+  """
+  <Purpose>
+    Returns the path of the file whose existence records that code passed
+    the safety check under the current policy.
+
+  <Arguments>
+    code: See safe_check.
+
+  <Exceptions>
+    None
+
+  <Return>
+    The path, or None if there is no cache or code is not a str.
+  """
+  if SAFE_CHECK_CACHE_DIR is None or type(code) is not str:
+    return None
+
+  # Hash the policy separately so that no choice of code can make the
+  # combination ambiguous.
+  policyhash = hashlib.sha256(_get_safe_check_policy()).hexdigest()
+  entryname = hashlib.sha256(policyhash + code).hexdigest()
+  return os.path.join(SAFE_CHECK_CACHE_DIR, entryname)
+
+
+
+def _write_cache_entry(entrypath, data):
+  """
+  <Purpose>
+    Stores data as the cache entry entrypath. Problems with the cache
+    directory are ignored, since the only consequence is that the work will
+    be done again next time.
+
+  <Arguments>
+    entrypath: The path of the entry in SAFE_CHECK_CACHE_DIR.
+    data: The string to store.
+
+  <Exceptions>
+    None
+
+  <Return>
+    None
+  """
+  # Create the entry under a temporary name and rename it, so that an entry
+  # that exists is always complete.
+  temppath = entrypath + "." + str(os.getpid()) + ".tmp"
+  try:
+    fd = os.open(temppath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    try:
+      while data:
+        data = data[os.write(fd, data):]
+    finally:
+      os.close(fd)
+    os.rename(temppath, entrypath)
+  except OSError:
+    try:
+      os.remove(temppath)
+    except OSError:
+      pass
+
+
+
+def _read_cache_entry(entrypath):
+  """
+  <Purpose>
+    Reads the cache entry entrypath.
+
+  <Arguments>
+    entrypath: The path of the entry in SAFE_CHECK_CACHE_DIR.
+
+  <Exceptions>
+    None
+
+  <Return>
+    The contents of the entry, or None if it can't be read.
+  """
+  try:
+    fd = os.open(entrypath, os.O_RDONLY)
+  except OSError:
+    return None
+
+  chunks = []
+  try:
+    try:
+      while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+          break
+        chunks.append(chunk)
+    except OSError:
+      return None
+  finally:
+    os.close(fd)
 
-# Wraps safe_check to serialize calls
+  return "".join(chunks)
+
+
+
+def _add_safe_check_cache_entry(entrypath):
+  """
+  <Purpose>
+    Records that the code which entrypath was created for passed the safety
+    check.
+
+  <Arguments>
+    entrypath: The path returned by _get_safe_check_cache_entry().
+
+  <Exceptions>
+    None
+
+  <Return>
+    None
+  """
+  _write_cache_entry(entrypath, "safe\n")
+
+
+
+# Limits how many checks serial_safe_check runs at the same time
+if SAFE_CHECK_WORKERS_SUPPORTED:
+  SAFE_CHECK_SEMAPHORE = threading.Semaphore(SAFE_CHECK_WORKERS)
+else:
+  SAFE_CHECK_SEMAPHORE = threading.Semaphore(1)
+
+# Wraps safe_check to limit concurrent calls
 def serial_safe_check(code):
   """
   <Purpose>
-    Serializes calls to safe_check_subprocess(). This is because safe_check_subprocess()
-    creates a new process which may take many seconds to return. This prevents us from
-    creating many new python processes.
+    Limits the number of concurrent calls to safe_check_subprocess(). This is because
+    safe_check_subprocess() uses a process which may take many seconds to return. This
+    prevents us from creating many new python processes. Up to SAFE_CHECK_WORKERS
+    checks run in parallel where workers are supported, otherwise calls are serialized.
+
+    If SAFE_CHECK_CACHE_DIR is set, code which already passed the check under
+    the current policy is not checked again.
   
   <Arguments>
     code: See safe_check.
@@ -403,15 +1005,107 @@ def serial_safe_check(code):
   <Exceptions>
     As with safe_check.
   
+  <Side Effects>
+    Adds an entry to the cache if the code passes the check.
+
   <Return>
     See safe_check.
   """
+  entrypath = _get_safe_check_cache_entry(code)
+  if entrypath is not None and os.path.isfile(entrypath):
+    return True
 
-  SAFE_CHECK_LOCK.acquire()
+  SAFE_CHECK_SEMAPHORE.acquire()
   try:
-    return safe_check_subprocess(code)
+    result = safe_check_subprocess(code)
   finally:
-    SAFE_CHECK_LOCK.release()
+    SAFE_CHECK_SEMAPHORE.release()
+
+  # Only successful checks are cached. Failures raise above.
+  if entrypath is not None:
+    _add_safe_check_cache_entry(entrypath)
+
+  return result
+
+
+
+def _get_compiled_code_cache_entry(code, name):
+  """
+  <Purpose>
+    Finds the cache entry for the compiled form of code. Compiled code is
+    only cached for code that passed the safety check, so there is no entry
+    unless the code has a safety check cache entry.
+
+  <Arguments>
+    code: The code to compile.
+    name: The file name the code is compiled under.
+
+  <Exceptions>
+    None
+
+  <Return>
+    The path of the entry, or None if there is none.
+  """
+  entrypath = _get_safe_check_cache_entry(code)
+  if entrypath is None or type(name) is not str or not os.path.isfile(entrypath):
+    return None
+
+  # The compiled code is run without being checked, so it is only ever
+  # loaded from (or stored in) a directory nobody else can write to. This
+  # is checked again here in case SAFE_CHECK_CACHE_DIR was not set up by
+  # repy.py.
+  if not is_private_cache_dir(SAFE_CHECK_CACHE_DIR):
+    return None
+
+  # The code objects depend on the name (for tracebacks) and on the
+  # bytecode format of this interpreter.
+  compiledname = hashlib.sha256(_BYTECODE_MAGIC + sys.version + "\n" + name).hexdigest()
+  return entrypath + "-" + compiledname + ".code"
+
+
+
+def compile_checked_code(code, name):
+  """
+  <Purpose>
+    Compiles code which passed serial_safe_check(), like
+    compile(code, name, "exec").
+
+    If SAFE_CHECK_CACHE_DIR is set, the compiled code is stored there, and
+    later compiles of the same code under the same name by the same
+    interpreter load it from there instead of compiling again.
+
+  <Arguments>
+    code: The code to compile.
+    name: The file name the code is compiled under.
+
+  <Exceptions>
+    As with compile().
+
+  <Side Effects>
+    May add an entry to the cache.
+
+  <Return>
+    A code object.
+  """
+  entrypath = _get_compiled_code_cache_entry(code, name)
+
+  if entrypath is not None:
+    data = _read_cache_entry(entrypath)
+    if data is not None:
+      try:
+        codeobj = marshal.loads(data)
+      except (EOFError, ValueError, TypeError):
+        codeobj = None
+      # A damaged entry is simply replaced below
+      if _type(codeobj) is _compile_type:
+        return codeobj
+
+  codeobj = _saved_compile(code, name, "exec")
+
+  if entrypath is not None:
+    _write_cache_entry(entrypath, marshal.dumps(codeobj))
+
+  return codeobj
 
 #End of static analysis portion
 
@@ -627,6 +1321,44 @@ def get_SafeDict(*args,**kwargs):
   return SafeDict(*args,**kwargs)
 
 
+# Keys of type str which are known to be valid SafeDict keys. Looking a key
+# up here is much cheaper than checking it with _is_string_safe() again.
+# It is emptied when it gets too large, so that programs which use many
+# different keys can't make it grow without bound.
+_safe_dict_valid_keys = set()
+_SAFE_DICT_VALID_KEYS_MAX = 10000
+
+def _check_safe_dict_key(key):
+  """
+  <Purpose>
+    Checks that key may be used in a SafeDict, and remembers it in
+    _safe_dict_valid_keys if it may.
+
+  <Arguments>
+    key: The key to check.
+
+  <Exceptions>
+    TypeError if key is not a string.
+    ValueError if key is not safe.
+
+  <Return>
+    None
+  """
+  if type(key) is not str and type(key) is not unicode:
+    raise TypeError, "'SafeDict' keys must be of string type!"
+  if not _is_string_safe(key):
+    raise ValueError, "Unsafe key: '"+key+"'"
+
+  # Only exact strings are remembered, so the fast path in SafeDict (which
+  # checks the type first) never accepts a str subclass or other object
+  # which merely compares equal to a valid key.
+  if _type(key) is str:
+    if len(_safe_dict_valid_keys) >= _SAFE_DICT_VALID_KEYS_MAX:
+      _safe_dict_valid_keys.clear()
+    _safe_dict_valid_keys.add(key)
+
+
+
 class SafeDict(UserDict.DictMixin):
   """
   <Purpose>
@@ -638,6 +1370,9 @@ class SafeDict(UserDict.DictMixin):
     important to prevent unsafe keys is because it is possible to use them to
     break out of the sandbox. For example, it is possible to change an object's
     private variables by manually bypassing python's name mangling.
+
+    Keys which were already found to be safe are remembered in
+    _safe_dict_valid_keys, so the common case only costs a set lookup.
   """
 
   def __init__(self,from_dict=None):
@@ -656,62 +1391,50 @@ class SafeDict(UserDict.DictMixin):
       if key in ["__builtins__","__doc__"]:
         continue
 
-      # Check the key type
-      if type(key) is not str and type(key) is not unicode:
-        raise TypeError, "'SafeDict' keys must be of string type!"
+      # Throw an exception if the key is not a string or unsafe
+      if _type(key) is not str or key not in _safe_dict_valid_keys:
+        _check_safe_dict_key(key)
 
-      # Check if the key is safe
-      if _is_string_safe(key):
-        self.__under__[key] = value
-
-      # Throw an exception if the key is unsafe
-      else:
-        raise ValueError, "Unsafe key: '"+key+"'"
+      self.__under__[key] = value
 
   # Allow getting items
   def __getitem__(self,key):
-    if type(key) is not str and type(key) is not unicode:
-      raise TypeError, "'SafeDict' keys must be of string type!"
-    if not _is_string_safe(key):
-      raise ValueError, "Unsafe key: '"+key+"'"
+    if _type(key) is not str or key not in _safe_dict_valid_keys:
+      _check_safe_dict_key(key)
 
-    return self.__under__.__getitem__(key)
+    return self.__under__[key]
 
   # Allow setting items
   def __setitem__(self,key,value):
-    if type(key) is not str and type(key) is not unicode:
-      raise TypeError, "'SafeDict' keys must be of string type!"
-    if not _is_string_safe(key):
-      raise ValueError, "Unsafe key: '"+key+"'"
+    if _type(key) is not str or key not in _safe_dict_valid_keys:
+      _check_safe_dict_key(key)
 
-    return self.__under__.__setitem__(key,value)
+    self.__under__[key] = value
 
   # Allow deleting items
   def __delitem__(self,key):
-    if type(key) is not str and type(key) is not unicode:
-      raise TypeError, "'SafeDict' keys must be of string type!"
-    if not _is_string_safe(key):
-      raise ValueError, "Unsafe key: '"+key+"'"
+    if _type(key) is not str or key not in _safe_dict_valid_keys:
+      _check_safe_dict_key(key)
 
-    return self.__under__.__delitem__(key)
+    del self.__under__[key]
 
   # Allow checking if a key is set
   def __contains__(self,key):
-    if type(key) is not str and type(key) is not unicode:
-      raise TypeError, "'SafeDict' keys must be of string type!"
-    if not _is_string_safe(key):
-      raise ValueError, "Unsafe key: '"+key+"'"
+    if _type(key) is not str or key not in _safe_dict_valid_keys:
+      _check_safe_dict_key(key)
 
     return key in self.__under__
 
   # Return the key set
   def keys(self):
 
-    # Filter out the unsafe keys from the underlying dict
+    # Filter out the unsafe keys from the underlying dict. A key which
+    # merely compares equal to a valid key gets the same answer from
+    # _is_string_safe(), so the lookup needs no type check here.
     safe_keys = []
 
-    for key in self.__under__.iterkeys():
-      if _is_string_safe(key):
+    for key in self.__under__:
+      if key in _safe_dict_valid_keys or _is_string_safe(key):
         safe_keys.append(key)
 
     # Return the safe keys
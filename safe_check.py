@@ -7,26 +7,109 @@ Description:
   The purpose of this script is to be called from the main repy.py script so that the
   memory used by the safe.safe_check() will be reclaimed when this process quits.
 
+  When started as "safe_check.py --worker MAXCHECKS MAXMEMORY", it instead
+  checks one piece of code after another, so that the interpreter doesn't
+  have to be started for every check. Each request is a line with the
+  length of the code, followed by the code. Each reply is a line of the
+  form "SAFECHECK <length of output> <retiring>", followed by the output.
+  After MAXCHECKS checks, or once the process uses more than MAXMEMORY
+  bytes, retiring is 1 and the worker exits, so that the memory used by the
+  checks is still reclaimed. It also exits when stdin is closed.
 """
 
+import os
 import safe
 import sys
 
-if __name__ == "__main__":
-  # Get the user "code"
-  usercode = sys.stdin.read()
-  
+try:
+  import resource
+except ImportError:
+  # Not available on Windows
+  resource = None
+
+
+def check_code(usercode):
   # Output buffer
   output = ""
-  
+
   # Check the code
   try:
     value = safe.safe_check(usercode)
     output += str(value)
   except Exception,e:
     output += str(type(e)) + " " + str(e)
-  
-  # Write out
-  sys.stdout.write(output)
-  sys.stdout.flush()
-  
+
+  return output
+
+
+
+def get_peak_memory():
+  """
+  Returns the most memory this process has used so far, in bytes, or 0 if
+  that can't be determined.
+  """
+  if resource is None:
+    return 0
+
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux and the BSDs use kilobytes, Mac OS X uses bytes
+  if sys.platform == "darwin":
+    return maxrss
+  return maxrss * 1024
+
+
+
+def get_current_memory():
+  """
+  Returns the memory this process is using right now (its resident set
+  size), in bytes. Where that can't be determined, this is the most memory
+  it has used so far instead.
+  """
+  try:
+    statmfo = open("/proc/self/statm")
+    try:
+      fields = statmfo.read().split()
+    finally:
+      statmfo.close()
+    return int(fields[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (IOError, OSError, ValueError, IndexError):
+    # No /proc, e.g. on Mac OS X and the BSDs
+    return get_peak_memory()
+
+
+
+def run_worker(maxchecks, maxmemory):
+  checks = 0
+
+  while True:
+    header = sys.stdin.readline()
+    if not header:
+      # The other end closed the pipe, we are done
+      break
+
+    usercode = sys.stdin.read(int(header))
+    output = check_code(usercode)
+    checks += 1
+
+    retiring = checks >= maxchecks or get_current_memory() > maxmemory
+
+    sys.stdout.write("SAFECHECK " + str(len(output)) + " " + str(int(retiring)) + "\n")
+    sys.stdout.write(output)
+    sys.stdout.flush()
+
+    if retiring:
+      break
+
+
+
+if __name__ == "__main__":
+  if len(sys.argv) == 4 and sys.argv[1] == "--worker":
+    run_worker(int(sys.argv[2]), int(sys.argv[3]))
+
+  else:
+    # Get the user "code"
+    usercode = sys.stdin.read()
+
+    # Write out
+    sys.stdout.write(check_code(usercode))
+    sys.stdout.flush()
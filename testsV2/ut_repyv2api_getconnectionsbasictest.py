@@ -0,0 +1,43 @@
+"""
+This unit test checks the TCPServerSocket.getconnections() API call.
+"""
+
+#pragma repy
+#pragma repy restrictions.threeports
+
+server = listenforconnection('127.0.0.1', 12345)
+
+client1 = openconnection('127.0.0.1', 12345, '127.0.0.1', 12346, 5)
+client2 = openconnection('127.0.0.1', 12345, '127.0.0.1', 12347, 5)
+
+# Give the connections a moment to arrive
+sleep(0.1)
+
+connections = server.getconnections(10)
+
+if len(connections) != 2:
+  log("Expected 2 connections, got " + str(len(connections)), '\n')
+
+ports = []
+for (ip, port, conn) in connections:
+  if ip != '127.0.0.1':
+    log("Wrong remote ip: " + ip, '\n')
+  ports.append(port)
+  conn.send("hi")
+  conn.close()
+
+ports.sort()
+if ports != [12346, 12347]:
+  log("Wrong remote ports: " + str(ports), '\n')
+
+# The backlog is now drained
+try:
+  server.getconnections(1)
+except SocketWouldBlockError:
+  pass
+else:
+  log("getconnections() did not block with no pending connections!", '\n')
+
+client1.close()
+client2.close()
+server.close()
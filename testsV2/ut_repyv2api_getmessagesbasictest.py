@@ -0,0 +1,45 @@
+"""
+This unit test checks the UDPServerSocket.getmessages() API call.
+"""
+
+#pragma repy
+#pragma repy restrictions.twoports
+
+s = listenformessage('127.0.0.1', 12345)
+
+data = ["HI"*8, "BYE"*4, "OK"]
+
+for mess in data:
+  sendmessage('127.0.0.1', 12345, mess, '127.0.0.1', 12346)
+
+# Give the messages a moment to arrive
+sleep(0.1)
+
+# We should get no more than we ask for...
+first = s.getmessages(2)
+if len(first) != 2:
+  log("Expected 2 messages, got " + str(len(first)), '\n')
+
+# ... and then whatever is left
+rest = s.getmessages(10)
+if len(rest) != 1:
+  log("Expected 1 message, got " + str(len(rest)), '\n')
+
+received = []
+for (rip, rport, mess) in first + rest:
+  if rip != '127.0.0.1' or rport != 12346:
+    log("Wrong sender: " + rip + ":" + str(rport), '\n')
+  received.append(mess)
+
+if received != data:
+  log("Mismatch!", '\n')
+
+# The socket is now drained
+try:
+  s.getmessages(1)
+except SocketWouldBlockError:
+  pass
+else:
+  log("getmessages() did not block on an empty socket!", '\n')
+
+s.close()
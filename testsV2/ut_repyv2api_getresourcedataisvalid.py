@@ -32,6 +32,8 @@ expected = {"cpu":0.1,
             "random":10000,
             "messport":set([12345]),
             "connport":set([12345]),
+            "socketbuffer":0,
+            "listenbacklog":0,
            }
 
 # Check everything
@@ -0,0 +1,49 @@
+"""
+This unit test checks the EmulatedSocket.getstatistics() API call.
+"""
+
+#pragma repy restrictions.twoports
+
+server = listenforconnection('127.0.0.1', 12345)
+client = openconnection('127.0.0.1', 12345, '127.0.0.1', 12346, 5)
+sleep(0.1)
+ip, port, conn = server.getconnection()
+
+# Nothing has happened yet
+stats = client.getstatistics()
+for key in ["bytessent", "bytesreceived", "sendcalls", "recvcalls", "wouldblock"]:
+  if stats[key] != 0:
+    log("Expected no " + key + ", got " + str(stats[key]), '\n')
+
+# There is nothing to receive yet
+try:
+  conn.recv(10)
+except SocketWouldBlockError:
+  pass
+
+client.send("hello")
+sleep(0.1)
+conn.recv(100)
+
+stats = client.getstatistics()
+if stats["bytessent"] != 5 or stats["sendcalls"] != 1:
+  log("Wrong send statistics: " + str(stats), '\n')
+
+stats = conn.getstatistics()
+if stats["bytesreceived"] != 5 or stats["recvcalls"] != 2 or stats["wouldblock"] != 1:
+  log("Wrong recv statistics: " + str(stats), '\n')
+
+if stats["throttletime"] < 0:
+  log("Negative throttle time: " + str(stats["throttletime"]), '\n')
+
+# The OS statistics depend on the platform
+if "rtt" in stats and type(stats["rtt"]) is not float:
+  log("The round trip time should be a float!", '\n')
+
+# The counters are still there after close
+client.close()
+if client.getstatistics()["bytessent"] != 5:
+  log("The statistics were lost on close!", '\n')
+
+conn.close()
+server.close()
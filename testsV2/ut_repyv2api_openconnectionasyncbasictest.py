@@ -0,0 +1,44 @@
+"""
+This unit test checks the openconnectionasync() API call.
+"""
+
+#pragma repy
+#pragma repy restrictions.twoports
+
+server = listenforconnection('127.0.0.1', 12345)
+
+pending = openconnectionasync('127.0.0.1', 12345, '127.0.0.1', 12346, 5)
+client = pending.wait(5)
+
+# Once connected, poll() keeps returning the connection
+pending.poll()
+
+if pending.cancel():
+  log("Should not be able to cancel a finished connection!", '\n')
+
+# Get the other end
+while True:
+  try:
+    (ip, port, serverconn) = server.getconnection()
+    break
+  except SocketWouldBlockError:
+    sleep(0.01)
+
+client.send("hello")
+sleep(0.1)
+if serverconn.recv(5) != "hello":
+  log("Mismatch!", '\n')
+
+client.close()
+serverconn.close()
+server.close()
+
+
+# A refused connection is reported, either right away or by wait()
+try:
+  pending = openconnectionasync('127.0.0.1', 12345, '127.0.0.1', 12346, 5)
+  pending.wait(5)
+except ConnectionRefusedError:
+  pass
+else:
+  log("The connection should have been refused!", '\n')
@@ -0,0 +1,64 @@
+"""
+This unit test checks the EmulatedSocket.sendfile() API call.
+"""
+
+#pragma repy restrictions.twoports
+
+FILENAME = "junk_test_sendfile.out"
+CONTENTS = "0123456789" * 100
+
+if FILENAME in listfiles():
+  removefile(FILENAME)
+
+fileobj = openfile(FILENAME, True)
+fileobj.writeat(CONTENTS, 0)
+
+server = listenforconnection('127.0.0.1', 12345)
+client = openconnection('127.0.0.1', 12345, '127.0.0.1', 12346, 5)
+sleep(0.1)
+ip, port, conn = server.getconnection()
+
+# Send part of the file, starting in the middle
+sent = client.sendfile(fileobj, 5, 500)
+if sent != 500:
+  log("Expected to send 500 bytes, sent " + str(sent), '\n')
+
+sleep(0.1)
+received = ""
+while len(received) < sent:
+  received += conn.recv(1000)
+
+if received != CONTENTS[5:505]:
+  log("Received the wrong data: " + received, '\n')
+
+# Nothing is left at the end of the file
+if client.sendfile(fileobj, len(CONTENTS), 100) != 0:
+  log("Sending from the end of the file should send nothing!", '\n')
+
+try:
+  client.sendfile(fileobj, len(CONTENTS) + 1, 100)
+except SeekPastEndOfFileError:
+  pass
+else:
+  log("Sending from past the end of the file should fail!", '\n')
+
+try:
+  client.sendfile("not a file", 0, 100)
+except RepyArgumentError:
+  pass
+else:
+  log("sendfile() should only accept a file!", '\n')
+
+fileobj.close()
+
+try:
+  client.sendfile(fileobj, 0, 100)
+except FileClosedError:
+  pass
+else:
+  log("Sending from a closed file should fail!", '\n')
+
+conn.close()
+client.close()
+server.close()
+removefile(FILENAME)
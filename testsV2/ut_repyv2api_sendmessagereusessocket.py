@@ -0,0 +1,31 @@
+"""
+This unit test checks that sendmessage() reuses one socket per local IP
+and port, and that listenformessage() takes that socket over.
+"""
+
+#pragma repy
+#pragma repy restrictions.twoports
+
+for count in range(20):
+  sendmessage('127.0.0.1', 12345, "HI", '127.0.0.1', 12346)
+
+lim, usage, stops = getresources()
+if usage["outsockets"] != 1:
+  log("Expected 1 outsocket, got " + str(usage["outsockets"]), '\n')
+
+# Listening on the same IP and port must work while the socket is pooled
+s = listenformessage('127.0.0.1', 12346)
+
+lim, usage, stops = getresources()
+if usage["outsockets"] != 0 or usage["insockets"] != 1:
+  log("The listening socket was not moved to the insockets!", '\n')
+
+sendmessage('127.0.0.1', 12345, "HI", '127.0.0.1', 12346)
+s.close()
+
+lim, usage, stops = getresources()
+if usage["insockets"] != 0:
+  log("The insocket was not released!", '\n')
+
+# After closing, sending from the port works again
+sendmessage('127.0.0.1', 12345, "HI", '127.0.0.1', 12346)
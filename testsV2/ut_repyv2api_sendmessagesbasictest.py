@@ -0,0 +1,42 @@
+"""
+This unit test checks the sendmessages() API call.
+"""
+
+#pragma repy
+#pragma repy restrictions.twoports
+
+s = listenformessage('127.0.0.1', 12345)
+
+data = ["HI"*8, "BYE"*4, "OK"]
+batch = []
+for mess in data:
+  batch.append(('127.0.0.1', 12345, mess))
+
+sent = sendmessages('127.0.0.1', 12346, batch)
+
+if sent != [16, 12, 2]:
+  log("Wrong byte counts: " + str(sent), '\n')
+
+# Give the messages a moment to arrive
+sleep(0.1)
+
+received = []
+for count in range(len(data)):
+  (rip, rport, mess) = s.getmessage()
+  received.append(mess)
+
+s.close()
+
+if received != data:
+  log("Mismatch!", '\n')
+
+# Malformed entries must be rejected before anything is sent
+try:
+  sendmessages('127.0.0.1', 12346, [('127.0.0.1', 12345)])
+except RepyArgumentError:
+  pass
+else:
+  log("Did not reject a malformed message!", '\n')
+
+if sendmessages('127.0.0.1', 12346, []) != []:
+  log("Sending nothing should send nothing!", '\n')
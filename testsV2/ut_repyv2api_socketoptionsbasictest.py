@@ -0,0 +1,63 @@
+"""
+This unit test checks the setsocketoption() and getsocketoption() calls on
+TCP sockets and TCPServerSockets.
+"""
+
+#pragma repy restrictions.twoports
+
+server = listenforconnection('127.0.0.1', 12345)
+
+# restrictions.twoports allows 5 outsockets, so the backlog is clamped to 5
+if server.getsocketoption("backlog") != 5:
+  log("Wrong initial backlog: " + str(server.getsocketoption("backlog")), '\n')
+
+if server.setsocketoption("backlog", 100) != 5:
+  log("The backlog was not clamped!", '\n')
+
+if server.setsocketoption("backlog", 2) != 2 or server.getsocketoption("backlog") != 2:
+  log("Could not lower the backlog!", '\n')
+
+client = openconnection('127.0.0.1', 12345, '127.0.0.1', 12346, 5)
+
+if client.setsocketoption("nodelay", True) is not True:
+  log("Could not set nodelay!", '\n')
+if client.getsocketoption("nodelay") is not True:
+  log("nodelay is not set!", '\n')
+
+client.setsocketoption("nodelay", False)
+if client.getsocketoption("nodelay") is not False:
+  log("nodelay is still set!", '\n')
+
+# The restrictions file has no socketbuffer entry, so buffers are fixed
+try:
+  client.setsocketoption("sendbuffer", 4096)
+except ResourceForbiddenError:
+  pass
+else:
+  log("Changing the send buffer should be forbidden!", '\n')
+
+# Unknown options and bad values are rejected
+try:
+  client.setsocketoption("backlog", 5)
+except RepyArgumentError:
+  pass
+else:
+  log("A TCP socket should not have a backlog!", '\n')
+
+try:
+  client.setsocketoption("keepalive", 1)
+except RepyArgumentError:
+  pass
+else:
+  log("keepalive should only accept a bool!", '\n')
+
+client.close()
+
+try:
+  client.getsocketoption("nodelay")
+except SocketClosedLocal:
+  pass
+else:
+  log("Reading an option of a closed socket should fail!", '\n')
+
+server.close()
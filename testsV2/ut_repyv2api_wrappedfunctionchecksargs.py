@@ -0,0 +1,38 @@
+"""
+This unit test checks that the namespace layer checks the arguments of API
+functions and methods before calling them.
+"""
+
+#pragma repy
+
+def expect_argument_error(func, args, kwargs, description):
+  try:
+    func(*args, **kwargs)
+  except RepyArgumentError:
+    pass
+  else:
+    log("Expected RepyArgumentError for " + description, '\n')
+
+
+# Functions
+expect_argument_error(getruntime, [1], {}, "too many arguments")
+expect_argument_error(sleep, [], {}, "too few arguments")
+expect_argument_error(sleep, ["1"], {}, "an argument of the wrong type")
+expect_argument_error(sleep, [], {"seconds" : 0}, "keyword arguments")
+
+# Methods implemented by our own objects
+fileobj = openfile("junk_test_wrappedfunction.out", True)
+expect_argument_error(fileobj.readat, [1], {}, "too few method arguments")
+expect_argument_error(fileobj.readat, [1, "0"], {}, "a method argument of the wrong type")
+expect_argument_error(fileobj.readat, [1, 0], {"extra" : 1}, "method keyword arguments")
+fileobj.close()
+removefile("junk_test_wrappedfunction.out")
+
+# Methods called by name on the real object
+lock = createlock()
+expect_argument_error(lock.acquire, [], {}, "too few lock arguments")
+expect_argument_error(lock.acquire, [1], {}, "a lock argument of the wrong type")
+
+if lock.acquire(True) is not True:
+  log("acquire() should return True", '\n')
+lock.release()
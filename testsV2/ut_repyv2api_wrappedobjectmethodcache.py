@@ -0,0 +1,45 @@
+"""
+This unit test checks that wrapped objects reuse the callables returned for
+their methods, and that they still hide everything they don't expose.
+"""
+
+#pragma repy
+
+lockobj = createlock()
+
+if lockobj.acquire is not lockobj.acquire:
+  log("Accessing the same method twice returned different callables", '\n')
+
+acquire = lockobj.acquire
+release = lockobj.release
+for count in range(100):
+  if not acquire(True):
+    log("Cached acquire() failed to acquire the lock", '\n')
+  release()
+
+# Each wrapper has its own callables, bound to its own object.
+otherlock = createlock()
+if otherlock.acquire is lockobj.acquire:
+  log("Two wrapped locks share the same bound method", '\n')
+
+lockobj.acquire(True)
+if not otherlock.acquire(False):
+  log("Acquiring one lock should not affect another", '\n')
+otherlock.release()
+lockobj.release()
+
+# Attributes that aren't allowed must stay hidden, cached or not.
+try:
+  lockobj.foo
+except AttributeError:
+  pass
+else:
+  log("Accessing a disallowed attribute should raise AttributeError", '\n')
+
+# Wrapped objects don't accept new attributes.
+try:
+  lockobj.foo = 1
+except AttributeError:
+  pass
+else:
+  log("Setting an attribute on a wrapped object should fail", '\n')
@@ -0,0 +1,91 @@
+"""
+This unit test checks the counters and histograms recorded by the API
+profiler, without running repy.
+"""
+
+import os
+import time
+
+import apiprofiler
+
+
+def succeed(value):
+  return value
+
+def fail():
+  raise ValueError("failed")
+
+def wait():
+  time.sleep(0.01)
+
+
+profiled_succeed = apiprofiler.profile_function("succeed", succeed)
+profiled_fail = apiprofiler.profile_function("fail", fail)
+profiled_wait = apiprofiler.profile_function("wait", wait)
+
+# Return values and exceptions are passed through
+for count in range(5):
+  if profiled_succeed(count) != count:
+    print "The profiled function returned the wrong value"
+
+try:
+  profiled_fail()
+except ValueError:
+  pass
+else:
+  print "The profiled function should have raised ValueError"
+
+profiled_wait()
+
+profile = apiprofiler._profiles["succeed"]
+if profile.calls != 5 or profile.errors != 0:
+  print "Expected 5 calls and no errors, got " + str((profile.calls, profile.errors))
+if sum(profile.histogram) != 5:
+  print "Expected 5 calls in the histogram, got " + str(profile.histogram)
+
+profile = apiprofiler._profiles["fail"]
+if profile.calls != 1 or profile.errors != 1:
+  print "Expected 1 call with an error, got " + str((profile.calls, profile.errors))
+
+# A 10ms call belongs in the 8192-16384us bucket
+profile = apiprofiler._profiles["wait"]
+if profile.maxtime < 0.01 or profile.totaltime < 0.01:
+  print "The time of the call was not recorded: " + str(profile.maxtime)
+if profile.histogram[14] != 1:
+  print "Expected the call in bucket 14, got " + str(profile.histogram)
+
+# Bucket boundaries
+for elapsed, bucket in [(0.0, 0), (0.0000005, 0), (0.000001, 1),
+    (0.0000015, 1), (0.000002, 2), (1.0, 20), (1000.0, apiprofiler.HISTOGRAM_BUCKETS - 1)]:
+  if apiprofiler._get_bucket(elapsed) != bucket:
+    print "Expected " + str(elapsed) + "s in bucket " + str(bucket) + ", got " + str(apiprofiler._get_bucket(elapsed))
+
+# Functions which weren't called aren't reported
+apiprofiler.profile_function("unused", succeed)
+
+filename = "junk_test_apiprofiler.out"
+apiprofiler.write_report(filename)
+report = open(filename).read()
+os.remove(filename)
+
+# Each function has a row with its numbers, followed by an indented line
+# with its histogram
+names = []
+totals = []
+for line in report.splitlines():
+  if line.startswith("#") or line.startswith(" "):
+    continue
+  fields = line.split()
+  names.append(fields[0])
+  totals.append(float(fields[3]))
+
+if sorted(names) != ["fail", "succeed", "wait"]:
+  print "Expected rows for fail, succeed and wait, got " + str(names) + ":\n" + report
+if totals != sorted(totals, reverse=True):
+  print "The report is not sorted by total time:\n" + report
+if names and names[0] != "wait":
+  print "The function that took the longest should come first:\n" + report
+if "unused" in report:
+  print "A function which was never called was reported:\n" + report
+if "8192-16384us:1" not in report:
+  print "The histogram of the wait function is missing:\n" + report
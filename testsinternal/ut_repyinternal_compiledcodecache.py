@@ -0,0 +1,88 @@
+"""
+This unit test checks that the compiled code of programs which passed the
+safety check is cached (repy's --codecache), without running repy.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import safe
+
+
+safe.SAFE_CHECK_CACHE_DIR = tempfile.mkdtemp()
+
+code = "x = 1\n"
+
+# Code that wasn't checked is compiled, but not cached
+if safe._get_compiled_code_cache_entry(code, "prog.r2py") is not None:
+  print "Code that wasn't checked should have no compiled code entry"
+codeobj = safe.compile_checked_code(code, "prog.r2py")
+if os.listdir(safe.SAFE_CHECK_CACHE_DIR) != []:
+  print "Code that wasn't checked should not be cached"
+
+# Once the code passed the check, its compiled code is cached
+safe.serial_safe_check(code)
+entrypath = safe._get_compiled_code_cache_entry(code, "prog.r2py")
+codeobj = safe.compile_checked_code(code, "prog.r2py")
+if entrypath is None or not os.path.isfile(entrypath):
+  print "The compiled code was not cached"
+
+# ... and loaded from the cache instead of compiled again
+original_compile = safe._saved_compile
+def fail_compile(*args):
+  raise Exception("The code should not have been compiled again")
+safe._saved_compile = fail_compile
+try:
+  cachedcodeobj = safe.compile_checked_code(code, "prog.r2py")
+  if cachedcodeobj != codeobj or cachedcodeobj.co_filename != "prog.r2py":
+    print "The cached code differs from the compiled code"
+  context = {}
+  exec cachedcodeobj in context
+  if context["x"] != 1:
+    print "The cached code does not run correctly"
+except Exception, e:
+  print str(e)
+safe._saved_compile = original_compile
+
+# The name is part of the entry, since it ends up in the code object
+if safe._get_compiled_code_cache_entry(code, "other.r2py") == entrypath:
+  print "Compiling under another name should use another entry"
+if safe.compile_checked_code(code, "other.r2py").co_filename != "other.r2py":
+  print "The code was not compiled under the other name"
+
+# A damaged entry is compiled again and replaced
+entryfo = open(entrypath, "wb")
+entryfo.write("garbage")
+entryfo.close()
+if safe.compile_checked_code(code, "prog.r2py") != codeobj:
+  print "A damaged entry should be compiled again"
+entryfo = open(entrypath, "rb")
+if entryfo.read() == "garbage":
+  print "A damaged entry should be replaced"
+entryfo.close()
+
+# Nothing is loaded from a directory other users can write to
+if not sys.platform.startswith("win"):
+  os.chmod(safe.SAFE_CHECK_CACHE_DIR, 0777)
+  if safe._get_compiled_code_cache_entry(code, "prog.r2py") is not None:
+    print "There should be no compiled code entry in a directory others can write to"
+  safe._saved_compile = fail_compile
+  try:
+    safe.compile_checked_code(code, "prog.r2py")
+  except Exception:
+    pass
+  else:
+    print "The compiled code should not have been loaded from a directory others can write to"
+  safe._saved_compile = original_compile
+  os.chmod(safe.SAFE_CHECK_CACHE_DIR, 0700)
+
+shutil.rmtree(safe.SAFE_CHECK_CACHE_DIR)
+
+# Without a cache directory nothing is cached
+safe.SAFE_CHECK_CACHE_DIR = None
+if safe._get_compiled_code_cache_entry(code, "prog.r2py") is not None:
+  print "There should be no compiled code entry without a cache directory"
+if safe.compile_checked_code(code, "prog.r2py") != codeobj:
+  print "The code should still be compiled without a cache directory"
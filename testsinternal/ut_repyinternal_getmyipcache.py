@@ -0,0 +1,133 @@
+"""
+This unit test checks that emulcomm caches the IP getmyip() finds, and
+probes the stable public IPs at the same time, without running repy.
+"""
+
+import socket
+import threading
+import time
+
+import emulcomm
+import repy_constants
+
+
+probed = []
+
+def stub_get_local_ip(connection_type, external_ip, external_port=80):
+  probed.append(external_ip)
+  # Only the last IP can be reached, and only slowly
+  time.sleep(0.2)
+  if external_ip != repy_constants.STABLE_PUBLIC_IPS[-1]:
+    raise socket.error(101, "Network is unreachable")
+  return "10.9.8.7"
+
+emulcomm._get_localIP_to_remoteIP = stub_get_local_ip
+
+
+# All probes run at the same time
+start = time.time()
+if emulcomm._get_public_ip() != "10.9.8.7":
+  print "Wrong IP found"
+if time.time() - start > 0.2 * len(repy_constants.STABLE_PUBLIC_IPS) - 0.1:
+  print "The probes were not run at the same time"
+
+# The next call is answered from the cache
+time.sleep(0.3)
+del probed[:]
+if emulcomm._get_public_ip() != "10.9.8.7" or probed:
+  print "The IP was not cached"
+
+# Once the cache expires, we probe again. Failures are not cached.
+def stub_offline(connection_type, external_ip, external_port=80):
+  probed.append(external_ip)
+  raise socket.error(101, "Network is unreachable")
+
+emulcomm._get_localIP_to_remoteIP = stub_offline
+emulcomm._myip_cache_expiry = None
+
+for attempt in range(2):
+  del probed[:]
+  try:
+    emulcomm._get_public_ip()
+  except emulcomm.InternetConnectivityError:
+    pass
+  else:
+    print "Expected InternetConnectivityError"
+
+  time.sleep(0.1)
+  if len(probed) != len(repy_constants.STABLE_PUBLIC_IPS):
+    print "Expected every IP to be probed again"
+
+
+# The IP found through the first stable IP that works is used, even if a
+# later one answers first, as when they were tried one after another
+def stub_by_priority(connection_type, external_ip, external_port=80):
+  probed.append(external_ip)
+  if external_ip == repy_constants.STABLE_PUBLIC_IPS[0]:
+    raise socket.error(101, "Network is unreachable")
+  if external_ip == repy_constants.STABLE_PUBLIC_IPS[1]:
+    time.sleep(0.3)
+    return "10.0.0.2"
+  return "10.0.0.3"
+
+emulcomm._get_localIP_to_remoteIP = stub_by_priority
+emulcomm._myip_cache_expiry = None
+
+# The cachelock is not held while the probes run, and callers meanwhile
+# share the running probe
+lockwasfree = []
+otherresults = []
+def check_while_probing():
+  time.sleep(0.1)
+  if emulcomm.cachelock.acquire(False):
+    emulcomm.cachelock.release()
+    lockwasfree.append(True)
+  otherresults.append(emulcomm._get_public_ip())
+
+otherthread = threading.Thread(target=check_while_probing)
+otherthread.start()
+
+del probed[:]
+if emulcomm._get_public_ip() != "10.0.0.2":
+  print "The IP should have been found through the earliest stable IP that works"
+otherthread.join()
+if not lockwasfree:
+  print "The cachelock should not be held while probing"
+if otherresults != ["10.0.0.2"]:
+  print "A concurrent caller got a different IP: " + str(otherresults)
+if len(probed) != len(repy_constants.STABLE_PUBLIC_IPS):
+  print "Concurrent callers should share one probe, probed: " + str(probed)
+
+
+# Address change notifications expire the cache, but are only read (and
+# the change counted) once the cachelock is held
+(notifysock, kernelsock) = socket.socketpair()
+notifysock.setblocking(0)
+emulcomm._address_change_socket = notifysock
+emulcomm._address_change_socket_opened = True
+
+if emulcomm._myip_cache_is_stale():
+  print "The cache should still be good before any notification"
+
+changecount = emulcomm._address_change_count
+kernelsock.send("change")
+if not emulcomm._myip_cache_is_stale() or not emulcomm._ip_cache_is_stale():
+  print "A pending notification should make the caches stale"
+if emulcomm._address_change_count != changecount:
+  print "Checking for staleness should not count the change"
+if not emulcomm._address_changes_pending():
+  print "Checking for staleness should not read the notification"
+
+del probed[:]
+if emulcomm._get_public_ip() != "10.0.0.2":
+  print "Wrong IP found after an address change"
+if len(probed) != len(repy_constants.STABLE_PUBLIC_IPS):
+  print "The IP should have been probed again after an address change"
+if emulcomm._address_change_count != changecount + 1:
+  print "The address change should have been counted once"
+if emulcomm._address_changes_pending() or emulcomm._myip_cache_is_stale():
+  print "The notification should have been read and the cache refreshed"
+
+emulcomm._address_change_socket = None
+notifysock.close()
+kernelsock.close()
@@ -0,0 +1,67 @@
+"""
+This unit test checks the buffers which carry in-process loopback
+connections (repy's --loopbackfastpath), without running repy.
+"""
+
+import errno
+import socket
+
+import emulcomm
+
+
+identity = ("TCP", "127.0.0.1", 12346, "127.0.0.1", 12345)
+client, server = emulcomm._create_in_process_pair(identity)
+emulcomm._IN_PROCESS_CONNECTIONS.add(identity)
+
+
+def expect_error(func, args, errnum):
+  try:
+    func(*args)
+  except socket.error, e:
+    if e[0] != errnum:
+      print "Expected error " + errno.errorcode[errnum] + ", got " + str(e)
+  else:
+    print "Expected error " + errno.errorcode[errnum] + " from " + str(func)
+
+
+# Nothing was sent yet
+expect_error(server.recv, (10,), errno.EWOULDBLOCK)
+
+# Data arrives in order, and can be read in pieces
+client.send("hello ")
+client.send("world")
+if server.recv(3) != "hel":
+  print "Wrong first piece"
+if server.recv(100) != "lo world":
+  print "Wrong second piece"
+
+# Sends are limited by the buffer size
+client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 10)
+if server.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) != 10:
+  print "The buffer size should be shared by both ends"
+if client.send("x" * 20) != 10:
+  print "The send should have been limited to the buffer size"
+expect_error(client.send, ("x",), errno.EWOULDBLOCK)
+server.recv(100)
+
+# Other options are just remembered
+server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+if server.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY) != 1:
+  print "nodelay was not set"
+
+# After a close, the rest of the data can still be read
+server.send("bye")
+server.close()
+if client.recv(100) != "bye":
+  print "The data sent before close was lost"
+if client.recv(100) != "":
+  print "recv() should return '' after a remote close"
+expect_error(client.send, ("x",), errno.EPIPE)
+expect_error(server.recv, (10,), errno.EBADF)
+
+# The tuple is in use until both ends are closed
+if identity not in emulcomm._IN_PROCESS_CONNECTIONS:
+  print "The tuple was released too early"
+client.close()
+if identity in emulcomm._IN_PROCESS_CONNECTIONS:
+  print "The tuple was not released"
@@ -0,0 +1,119 @@
+"""
+This unit test checks the interface enumeration in nix_common_api: the
+parsers for ifconfig and netstat output (against captured output from
+several platforms), and the native getifaddrs() based lookup.
+"""
+
+import socket
+import sys
+
+if sys.platform.startswith("win"):
+  # Nothing to test here
+  sys.exit(0)
+
+import nix_common_api
+
+
+LINUX_NETTOOLS_OLD = """eth0      Link encap:Ethernet  HWaddr 00:16:3e:2c:11:9a  
+          inet addr:10.0.2.15  Bcast:10.0.2.255  Mask:255.255.255.0
+          inet6 addr: fe80::216:3eff:fe2c:119a/64 Scope:Link
+          UP BROADCAST RUNNING MULTICAST  MTU:1500  Metric:1
+
+eth0:1    Link encap:Ethernet  HWaddr 00:16:3e:2c:11:9a  
+          inet addr:10.0.3.15  Bcast:10.0.3.255  Mask:255.255.255.0
+
+lo        Link encap:Local Loopback  
+          inet addr:127.0.0.1  Mask:255.0.0.0
+          inet6 addr: ::1/128 Scope:Host
+          UP LOOPBACK RUNNING  MTU:16436  Metric:1
+"""
+
+LINUX_NETTOOLS_NEW = """eth0: flags=4163<UP,BROADCAST,RUNNING,MULTICAST>  mtu 1400
+        inet 192.0.2.2  netmask 255.255.255.0  broadcast 192.0.2.255
+        inet6 fd00::2  prefixlen 64  scopeid 0x0<global>
+        ether 02:fc:00:00:00:01  txqueuelen 1000  (Ethernet)
+
+ifb0: flags=130<BROADCAST,NOARP>  mtu 1500
+        ether 92:70:e0:1e:75:65  txqueuelen 32  (Ethernet)
+
+lo: flags=73<UP,LOOPBACK,RUNNING>  mtu 65536
+        inet 127.0.0.1  netmask 255.0.0.0
+        inet6 ::1  prefixlen 128  scopeid 0x10<host>
+"""
+
+DARWIN = """lo0: flags=8049<UP,LOOPBACK,RUNNING,MULTICAST> mtu 16384
+\toptions=3<RXCSUM,TXCSUM>
+\tinet6 fe80::1%lo0 prefixlen 64 scopeid 0x1 
+\tinet 127.0.0.1 netmask 0xff000000 
+\tinet6 ::1 prefixlen 128 
+en0: flags=8863<UP,BROADCAST,SMART,RUNNING,SIMPLEX,MULTICAST> mtu 1500
+\tether 60:33:4b:12:34:56 
+\tinet 192.168.1.23 netmask 0xffffff00 broadcast 192.168.1.255
+\tmedia: autoselect
+\tstatus: active
+"""
+
+LINUX_NETSTAT = """Kernel Interface table
+Iface             MTU    RX-OK RX-ERR RX-DRP RX-OVR    TX-OK TX-ERR TX-DRP TX-OVR Flg
+eth0             1400       54      0      0 0            54      0      0      0 BMRU
+lo              65536     4333      0      0 0          4333      0      0      0 LRU
+"""
+
+BSD_NETSTAT = """Name  Mtu   Network       Address            Ipkts Ierrs    Opkts Oerrs  Coll
+em0   1500  <Link#1>      08:00:27:aa:bb:cc    12345     0     6789     0     0
+em0   1500  10.0.2.0      10.0.2.15            12000     -     6500     -     -
+lo0   16384 <Link#2>                             100     0      100     0     0
+lo0   16384 127.0.0.0     127.0.0.1              100     -      100     -     -
+"""
+
+
+def check(name, actual, expected):
+  if actual != expected:
+    print "%s: expected %s, got %s" % (name, expected, actual)
+
+
+check("old linux ifconfig",
+    nix_common_api.parse_ifconfig_addresses(LINUX_NETTOOLS_OLD),
+    [("eth0", socket.AF_INET, "10.0.2.15"),
+     ("eth0", socket.AF_INET6, "fe80::216:3eff:fe2c:119a"),
+     ("eth0:1", socket.AF_INET, "10.0.3.15"),
+     ("lo", socket.AF_INET, "127.0.0.1"),
+     ("lo", socket.AF_INET6, "::1")])
+
+check("new linux ifconfig",
+    nix_common_api.parse_ifconfig_addresses(LINUX_NETTOOLS_NEW),
+    [("eth0", socket.AF_INET, "192.0.2.2"),
+     ("eth0", socket.AF_INET6, "fd00::2"),
+     ("lo", socket.AF_INET, "127.0.0.1"),
+     ("lo", socket.AF_INET6, "::1")])
+
+check("darwin ifconfig",
+    nix_common_api.parse_ifconfig_addresses(DARWIN),
+    [("lo0", socket.AF_INET6, "fe80::1"),
+     ("lo0", socket.AF_INET, "127.0.0.1"),
+     ("lo0", socket.AF_INET6, "::1"),
+     ("en0", socket.AF_INET, "192.168.1.23")])
+
+check("empty ifconfig", nix_common_api.parse_ifconfig_addresses(""), [])
+
+check("linux netstat",
+    nix_common_api.parse_netstat_interfaces(LINUX_NETSTAT), ["eth0", "lo"])
+
+check("bsd netstat",
+    nix_common_api.parse_netstat_interfaces(BSD_NETSTAT), ["em0", "lo0"])
+
+
+# The native lookup must find the loopback address
+records = nix_common_api.get_interface_addresses()
+loopback = None
+for (interface, family, address) in records:
+  if family == socket.AF_INET and address == "127.0.0.1":
+    loopback = interface
+
+if loopback is None:
+  print "The loopback address was not found in", records
+else:
+  if "127.0.0.1" not in nix_common_api.get_interface_ip_addresses(loopback):
+    print "get_interface_ip_addresses() did not find the loopback address"
+  if loopback not in nix_common_api.get_available_interfaces():
+    print "get_available_interfaces() did not find", loopback
@@ -0,0 +1,79 @@
+"""
+This unit test checks the deep copy the namespace layer makes of arguments
+and return values, without running repy.
+"""
+
+import namespace
+
+
+# Simple values are returned as they are
+for value in ["abc", u"abc", 1, 2L, 1.5, 1j, True, None, frozenset([1])]:
+  if namespace._copy(value) is not value:
+    print "Expected " + repr(value) + " to be returned without a copy"
+
+# Tuples of immutable values don't need a copy either
+immutable = ("a", 1, ("b", (2.0, None)))
+if namespace._copy(immutable) is not immutable:
+  print "Expected a tuple of immutable values to be returned without a copy"
+
+# Mutable containers are copied, including when nested in a tuple
+original = ("a", [1, 2], {"key" : ["value"]})
+copied = namespace._copy(original)
+if copied is original or copied != original:
+  print "Expected an equal copy of a tuple holding mutable values"
+if copied[1] is original[1] or copied[2] is original[2]:
+  print "Expected the mutable values in the tuple to be copied"
+if copied[2]["key"] is original[2]["key"]:
+  print "Expected the list in the dict to be copied"
+
+original = set([1, ("a", "b")])
+copied = namespace._copy(original)
+if copied is original or copied != original:
+  print "Expected an equal copy of a set"
+
+original = ["file1", "file2", "file3"]
+copied = namespace._copy(original)
+if copied is original or copied != original:
+  print "Expected an equal copy of a list"
+
+# Circular references are preserved
+original = [1]
+original.append(original)
+copied = namespace._copy(original)
+if copied is original or copied[1] is not copied:
+  print "Expected the copy of a circular list to refer to itself"
+
+original = {}
+original["tuple"] = (original,)
+copied = namespace._copy(original)
+if copied is original or copied["tuple"][0] is not copied:
+  print "Expected the copy of a tuple in a circular dict to refer to the copy"
+
+# Shared values stay shared
+shared = [1]
+original = [shared, shared]
+copied = namespace._copy(original)
+if copied[0] is shared or copied[0] is not copied[1]:
+  print "Expected a value that appears twice to be copied once"
+
+# Handles are never copied
+lock = namespace.thread.allocate_lock()
+if namespace._copy([lock])[0] is not lock:
+  print "Expected a lock to be returned without a copy"
+
+pending = namespace.emulcomm.PendingConnection(None, False,
+    ("TCP", "127.0.0.1", 12345, "127.0.0.1", 12346), 0)
+if namespace._copy([pending])[0] is not pending:
+  print "Expected a pending connection to be returned without a copy"
+
+# Anything else is refused
+class NewStyle(object):
+  pass
+
+for value in [NewStyle(), ("a", NewStyle()), [{"a" : NewStyle()}]]:
+  try:
+    namespace._copy(value)
+  except namespace.NamespaceInternalError:
+    pass
+  else:
+    print "Expected _copy of " + repr(value) + " to fail"
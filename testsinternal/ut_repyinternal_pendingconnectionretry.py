@@ -0,0 +1,104 @@
+"""
+This unit test checks that openconnectionasync()'s PendingConnection
+keeps retrying recoverable connect errors for as long as the caller
+waits, without running repy.
+"""
+
+import errno
+import socket
+import time
+
+import emulcomm
+import nanny
+import nonportable
+
+
+nanny.start_resource_nanny("restrictions.fixed")
+
+listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+listensock.bind(("127.0.0.1", 0))
+listensock.listen(5)
+destport = listensock.getsockname()[1]
+
+original_start_connect = emulcomm._start_connect
+attempts = []
+
+def failing_start_connect(sock, destip, destport):
+  attempts.append(time.time())
+  raise socket.error(errno.EAGAIN, "Resource temporarily unavailable")
+
+def flaky_start_connect(sock, destip, destport):
+  # The first few attempts fail, like with a full route cache
+  if len(attempts) < 3:
+    return failing_start_connect(sock, destip, destport)
+  attempts.append(time.time())
+  return original_start_connect(sock, destip, destport)
+
+
+def get_pending_connection(timeout):
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.bind(("127.0.0.1", 0))
+  sock.setblocking(0)
+  identity = ("TCP", "127.0.0.1", sock.getsockname()[1], "127.0.0.1", destport)
+  return emulcomm.PendingConnection(sock, True, identity,
+      nonportable.getruntime() + timeout)
+
+
+# A wait() retries after a recoverable error, backing off between attempts
+emulcomm._start_connect = flaky_start_connect
+pending = get_pending_connection(5)
+try:
+  connsock = pending.wait(2)
+except emulcomm.SocketWouldBlockError:
+  print "wait() should have retried until the connection was established"
+else:
+  connsock.close()
+if len(attempts) != 4:
+  print "Expected 4 attempts, got " + str(len(attempts))
+elif not attempts[1] - attempts[0] < attempts[3] - attempts[2]:
+  print "The time between attempts should grow"
+
+# poll() does not wait, and fails until the connection is established
+del attempts[:]
+emulcomm._start_connect = failing_start_connect
+pending = get_pending_connection(5)
+start = time.time()
+try:
+  pending.poll()
+except emulcomm.SocketWouldBlockError:
+  pass
+else:
+  print "poll() should not have connected"
+if time.time() - start > 0.1:
+  print "poll() should not wait"
+
+# A wait() which never connects lasts as long as asked, without busy
+# waiting
+del attempts[:]
+start = time.time()
+try:
+  pending.wait(0.5)
+except emulcomm.SocketWouldBlockError:
+  pass
+else:
+  print "wait() should not have connected"
+if time.time() - start < 0.4:
+  print "wait() returned before its timeout"
+if len(attempts) > 15:
+  print "Too many attempts while waiting: " + str(len(attempts))
+pending.cancel()
+
+# The connection still times out on its own
+pending = get_pending_connection(0.3)
+start = time.time()
+try:
+  pending.wait(5)
+except emulcomm.TimeoutError:
+  pass
+else:
+  print "Expected TimeoutError"
+if time.time() - start > 1:
+  print "The connection should have timed out after 0.3 seconds"
+
+emulcomm._start_connect = original_start_connect
+listensock.close()
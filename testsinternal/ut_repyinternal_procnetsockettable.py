@@ -0,0 +1,92 @@
+"""
+This unit test checks the /proc/net socket table parser in linux_api
+against captured /proc/net files, and checks the lookups against a real
+listening socket.
+"""
+
+import socket
+import sys
+
+# The fixtures are from a little endian Linux host
+if not sys.platform.startswith("linux") or sys.byteorder != "little":
+  sys.exit(0)
+
+import linux_api
+
+
+PROC_NET_TCP = """  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode                                                     
+   0: 00000000:07E8 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 662 1 000000008af744f3 100 0 0 10 0                       
+   1: 0100007F:3039 00000000:0000 0A 00000000:00000000 00:00000000 00000000  1000        0 909 1 00000000068351de 100 0 0 10 0                       
+   2: 0100007F:303A 0100007F:3039 01 00000000:00000000 00:00000000 00000000  1000        0 30302 2 00000000a9ba9eae 20 4 22 18 -1                    
+   3: 0F02000A:C350 0202000A:0050 06 00000000:00000000 03:00000dd5 00000000     0        0 0 3 0000000000000000                                     
+"""
+
+PROC_NET_TCP6 = """  sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000000000000000000000000000:1F90 00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 00000000  1000        0 4242 1 0000000000000000 100 0 0 10 0
+   1: 0000000000000000FFFF00000100007F:1F91 0000000000000000FFFF00000100007F:D431 08 00000000:00000000 00:00000000 00000000  1000        0 4243 1 0000000000000000 20 4 30 10 -1
+"""
+
+PROC_NET_UDP = """   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops            
+  123: 0100007F:3039 00000000:0000 07 00000000:00000000 00:00000000 00000000  1000        0 5151 2 0000000000000000 0         
+"""
+
+
+def check(name, actual, expected):
+  if actual != expected:
+    print "%s: expected %s, got %s" % (name, expected, actual)
+
+
+tcp_records = linux_api.parse_proc_net_sockets(PROC_NET_TCP)
+check("tcp", tcp_records,
+    [("0.0.0.0", 2024, "0.0.0.0", 0, "LISTEN"),
+     ("127.0.0.1", 12345, "0.0.0.0", 0, "LISTEN"),
+     ("127.0.0.1", 12346, "127.0.0.1", 12345, "ESTABLISHED"),
+     ("10.0.2.15", 50000, "10.0.2.2", 80, "TIME_WAIT")])
+
+tcp6_records = linux_api.parse_proc_net_sockets(PROC_NET_TCP6)
+check("tcp6", tcp6_records,
+    [("::", 8080, "::", 0, "LISTEN"),
+     ("127.0.0.1", 8081, "127.0.0.1", 54321, "CLOSE_WAIT")])
+
+udp_records = linux_api.parse_proc_net_sockets(PROC_NET_UDP)
+check("udp", udp_records, [("127.0.0.1", 12345, "0.0.0.0", 0, "CLOSE")])
+
+check("empty", linux_api.parse_proc_net_sockets(""), [])
+
+
+table = linux_api.SocketTable(tcp_records + tcp6_records, udp_records)
+
+check("established", table.get_connection_state("127.0.0.1", 12346, "127.0.0.1", 12345), "ESTABLISHED")
+check("dual stack", table.get_connection_state("127.0.0.1", 8081, "127.0.0.1", 54321), "CLOSE_WAIT")
+check("no connection", table.get_connection_state("127.0.0.1", 12345, "127.0.0.1", 12346), None)
+
+check("listening", table.is_listening("127.0.0.1", 12345, True), True)
+check("wildcard", table.is_listening("10.0.2.15", 2024, True), True)
+check("wildcard v6", table.is_listening("127.0.0.1", 8080, True), True)
+check("not listening", table.is_listening("127.0.0.1", 12346, True), False)
+check("udp bound", table.is_listening("127.0.0.1", 12345, False), True)
+check("udp not bound", table.is_listening("127.0.0.1", 12346, False), False)
+
+
+# Check the lookups against the real socket table. Read a table before
+# the sockets exist, to make sure the lookups don't use it.
+linux_api.get_socket_table()
+
+listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+listener.bind(("127.0.0.1", 0))
+listener.listen(1)
+port = listener.getsockname()[1]
+
+client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+client.connect(("127.0.0.1", port))
+clientport = client.getsockname()[1]
+
+check("real connection",
+    linux_api.exists_outgoing_network_socket("127.0.0.1", clientport, "127.0.0.1", port),
+    (True, "ESTABLISHED"))
+
+if not linux_api.exists_listening_network_socket("127.0.0.1", port, True):
+  print "The listening socket was not found"
+
+client.close()
+listener.close()
@@ -0,0 +1,102 @@
+"""
+This unit test checks the hostname resolver cache in emulcomm against a
+stub resolver, without running repy.
+"""
+
+import socket
+import threading
+import time
+
+import emulcomm
+
+
+lookups = []
+
+# Lookups of names starting with "stuck" wait for this
+unstuck = threading.Event()
+
+def stub_gethostbyname(name):
+  lookups.append(name)
+  if name == "slow.example":
+    time.sleep(0.5)
+  if name.startswith("stuck"):
+    unstuck.wait()
+  if name in ["known.example", "slow.example"]:
+    return "10.1.2.3"
+  raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+
+emulcomm._system_gethostbyname = stub_gethostbyname
+emulcomm.resolver_timeout = 0.2
+
+
+# The first lookup goes to the resolver, the second one is cached
+if emulcomm._resolve_hostname("known.example") != ("10.1.2.3", False):
+  print "Wrong result for the first lookup"
+if emulcomm._resolve_hostname("known.example") != ("10.1.2.3", True):
+  print "The second lookup should have been cached"
+if lookups != ["known.example"]:
+  print "The resolver was called too often: " + str(lookups)
+
+# Names which can't be resolved are cached as well
+del lookups[:]
+if emulcomm._resolve_hostname("unknown.example") != (None, False):
+  print "Wrong result for an unknown name"
+if emulcomm._resolve_hostname("unknown.example") != (None, True):
+  print "The failed lookup should have been cached"
+if lookups != ["unknown.example"]:
+  print "The resolver was called too often: " + str(lookups)
+
+# IP addresses don't need a lookup
+del lookups[:]
+if emulcomm._resolve_hostname("127.0.0.1") != ("127.0.0.1", True) or lookups:
+  print "An IP address should not be looked up"
+
+# Expired entries are looked up again
+emulcomm._RESOLVER_CACHE["known.example"] = ("10.1.2.3", 0.0)
+emulcomm._resolve_hostname("known.example")
+if lookups != ["known.example"]:
+  print "An expired entry was not looked up again"
+
+# A slow lookup times out, but its result is still cached
+del lookups[:]
+start = time.time()
+if emulcomm._resolve_hostname("slow.example") != (None, False):
+  print "The slow lookup should have timed out"
+if time.time() - start > 0.4:
+  print "The timed out lookup took too long"
+time.sleep(0.5)
+if emulcomm._resolve_hostname("slow.example") != ("10.1.2.3", True):
+  print "The result of the timed out lookup was not cached"
+
+# The cache does not grow past its size
+emulcomm.RESOLVER_CACHE_SIZE = 3
+for index in range(5):
+  emulcomm._resolve_hostname("host" + str(index) + ".example")
+if len(emulcomm._RESOLVER_CACHE) > 3:
+  print "The cache grew past its size: " + str(len(emulcomm._RESOLVER_CACHE))
+
+# Only a few lookups run at the same time. Further names fail right away,
+# but names that are cached or being looked up still work.
+for index in range(emulcomm.RESOLVER_MAX_LOOKUPS):
+  emulcomm._resolve_hostname("stuck" + str(index) + ".example")
+
+start = time.time()
+try:
+  emulcomm._resolve_hostname("stuckmore.example")
+except emulcomm.ResourceExhaustedError:
+  pass
+else:
+  print "Too many lookups were started"
+if time.time() - start > 0.1:
+  print "A lookup beyond the limit should fail right away"
+
+if emulcomm._resolve_hostname("stuck0.example") != (None, False):
+  print "Waiting for a running lookup should still work"
+if emulcomm._resolve_hostname("127.0.0.1") != ("127.0.0.1", True):
+  print "An IP address should still work"
+
+# Once the lookups finish, new ones can start again
+unstuck.set()
+time.sleep(0.2)
+if emulcomm._resolve_hostname("stuckmore.example") != (None, False):
+  print "A new lookup should work once the others finished"
@@ -0,0 +1,142 @@
+"""
+This unit test checks that the _ast based safety check in safe.py makes the
+same decisions as the compiler module based check it replaced, without
+running repy. The old check is reproduced below as the reference.
+"""
+
+import glob
+import warnings
+
+warnings.simplefilter('ignore')
+import compiler
+warnings.resetwarnings()
+
+import exception_hierarchy
+import safe
+
+
+def compiler_check_node(node):
+  if node.__class__.__name__ not in safe._NODE_CLASS_OK:
+    raise exception_hierarchy.CheckNodeException(node.lineno,node.__class__.__name__)
+
+  for attribute, value in node.__dict__.iteritems():
+    if type(value) == unicode:
+      raise exception_hierarchy.CheckStrException(node.lineno, attribute, value)
+
+    if attribute in safe._NODE_ATTR_OK:
+      continue
+
+    if attribute == 'doc' and (node.__class__.__name__ in
+      ['Module', 'Function', 'Class']):
+      continue
+
+    if not safe._is_string_safe(value):
+      raise exception_hierarchy.CheckStrException(node.lineno, attribute, value)
+
+  for child in node.getChildNodes():
+    compiler_check_node(child)
+
+
+def compiler_safe_check(code):
+  compiler_check_node(compiler.parse(code))
+
+
+def get_decision(check, code):
+  """Returns None if code is accepted, otherwise the type of the error."""
+  try:
+    check(code)
+  except Exception, e:
+    return type(e)
+  return None
+
+
+SNIPPETS = [
+  # Statements
+  "x = 1\n", "x = y = 2\n", "x, y = 1, 2\n", "[x, y] = 1, 2\n", "x += 1\n",
+  "x.a = 1\n", "x.a += 1\n", "x[0] = 1\n", "x[0] += 1\n", "x[1:2] = y\n",
+  "x[1:2:3] = y\n", "x[...] = y\n", "x[1:2, 3] = y\n", "del x\n", "del x.a\n",
+  "del x[0]\n", "del x[1:2]\n", "del x, y\n", "del (x, y)\n", "del [x, y]\n",
+  "pass\n", "if x:\n  pass\nelif y:\n  pass\nelse:\n  pass\n",
+  "while x:\n  break\nelse:\n  pass\n", "for i in x:\n  continue\nelse:\n  pass\n",
+  "for a, b in x:\n  pass\n", "for a.b in x:\n  pass\n", "for a[0] in x:\n  pass\n",
+  "try:\n  pass\nexcept:\n  pass\n", "try:\n  pass\nexcept E, e:\n  pass\nelse:\n  pass\n",
+  "try:\n  pass\nexcept (A, B), (e, f):\n  pass\n", "try:\n  pass\nexcept E, e.a:\n  pass\n",
+  "try:\n  pass\nfinally:\n  pass\n", "try:\n  pass\nexcept E as e:\n  pass\nfinally:\n  pass\n",
+  "raise\n", "raise E\n", "raise E, v\n", "raise E, v, t\n", "assert x\n", "assert x, 'msg'\n",
+  "return\n", "def f():\n  return\n", "def f():\n  return 1\n",
+  "import os\n", "from os import path\n", "from os import *\n", "import os as __x\n",
+  "exec 'x'\n", "exec 'x' in d\n", "global x\n", "def f():\n  global x\n",
+  "print x\n", "print x,\n", "print >> f, x\n", "print\n",
+  "with x:\n  pass\n", "with x as y:\n  pass\n",
+  "def f():\n  yield 1\n", "def f():\n  x = yield\n",
+  # Functions and classes
+  "def f(a, b=1, *c, **d):\n  pass\n", "def f(a, (b, c)):\n  pass\n",
+  "def f(__a):\n  pass\n", "def f(__a):\n  return __a\n", "def f(a=__b):\n  pass\n",
+  "def f(*__a):\n  pass\n", "def f(**__a):\n  pass\n", "def f(encode):\n  pass\n",
+  "def f(encode):\n  return encode\n", "def f(a=lambda: 1):\n  pass\n",
+  "def __init__(self):\n  pass\n", "def __f(self):\n  pass\n", "def encode():\n  pass\n",
+  "def func_x():\n  pass\n", "def im_x():\n  pass\n", "def f_x():\n  pass\n",
+  "@d\ndef f():\n  pass\n", "@d\nclass C:\n  pass\n",
+  "class C:\n  pass\n", "class C(object):\n  pass\n", "class C(A, B):\n  x = 1\n",
+  "class __C:\n  pass\n", "class C(__B):\n  pass\n", "class C():\n  pass\n",
+  "def f():\n  '''doc with __x'''\n", "def f():\n  u'''unicode doc'''\n",
+  "class C:\n  '''doc __x'''\n", "class C:\n  u'''doc'''\n", "'''module __doc__'''\n",
+  "u'''module doc'''\n", "'''doc'''\n'''not doc __x'''\n", "def f():\n  pass\n  '''late __doc'''\n",
+  "def f():\n  def g():\n    return 1\n  return g\n",
+  # Expressions
+  "x = a and b or c\n", "x = not a\n", "x = a + b - c * d / e % f ** g\n", "x = a // b\n",
+  "x = a << b >> c\n", "x = a & b | c ^ d\n", "x = ~a\n", "x = -a\n", "x = +a\n", "x = -1\n",
+  "x = a < b <= c == d != e > f >= g\n", "x = a <> b\n", "x = a in b\n", "x = a not in b\n",
+  "x = a is b\n", "x = a is not b\n", "x = lambda: 1\n", "x = lambda a: a\n",
+  "x = a if b else c\n", "x = {}\n", "x = {1: 2, 'a': b}\n", "x = {1, 2}\n", "x = set()\n",
+  "x = [a for a in b]\n", "x = [a for a in b if a if c for d in e]\n",
+  "x = [__a for a in b]\n", "x = [a for __a in b]\n", "x = [a for a in __b]\n", "x = [a for a in b if __c]\n",
+  "x = {a for a in b}\n", "x = {a: a for a in b}\n", "x = (a for a in b)\n", "f(a for a in b)\n",
+  "x = `a`\n", "x = f(a, b=1, *c, **d)\n", "f(__x=1)\n", "f(encode=1)\n", "f(*__a)\n", "f(**__a)\n",
+  "x = 1\n", "x = 1L\n", "x = 1.5\n", "x = 1j\n", "x = 0x10\n", "x = 'abc'\n", "x = '__import__'\n",
+  "x = u'abc'\n", "x = ur'abc'\n", "x = b'abc'\n", "x = 'a' 'b'\n", "x = 'a' u'b'\n", "x = r'\\x'\n",
+  "x = '\xc3\xa9'\n", "x = '\\u1234'\n", "x = '\\N{DASH}'\n",
+  "x = a.b\n", "x = a.b.c\n", "x = a.__class__\n", "x = a.__init__\n", "x = a.__repr__\n",
+  "x = a.__del__\n", "x = a.__iter__\n", "x = a.__str__\n", "x = a.__x\n", "x = a.x__y\n",
+  "x = a.func_globals\n", "x = a.im_func\n", "x = a.tb_frame\n", "x = a.f_back\n", "x = a.co_code\n",
+  "x = a.encode\n", "x = a.decode('x')\n", "x = a.encoded\n", "x = a._x\n", "x = a.x_func_\n",
+  "x = __x\n", "__x = 1\n", "x = __init__\n", "encode = 1\n", "x = f_x\n", "x = co\n",
+  "x = a[0]\n", "x = a[1:2]\n", "x = a[:]\n", "x = a[::2]\n", "x = a[1:2:3]\n",
+  "x = a[...]\n", "x = a[1:2, 3]\n", "x = a[1, 2]\n", "x = a[__b]\n", "x = a[1:__b]\n",
+  "x = (1,)\n", "x = ()\n", "x = [1, 2]\n", "x = []\n", "x = None\n", "x = True\n",
+  "x = a.b(c)[d].e\n", "x = f(*a)\n", "x = f(**a)\n", "x = f(a, *b, **c)\n",
+  "x = (yield)\n", "x = [(yield)]\n",
+  # Syntax errors
+  "x = \n", "def f(:\n", "x = 1", "if x:\npass\n", "x = 1\r\ny = 2\n", "\tx = 1\n",
+  "x = 'unterminated\n", "x = '\xff'\n",
+  # Deep nesting
+  "x = " + "(" * 50 + "1" + ")" * 50 + "\n",
+  "x = " + "[" * 30 + "]" * 30 + "\n",
+  "x = " + "+".join(["a"] * 500) + "\n",
+  "x = " + "-" * 200 + "1\n",
+  "x = " + "not " * 200 + "1\n",
+  "".join([" " * i + "if x:\n" for i in range(80)]) + " " * 80 + "pass\n",
+  "".join([" " * i + "def f%d():\n" % i for i in range(50)]) + " " * 50 + "pass\n",
+]
+
+# The repy programs among the tests. The pragma is split up so that this
+# file isn't taken for one of them.
+for filename in glob.glob("ut_*.py"):
+  code = open(filename).read()
+  if "#pragma" + " repy" in code:
+    SNIPPETS.append(code)
+
+
+for snippet in SNIPPETS:
+  # VirtualNamespace adds this line to all code
+  for code in [snippet, "# coding: utf-8\n\n" + snippet]:
+    expected = get_decision(compiler_safe_check, code)
+    actual = get_decision(safe.safe_check, code)
+
+    # The old check recursed for each level of nesting
+    if expected is RuntimeError:
+      expected = None
+
+    if expected is not actual:
+      print "Different decision for " + repr(code) + ": expected " + \
+          str(expected) + ", got " + str(actual)
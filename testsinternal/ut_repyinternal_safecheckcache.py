@@ -0,0 +1,84 @@
+"""
+This unit test checks the cache of safety check results (repy's
+--codecache), without running repy.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import safe
+
+
+safe.SAFE_CHECK_CACHE_DIR = tempfile.mkdtemp()
+
+# Only directories nobody else can write to may be used
+if not sys.platform.startswith("win"):
+  if not safe.is_private_cache_dir(safe.SAFE_CHECK_CACHE_DIR):
+    print "A directory only we can write to should be accepted"
+  for mode in [0720, 0702, 0777]:
+    os.chmod(safe.SAFE_CHECK_CACHE_DIR, mode)
+    if safe.is_private_cache_dir(safe.SAFE_CHECK_CACHE_DIR):
+      print "A directory with mode " + oct(mode) + " should be refused"
+  os.chmod(safe.SAFE_CHECK_CACHE_DIR, 0700)
+  if safe.is_private_cache_dir(os.path.join(safe.SAFE_CHECK_CACHE_DIR, "missing")):
+    print "A missing directory should be refused"
+
+safecode = "x = 1\n"
+unsafecode = "import os\n"
+
+entrypath = safe._get_safe_check_cache_entry(safecode)
+
+# Code that passes the check is remembered
+if os.path.exists(entrypath):
+  print "The cache should start out empty"
+if safe.serial_safe_check(safecode) is not True:
+  print "The safe code should pass the check"
+if not os.path.isfile(entrypath):
+  print "The result of the check was not cached"
+if os.listdir(safe.SAFE_CHECK_CACHE_DIR) != [os.path.basename(entrypath)]:
+  print "Unexpected files in the cache: " + str(os.listdir(safe.SAFE_CHECK_CACHE_DIR))
+
+# ... and not checked again
+original_safe_check_subprocess = safe.safe_check_subprocess
+def fail_safe_check_subprocess(code):
+  raise Exception("The code should not have been checked again")
+safe.safe_check_subprocess = fail_safe_check_subprocess
+try:
+  if safe.serial_safe_check(safecode) is not True:
+    print "The cached code should pass the check"
+except Exception, e:
+  print str(e)
+safe.safe_check_subprocess = original_safe_check_subprocess
+
+# Code that fails the check is never cached
+try:
+  safe.serial_safe_check(unsafecode)
+except Exception:
+  pass
+else:
+  print "The unsafe code should fail the check"
+if os.path.exists(safe._get_safe_check_cache_entry(unsafecode)):
+  print "A failed check was cached"
+
+# Changing the policy invalidates the entries
+safe._NODE_CLASS_OK.append("Import")
+if safe._get_safe_check_cache_entry(safecode) == entrypath:
+  print "Changing the allowed nodes should change the cache entry"
+safe._NODE_CLASS_OK.remove("Import")
+
+safe._BUILTIN_OK.append("open")
+if safe._get_safe_check_cache_entry(safecode) == entrypath:
+  print "Changing the allowed builtins should change the cache entry"
+safe._BUILTIN_OK.remove("open")
+
+if safe._get_safe_check_cache_entry(safecode) != entrypath:
+  print "Restoring the policy should restore the cache entry"
+
+shutil.rmtree(safe.SAFE_CHECK_CACHE_DIR)
+
+# Without a cache directory nothing is cached
+safe.SAFE_CHECK_CACHE_DIR = None
+if safe._get_safe_check_cache_entry(safecode) is not None:
+  print "There should be no cache entry without a cache directory"
@@ -0,0 +1,118 @@
+"""
+This unit test checks the safe_check.py worker processes that check code
+for safety, without running repy.
+"""
+
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import safe
+import safe_check
+
+
+if safe.SAFE_CHECK_WORKERS_SUPPORTED:
+  safe.SAFE_CHECK_WORKER_MAX_CHECKS = 3
+  # Long enough for the checks below to reuse workers, short enough to see
+  # them retire at the end
+  safe.SAFE_CHECK_WORKER_IDLE_TIMEOUT = 2.0
+
+  # Workers are reused for later checks
+  safe.serial_safe_check("x = 1\n")
+  worker = safe._idle_safe_check_workers[0]
+  safe.serial_safe_check("x = 2\n")
+  if safe._idle_safe_check_workers != [worker]:
+    print "The worker was not reused"
+
+  # Failed checks are reported as before
+  try:
+    safe.serial_safe_check("import os\n")
+  except safe.exception_hierarchy.SafeException, e:
+    if "CheckNodeException" not in str(e):
+      print "Unexpected error for unsafe code: " + str(e)
+  else:
+    print "The unsafe code should fail the check"
+
+  # That was the third check, so the worker has exited
+  if worker in safe._idle_safe_check_workers:
+    print "The worker should have retired after 3 checks"
+  if worker.proc.poll() is None:
+    print "The retired worker is still running"
+
+  # A worker that died while idle is replaced
+  safe.serial_safe_check("x = 3\n")
+  worker = safe._idle_safe_check_workers[0]
+  os.kill(worker.proc.pid, signal.SIGKILL)
+  worker.proc.wait()
+  safe.serial_safe_check("x = 4\n")
+  if safe._idle_safe_check_workers[0] is worker:
+    print "The dead worker was not replaced"
+
+  # Checks run in parallel, each in its own worker
+  errors = []
+  def check():
+    try:
+      safe.serial_safe_check("def f():\n  return 1\n")
+    except Exception, e:
+      errors.append(e)
+
+  threads = []
+  for count in range(4):
+    threads.append(threading.Thread(target=check))
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  if errors:
+    print "Parallel checks failed: " + str(errors)
+  if len(safe._idle_safe_check_workers) > safe.SAFE_CHECK_WORKERS:
+    print "More workers than SAFE_CHECK_WORKERS were started"
+
+  for worker in safe._idle_safe_check_workers:
+    worker.close()
+  del safe._idle_safe_check_workers[:]
+
+  # A worker which replies with garbage is killed, not left running
+  safe.serial_safe_check("x = 5\n")
+  worker = safe._idle_safe_check_workers[0]
+  worker.close()
+  worker.proc = subprocess.Popen([sys.executable, "-c",
+      "import sys, time\n" +
+      "sys.stdin.readline()\n" +
+      "sys.stdout.write('SAFECHECK garbage 0\\n')\n" +
+      "sys.stdout.flush()\n" +
+      "time.sleep(60)\n"],
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  worker.retired = False
+  try:
+    safe.serial_safe_check("x = 6\n")
+  except ValueError:
+    pass
+  else:
+    print "Garbage from the worker should have failed the check"
+  if worker.proc.poll() is None:
+    print "The worker which replied with garbage is still running"
+  if worker in safe._idle_safe_check_workers:
+    print "The worker which replied with garbage should not be reused"
+
+  # Idle workers exit after a while
+  safe.serial_safe_check("x = 7\n")
+  worker = safe._idle_safe_check_workers[0]
+  time.sleep(3)
+  if safe._idle_safe_check_workers:
+    print "The idle worker should have been retired"
+  if worker.proc.poll() is None:
+    print "The idle worker is still running"
+
+
+# Workers retire based on the memory they use now, not the most they ever
+# used, where that can be found out
+if os.path.exists("/proc/self/statm"):
+  memory = "x" * (64 * 1024 * 1024)
+  del memory
+  if safe_check.get_current_memory() > safe_check.get_peak_memory() - 32 * 1024 * 1024:
+    print "The memory in use should be less than the peak once it was freed"
@@ -0,0 +1,75 @@
+"""
+This unit test checks that SafeDict rejects the same keys when it
+remembers the keys it already checked, without running repy.
+"""
+
+import safe
+
+
+class StrSubclass(str):
+  pass
+
+
+def check_rejected(key, exceptiontype):
+  for attempt in range(2):
+    for operation in ["get", "set", "del", "contains"]:
+      safedict = safe.SafeDict({"ok": 1})
+      try:
+        if operation == "get":
+          safedict[key]
+        elif operation == "set":
+          safedict[key] = 1
+        elif operation == "del":
+          del safedict[key]
+        else:
+          key in safedict
+      except exceptiontype:
+        pass
+      else:
+        print "The key " + repr(key) + " should be rejected by " + operation
+
+
+safe._safe_dict_valid_keys.clear()
+
+safedict = safe.SafeDict()
+safedict["mycontext"] = 1
+if "mycontext" not in safe._safe_dict_valid_keys:
+  print "A valid key should be remembered"
+
+# Remembered keys still work as usual
+safedict["mycontext"] = 2
+if safedict["mycontext"] != 2 or "mycontext" not in safedict:
+  print "A remembered key should be usable"
+if safedict.keys() != ["mycontext"]:
+  print "Unexpected keys: " + str(safedict.keys())
+del safedict["mycontext"]
+if "mycontext" in safedict:
+  print "A remembered key should be deletable"
+
+# Unsafe keys are rejected every time, and never remembered
+for key in ["__class__", "func_globals", "im_self", u"__class__", "_" + "_"]:
+  check_rejected(key, ValueError)
+  if key in safe._safe_dict_valid_keys:
+    print "The unsafe key " + repr(key) + " was remembered"
+
+# So are keys which aren't strings, even if they equal a remembered key
+check_rejected(1, TypeError)
+check_rejected(StrSubclass("mycontext"), TypeError)
+
+# Unicode keys are checked, but not remembered
+safedict[u"unicodekey"] = 1
+if safedict[u"unicodekey"] != 1 or u"unicodekey" in safe._safe_dict_valid_keys:
+  print "Unicode keys should work, but not be remembered"
+
+# Keys the code set in the underlying dict are still filtered
+safedict.__under__["__builtins__"] = {}
+if "__builtins__" in safedict.keys():
+  print "Unsafe keys of the underlying dict should not be listed"
+
+# The remembered keys are limited
+for count in range(safe._SAFE_DICT_VALID_KEYS_MAX + 10):
+  safedict["key" + str(count)] = count
+if len(safe._safe_dict_valid_keys) > safe._SAFE_DICT_VALID_KEYS_MAX:
+  print "Too many keys are remembered: " + str(len(safe._safe_dict_valid_keys))
+if safedict["key5"] != 5:
+  print "Keys should be checked again after they were forgotten"
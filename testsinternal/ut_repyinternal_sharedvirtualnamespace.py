@@ -0,0 +1,65 @@
+"""
+This unit test checks that createvirtualnamespace() shares VirtualNamespace
+objects for the same code and name while they are in use, without running
+repy.
+"""
+
+import gc
+
+import safe
+import virtual_namespace
+
+
+code = "x = 1\n"
+
+first = virtual_namespace.createvirtualnamespace(code, "lib.r2py")
+
+# The same code under the same name is neither checked nor compiled again
+original_serial_safe_check = safe.serial_safe_check
+def fail_serial_safe_check(code):
+  raise Exception("The code should not have been checked again")
+safe.serial_safe_check = fail_serial_safe_check
+try:
+  if virtual_namespace.createvirtualnamespace(code, "lib.r2py") is not first:
+    print "The same code and name should share the VirtualNamespace"
+except Exception, e:
+  print str(e)
+safe.serial_safe_check = original_serial_safe_check
+
+# Other code or another name get their own
+if virtual_namespace.createvirtualnamespace(code, "other.r2py") is first:
+  print "Another name should get another VirtualNamespace"
+if virtual_namespace.createvirtualnamespace("x = 2\n", "lib.r2py") is first:
+  print "Other code should get another VirtualNamespace"
+
+# Each evaluation still uses its own context
+firstcontext = first.evaluate({})
+secondcontext = first.evaluate({"y": 2})
+# Evaluating destroys the builtins, which this test still needs
+safe._builtin_restore()
+safe.BUILTINS_DESTROYED = False
+if firstcontext is secondcontext or "y" in firstcontext or secondcontext["x"] != 1:
+  print "Evaluating a shared VirtualNamespace should use the given context"
+
+# Unsafe code is rejected every time and never shared
+for attempt in range(2):
+  try:
+    virtual_namespace.createvirtualnamespace("import os\n", "bad.r2py")
+  except virtual_namespace.CodeUnsafeError:
+    pass
+  else:
+    print "Unsafe code should be rejected"
+
+# Arguments of the wrong type are still rejected
+try:
+  virtual_namespace.createvirtualnamespace(code, 1)
+except virtual_namespace.RepyArgumentError:
+  pass
+else:
+  print "A name that isn't a string should be rejected"
+
+# Once nobody uses it anymore, it is freed
+del first
+gc.collect()
+if len(virtual_namespace._shared_namespaces) != 0:
+  print "Unused VirtualNamespaces should be freed: " + str(virtual_namespace._shared_namespaces.keys())
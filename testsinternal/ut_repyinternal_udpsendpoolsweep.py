@@ -0,0 +1,45 @@
+"""
+This unit test checks that the sockets sendmessage() keeps for later
+messages are closed once they have been idle for a while, even if the
+program makes no further network calls, without running repy.
+"""
+
+import time
+
+import emulcomm
+import nanny
+import nonportable
+
+
+nanny.start_resource_nanny("restrictions.twoports")
+
+def get_outsockets():
+  limits, usage = nanny.get_resource_information()
+  return usage["outsockets"]
+
+
+emulcomm.UDP_SEND_POOL_IDLE_TIMEOUT = 0.5
+
+emulcomm.sendmessage("127.0.0.1", 12345, "HI", "127.0.0.1", 12346)
+if get_outsockets() != 1:
+  print "Expected 1 outsocket, got " + str(get_outsockets())
+
+# A sweep before the timeout keeps the socket
+emulcomm._sweep_udp_send_pool()
+if get_outsockets() != 1:
+  print "The socket was closed before it was idle for long enough"
+
+# A socket that is in use is kept, however long ago it was last used
+sock = emulcomm._get_udp_send_socket("127.0.0.1", 12346)
+emulcomm._UDP_SEND_POOL[("127.0.0.1", 12346)][1] = nonportable.getruntime() - 60
+emulcomm._sweep_udp_send_pool()
+if get_outsockets() != 1:
+  print "A socket in use should not be closed"
+
+# Once it is handed back and idle for long enough, the timer closes it
+emulcomm._release_udp_send_socket("127.0.0.1", 12346, sock)
+time.sleep(1.5)
+if get_outsockets() != 0:
+  print "The idle socket was not released! Outsockets: " + str(get_outsockets())
+if emulcomm._UDP_SEND_POOL:
+  print "The idle socket is still pooled"
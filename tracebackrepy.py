@@ -48,7 +48,8 @@ import os
 # from the traceback, so that if there is an exception, they will
 # not appear in the stack.
 TB_SKIP_MODULES = ["repy.py","safe.py","virtual_namespace.py","namespace.py","emulcomm.py",
-                      "emultimer.py","emulmisc.py","emulfile.py","nonportable.py","socket.py"]
+                      "emultimer.py","emulmisc.py","emulfile.py","nonportable.py","socket.py",
+                      "apiprofiler.py"]
 
 
 # sets the user's file name.
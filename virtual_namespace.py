@@ -17,12 +17,89 @@ import safe
 # Get the errors
 from exception_hierarchy import *
 
-# This is to work around safe...
-safe_compile = compile
+# Used to share VirtualNamespace objects between callers
+import threading
+import weakref
+
+# Maps (code, name) to a weak reference to the VirtualNamespace created for
+# it, for as long as someone still uses that VirtualNamespace. We don't use
+# weakref.WeakValueDictionary, since it needs builtins which are not
+# available while the sandboxed code runs.
+_shared_namespaces = {}
+# This is reentrant, since a VirtualNamespace may be freed (and its entry
+# removed) by a garbage collection that runs while the lock is held.
+_shared_namespaces_lock = threading.RLock()
+
+
+def _get_forget_shared_namespace(key):
+  """
+  Returns the callback of the weak reference to the VirtualNamespace shared
+  under key, which removes its entry once it is freed.
+  """
+  def forget_shared_namespace(namespaceref):
+    _shared_namespaces_lock.acquire()
+    try:
+      # The entry may already refer to a newer VirtualNamespace
+      if _shared_namespaces.get(key) is namespaceref:
+        del _shared_namespaces[key]
+    finally:
+      _shared_namespaces_lock.release()
+
+  return forget_shared_namespace
+
 
 # Functional constructor for VirtualNamespace
 def createvirtualnamespace(code, name):
-  return VirtualNamespace(code,name)
+  """
+  <Purpose>
+    Returns a VirtualNamespace for code. Creating a VirtualNamespace checks
+    and compiles the code, so callers which ask for the same code under the
+    same name while an earlier VirtualNamespace for it is still in use get
+    that one instead. This is safe because a VirtualNamespace is never
+    changed after it is created, and evaluate() runs in the context that is
+    passed to it.
+
+  <Arguments>
+    See VirtualNamespace.__init__.
+
+  <Exceptions>
+    See VirtualNamespace.__init__.
+
+  <Returns>
+    A VirtualNamespace object.
+  """
+  # Anything but strings raises the usual error when it is created below
+  if type(code) is not str or type(name) is not str:
+    return VirtualNamespace(code,name)
+
+  key = (code, name)
+
+  _shared_namespaces_lock.acquire()
+  try:
+    namespaceref = _shared_namespaces.get(key)
+    if namespaceref is not None:
+      namespace = namespaceref()
+      if namespace is not None:
+        return namespace
+  finally:
+    _shared_namespaces_lock.release()
+
+  # Create it without holding the lock, since checking the code may take
+  # a while. If another thread creates the same one meanwhile, we keep
+  # the one that was registered first.
+  namespace = VirtualNamespace(code,name)
+
+  _shared_namespaces_lock.acquire()
+  try:
+    namespaceref = _shared_namespaces.get(key)
+    if namespaceref is not None:
+      existing = namespaceref()
+      if existing is not None:
+        return existing
+    _shared_namespaces[key] = weakref.ref(namespace, _get_forget_shared_namespace(key))
+    return namespace
+  finally:
+    _shared_namespaces_lock.release()
 
 # This class is used to represent a namespace
 class VirtualNamespace(object):
@@ -76,7 +153,7 @@ class VirtualNamespace(object):
       raise CodeUnsafeError, "Code failed safety check! Error: "+str(e)
 
     # All good, store the compiled byte code
-    self.code = safe_compile(code,name,"exec")
+    self.code = safe.compile_checked_code(code,name)
 
 
   # Evaluates the virtual namespace